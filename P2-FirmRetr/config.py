@@ -3,5 +3,27 @@ source_data_path = "/data/firmproj/data/"
 
 result_root_path = "/data/firmproj/result/"
 
+# LLM 响应缓存 (sqlite), 跨数据集、跨运行共享
+llm_cache_path = "/data/firmproj/cache/llm_response_cache.sqlite"
+
+# 运行清单 (sqlite), 记录每个app每个阶段的完成情况, 用于 --resume 断点续跑
+run_manifest_path = "/data/firmproj/cache/run_manifest.sqlite"
+
+# 跨app请求去重表 (sqlite), 相同的请求值只送入LLM一次
+dedup_store_path = "/data/firmproj/cache/request_dedup.sqlite"
+
+# 请求值的近似重复索引 (sqlite, MinHash/LSH), 相似的请求复用 phase2 标签
+near_dup_index_path = "/data/firmproj/cache/near_dup_index.sqlite"
+
+# 已下载的固件链接 (sqlite), 之后的运行和其他app不再重复下载
+download_history_path = "/data/firmproj/cache/download_history.sqlite"
+
+# 按内容哈希去重的固件存储, 镜像只保存一份, 硬链接到各app的 firmware 目录
+firmware_store_path = "/data/firmproj/firmware_store/"
+
+# LLM 请求限速 (每分钟请求数 / 每分钟 token 数), 0 表示不限制
+llm_requests_per_minute = 600
+llm_tokens_per_minute = 2000000
+
 process_dataset = "IoT-VER"
 # process_dataset = "LOCAL_APK"
\ No newline at end of file
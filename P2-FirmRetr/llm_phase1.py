@@ -1,14 +1,28 @@
 import os
 import re
 import time
-import random
 import json
+import asyncio
+import argparse
 from tqdm import tqdm
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from utils.myllm_sdk import create_chat_completion, model_redirect
-from utils.utils import save_llm_phase_time, save_llm_usage, save_errors
+from utils.deepseek_tokenizer import count_tokens, count_tokens_batch
+from utils.myllm_sdk import create_chat_completion, model_redirect, get_client_pool_stats
+from utils.myllm_sdk import acreate_chat_completion, set_async_concurrency, aclose_clients
+from utils.myllm_sdk import setup_response_cache, response_cache_stats, setup_rate_limiter, rate_limiter_stats
+from utils.rate_limiter import add_rate_limit_args
+from utils.llm_cache import record_cache_stats, add_cache_args
+from utils.work_queue import get_work_queue
+from utils.flow import call_step, gather_steps, run_flow, arun_flow
+from utils.run_manifest import checkpoint_stage, current_checkpoint, fingerprint_value, setup_run_manifest, add_manifest_args
+from utils import incremental_index
+from utils.incremental_index import IncrementalIndex, setup_incremental, add_incremental_args
+from utils import request_dedup
+from utils.request_dedup import DedupClaim, setup_dedup_store, add_dedup_args, dedup_stats
+from utils.app_stats import record_app_stats, current_app_stats, setup_metrics_store, add_stats_args
+from utils.utils import save_errors, run_apps_async
 from utils.logger import Logger, ensure_log_directory, get_latest_log_number
-from config import source_data_path, result_root_path, process_dataset
+from config import source_data_path, result_root_path, process_dataset, llm_cache_path, llm_requests_per_minute, llm_tokens_per_minute, run_manifest_path, dedup_store_path
 
 log_dir = "logs/llm_phase1"
 ensure_log_directory(log_dir)
@@ -90,12 +104,8 @@ def save2json(content, json_path):
 
 
 
-# 三个阶段统一传参为 app package name
-def format_url(app_name,dataset):
-    # 该函数主要对通过静态分析获取的json格式中的url请求信息进行提取，并返回一个格式化的数据
-    # path_prefix = "/data/firmproj"
-    logger.info(f"========== llm phase1 | start process {app_name} ==========")
-    phase1_start_time = time.time()
+def list_format_inputs(app_name, dataset):
+    # 获取需要处理的 llm_preprocess 输出文件
     targetdir_path = os.path.join(result_root_path,dataset,app_name,"llm_preprocess")
 
     need_process_json = []
@@ -103,6 +113,228 @@ def format_url(app_name,dataset):
         if file.endswith(".json"):
             need_process_json.append(os.path.join(targetdir_path, file))
     logger.debug(need_process_json)
+    return need_process_json
+
+# 分组的 token 预算: 每次调用的输入 token (包含 prompt) 和预估的输出 token
+# deepseek-v3 的输入上限为 65536, 输出上限为 create_chat_completion 的 max_tokens=8192
+GROUP_INPUT_TOKENS = 16000
+GROUP_OUTPUT_TOKENS = 6000
+# 输出 token 的估计值: 每一项的输入 token * OUTPUT_TOKEN_RATIO
+OUTPUT_TOKEN_RATIO = 0.6
+# 线程模式下所有app共用的分组任务队列的线程数
+GROUP_WORKERS = 16
+
+def build_format_groups(app_name, content, prompt_tokens, input_budget=None, output_budget=None):
+    """
+    按 token 预算对json的各项装箱 (First Fit Decreasing), 使每个分组的输入和预估输出都不超过预算
+    只有一个分组时结果保存为 {app_name}.json, 否则保存为 {app_name}_{group_index}.json
+    超过预算的单项单独成组
+    返回 [(输出文件名, 分组内容)]
+    """
+    input_budget = max(1, (input_budget or GROUP_INPUT_TOKENS) - prompt_tokens)
+    output_budget = output_budget or GROUP_OUTPUT_TOKENS
+
+    all_items = [(str(k), v) for k, v in content.items()]
+    item_tokens = count_tokens_batch([json.dumps({k: v}) for k, v in all_items])
+    order = sorted(range(len(all_items)), key=lambda i: item_tokens[i], reverse=True)
+
+    # 每个分组: [已用输入token, 已用输出token, 项的下标]
+    bins = []
+    for i in order:
+        input_tokens = item_tokens[i]
+        output_tokens = input_tokens * OUTPUT_TOKEN_RATIO
+        for group_bin in bins:
+            if group_bin[0] + input_tokens <= input_budget and group_bin[1] + output_tokens <= output_budget:
+                break
+        else:
+            group_bin = [0, 0, []]
+            bins.append(group_bin)
+        group_bin[0] += input_tokens
+        group_bin[1] += output_tokens
+        group_bin[2].append(i)
+
+    # 分组内保持原来的顺序
+    groups = [{all_items[i][0]: all_items[i][1] for i in sorted(group_bin[2])} for group_bin in bins]
+    if len(groups) == 1:
+        return [(f"{app_name}.json", groups[0])]
+    return [(f"{app_name}_{group_index}.json", group) for group_index, group in enumerate(groups)]
+
+def is_overflow_error(error_info):
+    # 输出被截断, 或输入超过模型的最大长度
+    if error_info.get("error_code") == "MAX_OUTPUT_LENGTH":
+        return True
+    message = str(error_info.get("error_code")).lower()
+    return "maximum" in message and "length" in message
+
+def split_format_group(output_name, group):
+    # 将溢出的分组对半拆分, {name}.json -> {name}_0.json, {name}_1.json
+    items = list(group.items())
+    middle = len(items) // 2
+    stem = output_name[:-len(".json")]
+    return [(f"{stem}_0.json", dict(items[:middle])), (f"{stem}_1.json", dict(items[middle:]))]
+
+def resumed_output_names(checkpoint, output_name, group):
+    # 续跑时直接复用的分组: 上次溢出拆分过时, 其输出为拆分后(可能多次拆分)的文件
+    if len(group) > 1:
+        sub_groups = split_format_group(output_name, group)
+        if all(checkpoint.item_done(sub_name) for sub_name, _ in sub_groups):
+            return [name for sub_name, sub_group in sub_groups
+                    for name in resumed_output_names(checkpoint, sub_name, sub_group)]
+    return [output_name]
+
+def mark_split_group(checkpoint, output_name, fingerprint, sub_groups, result):
+    # 拆分后的两半都完成时, 原分组记为完成, 续跑时不再重复溢出的那次调用
+    if all(checkpoint.item_done(sub_name) for sub_name, _ in sub_groups):
+        checkpoint.mark_item(output_name, fingerprint, result)
+
+def build_format_message(prompt, group):
+    return [
+        {'role': 'system', 'content': prompt},
+        {'role': 'user', 'content': json.dumps(group)}
+    ]
+
+def handle_format_completion(success, completion, llm_time, app_name, json_file, output_path):
+    """
+    处理一次LLM调用的结果并保存到 output_path
+    返回该次调用使用的 token 数量, 调用失败时返回 None
+    """
+    if not success:
+        logger.error(f"error code: {completion['error_code']}, message: {completion['message']}")
+        logger.error(f"faild app: {app_name} ,faild file: {json_file}")
+        return None
+
+    llm_response_content = completion.choices[0].message.content
+    usage = completion.usage
+    logger.debug(f"response_content: {llm_response_content}")
+    logger.debug(f"finish reason: {completion.choices[0].finish_reason}")
+    logger.info(f"success app: {app_name} ,success file: {json_file}")
+    logger.info(f"used token: {usage.total_tokens} (input_tokens: {usage.prompt_tokens},output_tokens: {usage.completion_tokens})")
+    logger.info(f"used time: {llm_time}s")
+    # 将内容保存到 json 文件, 作为下一阶段的输入
+    if not is_json_format(llm_response_content,logger):
+        llm_response_content = get_json_content_from_llm_response(llm_response_content)
+        logger.debug(f"LLM_response match json format:\n{llm_response_content}")
+        # 防止llm输出不完整导致格式化匹配不到json情况
+        if llm_response_content == "{}":
+            logger.error(f"llm response incomplete, faild app: {app_name}, faild_file: {json_file}")
+    try:
+        # 防止llm输出的json格式出错
+        save2json(llm_response_content, output_path)
+    except Exception as e:
+        logger.error(f"{e}")
+        logger.error(f"Json format error, faild app: {app_name}, faild_file: {json_file}")
+    return usage.total_tokens
+
+def format_group_flow(prompt, app_name, json_file, result_path, output_name, group, written):
+    """
+    处理一个分组, 溢出时拆分为两半分别重试 (同步时依次重试, 异步时并发)
+    返回 (llm 用时, token 数量, 调用次数), 实际写入的输出文件名加入 written
+    断点续跑时, 上次已完成的分组直接返回记录的结果
+    """
+    checkpoint = current_checkpoint()
+    fingerprint = fingerprint_value(group)
+    stored = checkpoint.completed_item(output_name, fingerprint)
+    if stored is not None:
+        written.update(resumed_output_names(checkpoint, output_name, group))
+        return tuple(stored)
+
+    message = build_format_message(prompt, group)
+    llm_chat_start_time = time.time()
+    success, completion = yield call_step(create_chat_completion, acreate_chat_completion,
+                                          messages=message, model=MODEL, temperature=0.7)
+    llm_time = time.time() - llm_chat_start_time
+    tokens = handle_format_completion(success, completion, llm_time,
+                                      app_name, json_file, os.path.join(result_path, output_name))
+    if tokens is not None:
+        written.add(output_name)
+        checkpoint.mark_item(output_name, fingerprint, [llm_time, tokens, 1])
+        return llm_time, tokens, 1
+    if success or not is_overflow_error(completion) or len(group) <= 1:
+        checkpoint.mark_item(output_name, fingerprint, status="failed")
+        return 0, 0, 1
+
+    logger.warning(f"group overflow, split and retry, app: {app_name}, group: {output_name} ({len(group)} items)")
+    sub_groups = split_format_group(output_name, group)
+    results = yield gather_steps(format_group_flow(prompt, app_name, json_file, result_path, sub_name, sub_group, written)
+                                 for sub_name, sub_group in sub_groups)
+    total = [sum(result[0] for result in results), sum(result[1] for result in results),
+             1 + sum(result[2] for result in results)]
+    mark_split_group(checkpoint, output_name, fingerprint, sub_groups, total)
+    return tuple(total)
+
+def reuse_format_results(request_index, content, result_path, app_name, output_names):
+    """
+    增量模式: 之前格式化过的请求直接复用结果, 保存为 {app_name}_reused.json
+    返回仍需送入LLM的内容
+    """
+    reused = {}
+    for key in content:
+        output = request_index.get(key, "phase1")
+        if output is not None:
+            reused[key] = output
+    logger.info(f"incremental: {len(reused)}/{len(content)} requests unchanged, reuse phase1 results")
+    if reused:
+        reused_name = f"{app_name}_reused.json"
+        save2json(reused, os.path.join(result_path, reused_name))
+        output_names.add(reused_name)
+    return {key: value for key, value in content.items() if key not in reused}
+
+def finish_incremental_format(request_index, result_path, output_names, input_keys):
+    """
+    增量模式: 删除上一次运行留下、本次没有生成的输出文件 (序号可能已经变化, 不能与本次结果合并),
+    并把本次新格式化的结果按请求指纹记录到索引中
+    """
+    for file in os.listdir(result_path):
+        if file.endswith(".json") and file not in output_names:
+            logger.info(f"incremental: remove stale output {file}")
+            os.remove(os.path.join(result_path, file))
+    for file in os.listdir(result_path):
+        if not file.endswith(".json"):
+            continue
+        for key, output in get_json_content_from_file(os.path.join(result_path, file)).items():
+            if key in input_keys and request_index.get(key, "phase1") is None:
+                request_index.set(key, "phase1", output)
+    request_index.save()
+
+def format_groups_flow(prompt, app_name, json_file, result_path, groups, written):
+    """
+    同一个app的各个分组并发处理 (同步时提交到共享的任务队列), 按分组顺序汇总结果
+    返回 (llm 用时, token 数量, 调用次数), 写入的输出文件名(包括溢出拆分后的)加入 written
+    """
+    flows = []
+    for group_index, (output_name, group) in enumerate(groups):
+        logger.info(f"processing group {group_index+1}/{len(groups)} ({len(group)} items)")
+        flows.append(format_group_flow(prompt, app_name, json_file, result_path, output_name, group, written))
+    results = yield gather_steps(flows, get_work_queue("phase1_group", GROUP_WORKERS))
+    return (sum(result[0] for result in results), sum(result[1] for result in results),
+            sum(result[2] for result in results))
+
+def collect_format_outputs(result_path, output_names, since):
+    # 读取本次分组(包括溢出拆分后)在 since 之后写入的输出, 返回 {key: 格式化结果}
+    outputs = {}
+    for file in sorted(output_names):
+        file_path = os.path.join(result_path, file)
+        if os.path.exists(file_path) and os.path.getmtime(file_path) >= since:
+            try:
+                outputs.update(get_json_content_from_file(file_path))
+            except json.JSONDecodeError:
+                logger.error(f"Json format error, skip dedup output: {file}")
+    return outputs
+
+def save_shared_format_results(dedup_claim, result_path, app_name, output_names):
+    # 跨app去重复用的结果保存为 {app_name}_shared.json, 与本app的分组输出一起作为下一阶段的输入
+    if not dedup_claim.shared:
+        return
+    logger.info(f"dedup: {len(dedup_claim.shared)}/{len(dedup_claim.items)} requests share phase1 results with other apps")
+    shared_name = f"{app_name}_shared.json"
+    save2json(dedup_claim.shared, os.path.join(result_path, shared_name))
+    output_names.add(shared_name)
+
+def format_app_flow(app_name, dataset):
+    # 该函数主要对通过静态分析获取的json格式中的url请求信息进行提取，并返回一个格式化的数据
+    # path_prefix = "/data/firmproj"
+    phase1_start_time = time.time()
+    need_process_json = list_format_inputs(app_name, dataset)
 
     # 可能会存在apk目录为空
     if not need_process_json:
@@ -117,8 +349,10 @@ def format_url(app_name,dataset):
         os.makedirs(result_path)
 
     prompt = get_prompt_content("prompt/extract_urlinfo_prompt.txt")
-
-    group_threshold = 35
+    prompt_tokens = count_tokens(prompt)
+    app_stats = current_app_stats()
+    request_index = IncrementalIndex.for_app(result_root_path, dataset, app_name) if incremental_index.incremental else None
+    output_names, input_keys = set(), set()
 
     for index, json_file in enumerate(need_process_json,start=1):
         # json file name
@@ -132,103 +366,105 @@ def format_url(app_name,dataset):
         #     continue
         
         json_pairs_num = count_json_pairs(content)
-        # 对于小于50项的json文件，直接使用LLM进行解析
         if json_pairs_num == 0 :
             logger.info(f"Json file {json_file_name} is empty, skip")
             continue
-        elif json_pairs_num <= group_threshold :
-            message = [
-                {'role': 'system', 'content': prompt},
-                {'role': 'user', 'content': json.dumps(content)}
-            ]
-
-            llm_chat_start_time = time.time()
-            success, completion = create_chat_completion(messages=message,model=MODEL,temperature=0.7)
-            llm_chat_end_time = time.time()
-            if not success:
-                logger.error(f"error code: {completion['error_code']}, message: {completion['message']}")
-                logger.error(f"faild app: {app_name} ,faild file: {json_file}")
-                continue
-            
-            llm_response_content = completion.choices[0].message.content
-            usage = completion.usage
-            logger.debug(f"response_content: {llm_response_content}")
-            logger.debug(f"finish reason: {completion.choices[0].finish_reason}")
-            logger.info(f"success app: {app_name} ,success file: {json_file}")
-            logger.info(f"used token: {usage.total_tokens} (input_tokens: {usage.prompt_tokens},output_tokens: {usage.completion_tokens})")
-            logger.info(f"used time: {llm_chat_end_time - llm_chat_start_time}s")
-            save_llm_phase_time(os.path.join(result_root_path, dataset, app_name, "firmproj_stats.json"), "llm_phase1_chat", llm_chat_end_time - llm_chat_start_time)
-            save_llm_usage(os.path.join(result_root_path, dataset, app_name, "firmproj_stats.json"), "llm_phase1_usage", usage.total_tokens)
-            # 将内容保存到 json 文件, 作为下一阶段的输入
-            if not is_json_format(llm_response_content,logger):
-                llm_response_content = get_json_content_from_llm_response(llm_response_content)
-                logger.debug(f"LLM_response match json format:\n{llm_response_content}")
-                # 防止llm输出不完整导致格式化匹配不到json情况 
-                if llm_response_content == "{}":
-                    logger.error(f"llm response incomplete, faild app: {app_name}, faild_file: {json_file}")
-            try:
-                # 防止llm输出的json格式出错
-                save2json(llm_response_content, os.path.join(result_path, f"{app_name}.json"))
-            except Exception as e:
-                logger.error(f"Json format error, faild app: {app_name}, faild_file: {json_file}")
-        
-        # 剩下的都是 json 项 >40 的,进行拆分处理，提高LLM的准确性和分析时间
-        else:
-            # 按照 group_size 分组
-            group_size = group_threshold
-            all_items = list(content.items())
-            groups = [{str(k): v for k, v in all_items[i:i + group_size]} 
-                        for i in range(0, len(all_items), group_size)]
-            total_groups = len(groups)
-            total_llm_time = 0
-            total_tokens = 0
-            for group_index, group in enumerate(groups):
-                # 构造消息
-                logger.info(f"processing group {group_index+1}/{total_groups} ")
-                content = json.dumps(group)
-                message = [
-                    {'role': 'system', 'content': prompt},
-                    {'role': 'user', 'content': content}
-                ]
-                llm_chat_start_time = time.time()
-                success, completion = create_chat_completion(messages=message, model=MODEL,temperature=0.7)
-                llm_chat_end_time = time.time()
-                if not success:
-                    logger.error(f"error code: {completion['error_code']}, message: {completion['message']}")
-                    logger.error(f"faild app: {app_name} ,faild file: {json_file}")
-                    continue
-                llm_response_content = completion.choices[0].message.content
-                usage = completion.usage
-                logger.debug(f"response_content: {llm_response_content}")
-                logger.debug(f"finish reason: {completion.choices[0].finish_reason}")
-                logger.info(f"success app: {app_name} ,success file: {json_file}")
-                logger.info(f"used token: {usage.total_tokens} (input_tokens: {usage.prompt_tokens},output_tokens: {usage.completion_tokens})")
-                logger.info(f"used time: {llm_chat_end_time - llm_chat_start_time}s")
-                total_llm_time += llm_chat_end_time - llm_chat_start_time
-                total_tokens += usage.total_tokens
-                # 将内容保存到 json 文件, 作为下一阶段的输入
-                if not is_json_format(llm_response_content,logger):
-                    llm_response_content = get_json_content_from_llm_response(llm_response_content)
-                    logger.debug(f"LLM_response match json format:\n{llm_response_content}")
-                    # 防止llm输出不完整导致格式化匹配不到json情况
-                    if llm_response_content == "{}":
-                        logger.error(f"llm response incomplete, faild app: {app_name}, faild_file: {json_file}")
-                try:
-                    # 防止llm输出的json格式出错
-                    save2json(llm_response_content, os.path.join(result_path, f"{app_name}_{group_index}.json"))
-                except Exception as e:
-                    logger.error(f"{e}")
-                    logger.error(f"Json format error, faild app: {app_name}, faild_file: {json_file}")
-            # 等所有分组都处理完，再来将总的llm time和 tokens保存到文件
-            save_llm_phase_time(os.path.join(result_root_path, dataset, app_name, "firmproj_stats.json"), "llm_phase1_chat", total_llm_time)
-            save_llm_usage(os.path.join(result_root_path, dataset, app_name, "firmproj_stats.json"), "llm_phase1_usage", total_tokens)
-        
-        phase1_end_time = time.time()
-        save_llm_phase_time(os.path.join(result_root_path, dataset, app_name, "firmproj_stats.json"), "phase1", phase1_end_time - phase1_start_time)
 
-        time.sleep(random.randint(0, 10))
+        if request_index is not None:
+            input_keys.update(content)
+            content = reuse_format_results(request_index, content, result_path, app_name, output_names)
+        # 跨app去重: 其他app已经(或正在)处理的请求值不再送入LLM
+        dedup_claim = None
+        if request_dedup.dedup_store is not None and content:
+            dedup_claim = DedupClaim(request_dedup.dedup_store, "phase1", content)
+            content = dedup_claim.owned_items
+        groups = build_format_groups(app_name, content, prompt_tokens) if content else []
+        written = set()
+        total_groups = len(groups)
+        groups_start_time = time.time()
+        try:
+            total_llm_time, total_tokens, total_calls = yield from format_groups_flow(prompt, app_name, json_file, result_path, groups, written)
+        finally:
+            output_names.update(written)
+            if dedup_claim is not None:
+                dedup_claim.publish(collect_format_outputs(result_path, written, groups_start_time))
+        if dedup_claim is not None:
+            # 其他app处理失败的请求值由本app重新处理
+            retry_content = yield call_step(dedup_claim.wait, dedup_claim.await_wait)
+            if retry_content:
+                retry_groups = build_format_groups(f"{app_name}_retry", retry_content, prompt_tokens)
+                retry_time, retry_tokens, retry_calls = yield from format_groups_flow(prompt, app_name, json_file, result_path, retry_groups, output_names)
+                total_llm_time += retry_time
+                total_tokens += retry_tokens
+                total_calls += retry_calls
+                total_groups += len(retry_groups)
+            save_shared_format_results(dedup_claim, result_path, app_name, output_names)
+        logger.info(f"{json_file_name}: {json_pairs_num} items, {total_groups} groups, {total_calls} llm calls")
+        # 等所有分组都处理完，再将该文件的llm time和tokens累加到app的统计中, 整个app处理完后一次写入
+        app_stats.add_time("llm_phase1_chat", total_llm_time)
+        app_stats.add_usage("llm_phase1_usage", total_tokens)
+
+    if request_index is not None:
+        finish_incremental_format(request_index, result_path, output_names, input_keys)
+
+    phase1_end_time = time.time()
+    app_stats.set_time("phase1", phase1_end_time - phase1_start_time)
+
+# 三个阶段统一传参为 app package name
+@checkpoint_stage("phase1", list_format_inputs)
+@record_app_stats("phase1", result_root_path)
+@record_cache_stats("llm_phase1_cache", result_root_path)
+def format_url(app_name,dataset):
+    logger.info(f"========== llm phase1 | start process {app_name} ==========")
+    return run_flow(format_app_flow(app_name, dataset))
+
+@checkpoint_stage("phase1", list_format_inputs)
+@record_app_stats("phase1", result_root_path)
+@record_cache_stats("llm_phase1_cache", result_root_path)
+async def aformat_url(app_name,dataset):
+    # format_url 的异步版本, 同一个app的各个分组并发请求LLM
+    logger.info(f"========== llm phase1 (async) | start process {app_name} ==========")
+    return await arun_flow(format_app_flow(app_name, dataset))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="llm phase1: extract request info")
+    parser.add_argument("--mode", choices=["thread", "async"], default="thread",
+                        help="thread: one app per worker thread; async: all apps on one event loop")
+    parser.add_argument("--workers", type=int, default=6, help="number of worker threads (thread mode)")
+    parser.add_argument("--concurrency", type=int, default=100, help="max in-flight LLM requests (upper bound of the adaptive limit)")
+    parser.add_argument("--max-apps", type=int, default=50, help="max apps processed at the same time (async mode)")
+    parser.add_argument("--group-input-tokens", type=int, default=GROUP_INPUT_TOKENS,
+                        help="max input tokens (prompt included) of one llm call")
+    parser.add_argument("--group-output-tokens", type=int, default=GROUP_OUTPUT_TOKENS,
+                        help="max estimated output tokens of one llm call")
+    parser.add_argument("--group-workers", type=int, default=GROUP_WORKERS,
+                        help="threads of the llm work queue shared by all apps (thread mode)")
+    add_cache_args(parser, llm_cache_path)
+    add_rate_limit_args(parser, llm_requests_per_minute, llm_tokens_per_minute)
+    add_stats_args(parser)
+    add_manifest_args(parser, run_manifest_path)
+    add_incremental_args(parser)
+    add_dedup_args(parser, dedup_store_path)
+    return parser.parse_args()
+
+async def main_async(applist, dataset, concurrency, max_apps):
+    set_async_concurrency(concurrency)
+    try:
+        return await run_apps_async(aformat_url, applist, dataset, max_apps)
+    finally:
+        await aclose_clients()
 
 if __name__ == "__main__":
+    args = parse_args()
+    setup_response_cache(args)
+    setup_rate_limiter(args)
+    setup_metrics_store(args)
+    setup_run_manifest(args)
+    setup_incremental(args)
+    setup_dedup_store(args)
+    GROUP_INPUT_TOKENS = args.group_input_tokens
+    GROUP_OUTPUT_TOKENS = args.group_output_tokens
+    GROUP_WORKERS = args.group_workers
     applist = os.listdir(os.path.join(source_data_path,process_dataset))
     
     # llm incomplete 
@@ -241,33 +477,45 @@ if __name__ == "__main__":
     #            "com.big8bits.fetchcam.apk","com.tplink.skylight.apk",""]
     # 401 
     # applist = ["com.ezio.multiwii.apk","com.logi.brownie.apk"]
-    # 提交任务到线程池
-    with ThreadPoolExecutor(max_workers=6) as executor:
-        futures = {
-            executor.submit(format_url, app, process_dataset):app 
-            for app in applist
-        }
-        
-        completed = 0
-        total = len(applist)
-        errors = [] # 记录所有错误信息
-
-        for future in as_completed(futures):
-            app = futures[futures] # 获取当前任务对应的app
-            completed += 1
+    if args.mode == "async":
+        errors = asyncio.run(main_async(applist, process_dataset, args.concurrency, args.max_apps))
+    else:
+        # 提交任务到线程池
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            futures = {
+                executor.submit(format_url, app, process_dataset):app 
+                for app in applist
+            }
             
-            try:
-                result = future.result() # 获取任务结果, 可能会抛出异常
-            except Exception as e:
-                # 捕获异常并记录详细信息
-                error_message = f"Error processing {app}: {str(e)}"
-                errors.append(error_message)
-                print(error_message)
-                result = "error"
-            print(f"Progress: {completed}/{total} - {result}") # 输出进度和结果
-        
-        # 所有任务完成后，打印汇总的错误信息
-        if errors:
-            error_log_path = f"logs/llm_phase1/error_{process_dataset}.log"
-            save_errors(errors, error_log_path)    
-    
+            completed = 0
+            total = len(applist)
+            errors = [] # 记录所有错误信息
+
+            for future in as_completed(futures):
+                app = futures[future] # 获取当前任务对应的app
+                completed += 1
+                
+                try:
+                    result = future.result() # 获取任务结果, 可能会抛出异常
+                except Exception as e:
+                    # 捕获异常并记录详细信息
+                    error_message = f"Error processing {app}: {str(e)}"
+                    errors.append(error_message)
+                    print(error_message)
+                    result = "error"
+                print(f"Progress: {completed}/{total} - {result}") # 输出进度和结果
+
+        # LLM client 连接池复用情况
+        logger.info(f"llm client pool stats: {get_client_pool_stats()}")
+
+    # LLM 响应缓存命中情况
+    logger.info(f"llm response cache stats: {response_cache_stats()}")
+    # LLM 限速器的等待次数、429 次数及最终的并发上限
+    logger.info(f"llm rate limiter stats: {rate_limiter_stats()}")
+    # 跨app去重的去重率
+    logger.info(f"request dedup stats: {dedup_stats()}")
+
+    # 所有任务完成后，打印汇总的错误信息
+    if errors:
+        error_log_path = f"logs/llm_phase1/error_{process_dataset}.log"
+        save_errors(errors, error_log_path)
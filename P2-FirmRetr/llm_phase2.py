@@ -2,16 +2,32 @@ import os
 import re
 import time
 import json
-import random
-import time
+import asyncio
+import argparse
 from collections import Counter
 import numpy as np
 from concurrent.futures import ThreadPoolExecutor, as_completed
+from utils.deepseek_tokenizer import count_tokens_batch
 from utils.myllm_sdk import one_chat, one_completion, create_chat_completion
-from utils.myllm_sdk import get_prompt_content, model_redirect
+from utils.myllm_sdk import get_prompt_content, model_redirect, get_client_pool_stats
+from utils.myllm_sdk import acreate_chat_completion, set_async_concurrency, aclose_clients
+from utils.myllm_sdk import setup_response_cache, response_cache_stats, setup_rate_limiter, rate_limiter_stats
+from utils.rate_limiter import add_rate_limit_args
+from utils.llm_cache import record_cache_stats, add_cache_args
+from utils.work_queue import get_work_queue
+from utils.flow import call_step, gather_steps, run_flow, arun_flow
+from utils.run_manifest import checkpoint_stage, current_checkpoint, fingerprint_value, setup_run_manifest, add_manifest_args
+from utils import incremental_index
+from utils.incremental_index import IncrementalIndex, setup_incremental, add_incremental_args
+from utils import request_dedup
+from utils.request_dedup import DedupClaim, setup_dedup_store, add_dedup_args, dedup_stats
+from utils import near_dup
+from utils.near_dup import setup_near_dup, add_near_dup_args, near_dup_stats
+from utils.stopping_policy import ConsistencyEntropyPolicy, STOPPING_POLICIES, get_stopping_policy
 from utils.logger import Logger, ensure_log_directory, get_latest_log_number
-from utils.utils import save_llm_phase_time, save_llm_usage, save_errors
-from config import result_root_path, process_dataset
+from utils.app_stats import record_app_stats, current_app_stats, setup_metrics_store, add_stats_args
+from utils.utils import save_errors, run_apps_async
+from config import result_root_path, process_dataset, llm_cache_path, llm_requests_per_minute, llm_tokens_per_minute, run_manifest_path, dedup_store_path, near_dup_index_path
 
 log_dir = "logs/llm_phase2"
 ensure_log_directory(log_dir)
@@ -21,6 +37,8 @@ logger = Logger(name="phase2_logger", level="DEBUG",
                 log_file_level="DEBUG")
 
 MODEL = model_redirect("deepseek-v3")
+# 多轮投票的终止规则, 为 None 时使用 dynamic_multi_round_voting 参数对应的一致性+熵规则
+STOPPING_POLICY = None
 def get_json_content_from_file(json_path):
     # 从文件中读取json内容
     with open(json_path, 'r', encoding='utf-8') as f:
@@ -46,9 +64,148 @@ def entropy(probabilities):
     probabilities = probabilities[probabilities > 0]  # 避免log(0)
     return -np.sum(probabilities * np.log(probabilities))
 
-def dynamic_multi_round_voting(content, app_name, logger, initial_rounds=5, max_rounds=10, consistency_threshold=0.8, entropy_threshold=0.5,):
+def evaluate_votes(predictions):
+    """
+    评估一致性与熵值
+    返回 (预测分布, 最有可能的标签, 一致性分数, 熵值)
+    """
+    counter = Counter(predictions)
+    total_votes = sum(counter.values())
+    probabilities = [count / total_votes for count in counter.values()]
+    prediction_entropy = entropy(probabilities)
+    most_common_label, count = counter.most_common(1)[0]
+    consistency_score = count / total_votes
+    return counter, most_common_label, consistency_score, prediction_entropy
+
+def build_voting_result(most_common_label, consistency_score, prediction_entropy, counter, total_tokens, total_input_tokens, total_output_tokens, voting_time):
+    # 返回值: 最有可能的标签、一致性分数、熵值、总的预测分布、总token数量、投票过程总用时.
+    return {
+        "most_common_label":most_common_label,
+        "consistency_core": consistency_score,
+        "prediction_entry": prediction_entropy,
+        "counter": counter,
+        "total_usage": {
+            "total_tokens":total_tokens,
+            "total_input_tokens":total_input_tokens,
+            "total_output_tokens":total_output_tokens
+            },
+        "voting_time": voting_time
+    }
+
+# 投票请求使用的任务队列, 与处理app的线程池分开, 所有app共用
+VOTE_WORKERS = 32
+
+def get_vote_executor():
+    return get_work_queue("vote", VOTE_WORKERS)
+
+def next_vote_batch(state, min_rounds, max_rounds, extra_batch_size):
+    """
+    返回下一批并发请求的采样编号: 终止规则要求的最少票数一次性补齐, 之后每批 extra_batch_size 个, 不超过 max_rounds
+    """
+    collected = len(state["predictions"])
+    if collected < min_rounds:
+        batch_size = min_rounds - collected
+    else:
+        batch_size = min(extra_batch_size, max_rounds - collected)
+    samples = list(range(state["next_sample"], state["next_sample"] + batch_size))
+    state["next_sample"] += batch_size
+    return samples
+
+def consume_vote_batch(state, results, content, app_name, logger, policy):
+    """
+    按采样顺序逐个计入一批投票结果, 每计入一票都用 policy 判断是否终止, 与逐轮投票的结果相同
+    满足终止条件后, 同一批中剩余的投票不再计入 (token 仍计入消耗)
+    返回 "stop" / "error" / "continue"
+    """
+    for success, completion in results:
+        if success:
+            usage = completion.usage
+            state["total_tokens"] += usage.total_tokens
+            state["total_input_tokens"] += usage.prompt_tokens
+            state["total_output_tokens"] += usage.completion_tokens
+
+    for success, completion in results:
+        if not success:
+            logger.error(f"error code: {completion['error_code']}, message: {completion['message']}")
+            logger.error(f"faild app: {app_name} ,faild content: {content}")
+            # 如果一直LLM访问失败，可能会出现死循环，主要是网络原因
+            # 需要加一个次数判断，如果一直失败多少次，直接返回
+            state["total_llm_errors"] += 1
+            if state["total_llm_errors"] >= 10:
+                return "error"
+            continue
+
+        usage = completion.usage
+        if add_vote(state, completion.choices[0].message.content,
+                    (usage.total_tokens, usage.prompt_tokens, usage.completion_tokens), logger, policy):
+            return "stop"
+    return "continue"
+
+def add_vote(state, label, usage, logger, policy):
+    """
+    计入一票, usage 为 (total_tokens, input_tokens, output_tokens), 返回是否满足终止条件
+    """
+    predictions = state["predictions"]
+    predictions.append(label)
+    state["vote_tokens"].append(usage[0])
+    logger.info(f"predictions: {predictions}")
+    logger.info(f"used token: {usage[0]} (input_tokens: {usage[1]},output_tokens: {usage[2]})")
+    total_rounds = len(predictions)
+
+    if total_rounds >= policy.min_rounds:
+        # 评估一致性与熵值
+        counter, most_common_label, consistency_score, prediction_entropy = state["evaluation"] = evaluate_votes(predictions)
+
+        logger.info(f"轮次: {total_rounds}, 当前预测分布: {counter}, 一致性: {consistency_score:.2f}, 熵: {prediction_entropy:.4f}")
+
+        # 判断是否满足提前终止条件
+        if policy.should_stop(predictions):
+            logger.debug(f"符合终止条件,终止投票！")
+            return True
+
+    else:
+        logger.info(f"轮次: {total_rounds}, 当前预测: {label} (初始轮次阶段，继续收集...)")
+    return False
+
+def new_voting_state():
+    return {
+        "predictions": [],
+        # 每一票的token量, 与 predictions 一一对应, 用于离线模拟终止规则
+        "vote_tokens": [],
+        # 多轮投票总消耗的token量
+        "total_tokens": 0,
+        "total_input_tokens": 0,
+        "total_output_tokens": 0,
+        "total_llm_errors": 0,
+        # 下一个请求的采样编号, 同时作为缓存的 cache_sample
+        "next_sample": 0,
+        "evaluation": None,
+    }
+
+def finish_voting(state, app_name, logger, voting_time):
+    # 记录完整的投票序列, 供 utils.stopping_policy 离线回放
+    logger.info(f"vote sequence: {json.dumps({'app': app_name, 'votes': state['predictions'], 'tokens': state['vote_tokens']}, ensure_ascii=False)}")
+    counter, most_common_label, consistency_score, prediction_entropy = state["evaluation"]
+    return build_voting_result(most_common_label, consistency_score, prediction_entropy, counter,
+                               state["total_tokens"], state["total_input_tokens"], state["total_output_tokens"],
+                               voting_time)
+
+def get_voting_policy(initial_rounds, consistency_threshold, entropy_threshold):
+    if STOPPING_POLICY is not None:
+        return STOPPING_POLICY
+    return ConsistencyEntropyPolicy(initial_rounds, consistency_threshold, entropy_threshold)
+
+def vote_flow(messages, sample):
+    # 每一票使用不同的缓存项, 重跑时按采样编号复现
+    return (yield call_step(create_chat_completion, acreate_chat_completion,
+                            messages=messages, model=MODEL, temperature=1, cache_sample=sample))
+
+def multi_round_voting_flow(content, app_name, logger, initial_rounds=5, max_rounds=10, consistency_threshold=0.8, entropy_threshold=0.5, extra_batch_size=2):
     """
     动态多轮投票机制
+    先并发请求终止规则要求的最少票数(默认规则为 initial_rounds), 之后每次并发 extra_batch_size 票,
+    直到满足终止条件或达到 max_rounds; 计票顺序和终止条件与逐轮投票相同
+    终止规则由 STOPPING_POLICY 指定, 默认为一致性 >= consistency_threshold 且熵 <= entropy_threshold
 
     param: 
     - content 文本内容 
@@ -60,112 +217,356 @@ def dynamic_multi_round_voting(content, app_name, logger, initial_rounds=5, max_
     - total_token
     """
 
-    predictions = []
     prompt = get_prompt_content("prompt/classify_url_prompt.txt")
-    total_rounds = 0
-    # 多轮投票总消耗的token量
-    total_tokens = 0 
-    total_input_tokens = 0
-    total_output_tokens = 0
-
-    total_llm_errors = 0
-
     messages = [
             {"role": "system", "content": prompt},
             {"role": "user", "content": content}
     ]
+    state = new_voting_state()
+    policy = get_voting_policy(initial_rounds, consistency_threshold, entropy_threshold)
+
     voting_start_time = time.time()
-    while total_rounds < max_rounds:
+    while len(state["predictions"]) < max_rounds:
+        samples = next_vote_batch(state, policy.min_rounds, max_rounds, extra_batch_size)
+        results = yield gather_steps((vote_flow(messages, sample) for sample in samples), get_vote_executor())
+        status = consume_vote_batch(state, results, content, app_name, logger, policy)
+        if status == "error":
+            return None
+        if status == "stop":
+            break
 
-        success,completion = create_chat_completion(messages=messages,model=MODEL,temperature=1)
-        
+    voting_end_time = time.time()
+    return finish_voting(state, app_name, logger, voting_end_time - voting_start_time)
+
+def dynamic_multi_round_voting(content, app_name, logger, **kwargs):
+    # 同步执行多轮投票, 参数见 multi_round_voting_flow
+    return run_flow(multi_round_voting_flow(content, app_name, logger, **kwargs))
+
+# ---------------- 批量分类: 一次请求对多个 key-value 分类 ----------------
+CLASSIFY_LABELS = {"0", "1", "2", "3"}
+# 每批最多的条目数, <=1 表示逐条分类; 每批条目内容的 token 上限
+CLASSIFY_BATCH_SIZE = 1
+CLASSIFY_BATCH_TOKEN_BUDGET = 6000
+
+def pack_classify_batches(items, batch_size, token_budget):
+    """
+    按顺序把 [(key, value)] 装箱, 每批不超过 batch_size 条, 内容 token 数之和不超过 token_budget
+    单条超过预算的条目单独成批
+    """
+    token_counts = count_tokens_batch([json.dumps(value) for _, value in items])
+    batches = []
+    batch, batch_tokens = [], 0
+    for item, tokens in zip(items, token_counts):
+        if batch and (len(batch) >= batch_size or batch_tokens + tokens > token_budget):
+            batches.append(batch)
+            batch, batch_tokens = [], 0
+        batch.append(item)
+        batch_tokens += tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+def build_batch_classify_messages(prompt, batch_prompt, entries):
+    # entries 为 [(编号, value)], 用短编号代替原始 key, 减少输出 token, 也避免 key 中的特殊字符影响解析
+    content = json.dumps({index: value for index, value in entries})
+    return [
+            {"role": "system", "content": prompt + "\n\n" + batch_prompt},
+            {"role": "user", "content": content}
+    ]
+
+def parse_batch_labels(llm_response_content):
+    """
+    解析批量分类的输出 {编号: 类别}, 兼容 ```json 代码块和前后多余的文字
+    无法解析时返回 {}, 类别不合法的编号不会出现在返回值中
+    """
+    if not llm_response_content:
+        return {}
+    match = re.search(r"\{.*\}", llm_response_content, re.S)
+    if not match:
+        return {}
+    try:
+        label_map = json.loads(match.group(0))
+    except json.JSONDecodeError:
+        return {}
+    if not isinstance(label_map, dict):
+        return {}
+    labels = {}
+    for index, label in label_map.items():
+        label = str(label).strip().strip('"')
+        if label in CLASSIFY_LABELS:
+            labels[str(index).strip()] = label
+    return labels
+
+def split_usage(usage, count):
+    # 将一次请求的 token 平均分摊到 count 个条目, 余数计入第一个
+    shares = []
+    for index in range(count):
+        shares.append(tuple(value // count + (value % count if index == 0 else 0) for value in usage))
+    return shares
+
+def consume_batch_votes(states, pending, results, app_name, logger, policy):
+    """
+    按采样顺序计入一批批量投票结果, pending 为本轮请求中的 [(编号, key)]
+    返回 (终止的 key, 需要逐条重新分类的 key, 请求失败的次数)
+    某一票中缺失或类别不合法的条目不再参与批量投票, 改为逐条分类
+    """
+    finished, requeue, errors = [], [], 0
+    active = list(pending)
+    for success, completion in results:
         if not success:
             logger.error(f"error code: {completion['error_code']}, message: {completion['message']}")
-            logger.error(f"faild app: {app_name} ,faild content: {content}")
-            # 如果一直LLM访问失败，可能会出现死循环，主要是网络原因
-            # 需要加一个次数判断，如果一直失败多少次，直接返回
-            total_llm_errors += 1
-            if total_llm_errors >= 10:
-                return None
-            
+            logger.error(f"faild app: {app_name} ,faild batch: {[key for _, key in pending]}")
+            errors += 1
             continue
 
-        label = llm_response_content = completion.choices[0].message.content
         usage = completion.usage
-        total_tokens += usage.total_tokens
-        total_input_tokens += usage.prompt_tokens
-        total_output_tokens += usage.completion_tokens
-        predictions.append(label)
-        logger.info(f"predictions: {predictions}")
-        logger.info(f"used token: {usage.total_tokens} (input_tokens: {usage.prompt_tokens},output_tokens: {usage.completion_tokens})")
-        total_rounds += 1
-        time.sleep(1) # 避免速率限制
-
-        if total_rounds >= initial_rounds:
-            # 评估一致性与熵值
-            counter = Counter(predictions)
-            total_votes = sum(counter.values())
-            probabilities = [count / total_votes for count in counter.values()]
-            prediction_entropy = entropy(probabilities)
-            most_common_label, count = counter.most_common(1)[0]
-            consistency_score = count / total_votes
-
-            logger.info(f"轮次: {total_rounds}, 当前预测分布: {counter}, 一致性: {consistency_score:.2f}, 熵: {prediction_entropy:.4f}")
-
-            # 判断是否满足提前终止条件
-            if consistency_score >= consistency_threshold and prediction_entropy <= entropy_threshold:
-                logger.debug(f"符合终止条件,终止投票！")
-                break
-        
-        else:
-            logger.info(f"轮次: {total_rounds}, 当前预测: {label} (初始轮次阶段，继续收集...)")
-    
+        shares = dict(zip([key for _, key in pending],
+                          split_usage((usage.total_tokens, usage.prompt_tokens, usage.completion_tokens), len(pending))))
+        # 本次请求的 token 分摊到请求中的所有条目, 包括本批中已经终止的条目
+        for key, share in shares.items():
+            states[key]["total_tokens"] += share[0]
+            states[key]["total_input_tokens"] += share[1]
+            states[key]["total_output_tokens"] += share[2]
+
+        labels = parse_batch_labels(completion.choices[0].message.content)
+        for index, key in list(active):
+            label = labels.get(index)
+            if label is None:
+                logger.warning(f"batch label missing or malformed, key: {key}, requeue")
+                requeue.append(key)
+                active.remove((index, key))
+                continue
+            if add_vote(states[key], label, shares[key], logger, policy):
+                finished.append(key)
+                active.remove((index, key))
+    return finished, requeue, errors
+
+def next_batch_round(states, pending, policy, max_rounds, extra_batch_size, next_sample):
+    # pending 中的条目票数相同, 复用逐条投票的分批规则
+    collected = len(states[pending[0][1]]["predictions"])
+    if collected >= max_rounds:
+        return []
+    if collected < policy.min_rounds:
+        batch_size = policy.min_rounds - collected
+    else:
+        batch_size = min(extra_batch_size, max_rounds - collected)
+    return list(range(next_sample, next_sample + batch_size))
+
+def finish_batch_voting(states, batch, done, app_name, logger, voting_time):
+    # 批量投票的用时平均分摊到批内每个条目
+    voting_results = {}
+    for key, _ in batch:
+        if key in done and states[key]["evaluation"] is not None:
+            voting_results[key] = finish_voting(states[key], app_name, logger, voting_time / len(batch))
+    return voting_results
+
+def batch_multi_round_voting_flow(batch, app_name, logger, prompt, batch_prompt, initial_rounds=5, max_rounds=10, consistency_threshold=0.8, entropy_threshold=0.5, extra_batch_size=2):
+    """
+    对一批 [(key, value)] 同时进行多轮投票, 每一票是一次批量分类请求, 各条目按自己的票数独立判断是否终止
+    返回 (key -> 投票结果, 需要逐条重新分类的 [(key, value, 已消耗的token)])
+    """
+    policy = get_voting_policy(initial_rounds, consistency_threshold, entropy_threshold)
+    states = {key: new_voting_state() for key, _ in batch}
+    values = dict(batch)
+    pending = [(str(index), key) for index, (key, _) in enumerate(batch, start=1)]
+    done, requeue = set(), []
+    total_llm_errors = 0
+    next_sample = 0
+
+    voting_start_time = time.time()
+    while pending:
+        samples = next_batch_round(states, pending, policy, max_rounds, extra_batch_size, next_sample)
+        if not samples:
+            # 达到最大轮次, 使用最后一次的评估结果
+            done.update(key for _, key in pending)
+            break
+        next_sample += len(samples)
+        messages = build_batch_classify_messages(prompt, batch_prompt, [(index, values[key]) for index, key in pending])
+        results = yield gather_steps((vote_flow(messages, sample) for sample in samples), get_vote_executor())
+        finished, requeued, errors = consume_batch_votes(states, pending, results, app_name, logger, policy)
+        done.update(finished)
+        requeue.extend(requeued)
+        total_llm_errors += errors
+        if total_llm_errors >= 10:
+            # 与逐条投票一致, 连续失败时放弃这一批
+            break
+        pending = [(index, key) for index, key in pending if key not in done and key not in requeued]
+
     voting_end_time = time.time()
-    # 返回值: 最有可能的标签、一致性分数、熵值、总的预测分布、总token数量、投票过程总用时.
-    result = {
-        "most_common_label":most_common_label,
-        "consistency_core": consistency_score,
-        "prediction_entry": prediction_entropy,
-        "counter": counter,
-        "total_usage": {
-            "total_tokens":total_tokens,
-            "total_input_tokens":total_input_tokens,
-            "total_output_tokens":total_output_tokens
-            },
-        "voting_time": voting_end_time - voting_start_time
-    }
-    return result
+    voting_results = finish_batch_voting(states, batch, done, app_name, logger, voting_end_time - voting_start_time)
+    return voting_results, [(key, values[key], states[key]) for key in requeue]
 
-def classify_url(app_name, dataset):
-    # 完成LLM第二阶段子任务 - 对 URL 进行分类
-    # 0: 完整的网络请求
-    # 1,2,3: 不完整的网络请求
-    logger.info(f"========== llm phase2 | start process {app_name} ==========")
-    phase2_start_time = time.time()
-    # path_prefix = "/data/firmproj/result"
-    dir_path = os.path.join(result_root_path,dataset,app_name,'llm_phase1')
-    
-    # 设置输出目录
-    result_path = os.path.join(result_root_path,dataset,app_name,'llm_phase2')
-    if not os.path.exists(result_path):
-        # 创建文件夹
-        os.makedirs(result_path)
+def merge_requeue_usage(voting_result, state):
+    # 逐条重新分类的结果加上该条目在批量投票中已经分摊到的 token
+    if voting_result:
+        usage = voting_result["total_usage"]
+        usage["total_tokens"] += state["total_tokens"]
+        usage["total_input_tokens"] += state["total_input_tokens"]
+        usage["total_output_tokens"] += state["total_output_tokens"]
+    return voting_result
 
-    # 获取需要处理的json文件
+def resume_voting_results(items):
+    """
+    断点续跑: 返回 (上次已完成的 {key: 投票结果}, 仍需投票的 [(key, value)])
+    """
+    checkpoint = current_checkpoint()
+    voting_results = {}
+    for key, value in items:
+        stored = checkpoint.completed_item(key, fingerprint_value(value))
+        if stored is not None:
+            voting_results[key] = stored
+    if voting_results:
+        logger.info(f"resume: {len(voting_results)}/{len(items)} items already classified")
+    return voting_results, [(key, value) for key, value in items if key not in voting_results]
+
+def record_voting_result(key, value, voting_result):
+    # 每个条目投票结束后立即写入运行清单, 中途退出的app续跑时不必从头投票
+    if voting_result:
+        current_checkpoint().mark_item(key, fingerprint_value(value), voting_result)
+    else:
+        current_checkpoint().mark_item(key, fingerprint_value(value), status="failed")
+    return voting_result
+
+def record_batch_results(batch, batch_results, batch_requeue):
+    # 批量投票得到结果的条目记为完成, 既没有结果也不需要逐条重新分类的条目记为失败
+    requeued = {key for key, _, _ in batch_requeue}
+    for key, value in batch:
+        if key not in requeued:
+            record_voting_result(key, value, batch_results.get(key))
+
+def vote_item_flow(key, value, app_name, state=None):
+    # 逐条投票并立即记录结果, state 为该条目在批量投票中已经分摊到的 token
+    voting_result = yield from multi_round_voting_flow(json.dumps(value), app_name, logger)
+    if state is not None:
+        voting_result = merge_requeue_usage(voting_result, state)
+    return record_voting_result(key, value, voting_result)
+
+def vote_batch_flow(batch, app_name, prompt, batch_prompt):
+    batch_results, batch_requeue = yield from batch_multi_round_voting_flow(batch, app_name, logger, prompt, batch_prompt)
+    record_batch_results(batch, batch_results, batch_requeue)
+    return batch_results, batch_requeue
+
+def classify_items_flow(items, app_name):
+    """
+    对 [(key, value)] 进行多轮投票分类, 返回与 items 一一对应的投票结果(失败为 None)
+    同步时逐条(逐批)投票, 异步时并发
+    CLASSIFY_BATCH_SIZE > 1 时批量分类, 批量结果缺失的条目逐条重新分类
+    开启运行清单时, 每个条目完成后立即记录, 续跑时跳过已完成的条目
+    """
+    voting_results, pending_items = resume_voting_results(items)
+    if CLASSIFY_BATCH_SIZE <= 1:
+        single_results = yield gather_steps(vote_item_flow(key, value, app_name) for key, value in pending_items)
+        voting_results.update(zip([key for key, _ in pending_items], single_results))
+        return [voting_results.get(key) for key, _ in items]
+
+    prompt = get_prompt_content("prompt/classify_url_prompt.txt")
+    batch_prompt = get_prompt_content("prompt/classify_url_batch_prompt.txt")
+    batches = pack_classify_batches(pending_items, CLASSIFY_BATCH_SIZE, CLASSIFY_BATCH_TOKEN_BUDGET)
+    requeue = [(batch[0][0], batch[0][1], new_voting_state()) for batch in batches if len(batch) == 1]
+    batch_outputs = yield gather_steps(vote_batch_flow(batch, app_name, prompt, batch_prompt)
+                                       for batch in batches if len(batch) > 1)
+    for batch_results, batch_requeue in batch_outputs:
+        voting_results.update(batch_results)
+        requeue.extend(batch_requeue)
+    single_results = yield gather_steps(vote_item_flow(key, value, app_name, state) for key, value, state in requeue)
+    for (key, _, _), voting_result in zip(requeue, single_results):
+        voting_results[key] = voting_result
+    logger.info(f"batch classify: {len(pending_items)} items, {len(requeue)} classified one by one")
+    return [voting_results.get(key) for key, _ in items]
+
+def shared_voting_result(voting_result):
+    # 复用其他app(或本app中相同请求值)的投票结果, token 和用时只在第一次投票时计入
+    return build_voting_result(voting_result["most_common_label"], voting_result["consistency_core"],
+                               voting_result["prediction_entry"], Counter(voting_result["counter"]), 0, 0, 0, 0)
+
+def log_shared_results(dedup_claim):
+    if dedup_claim.shared:
+        logger.info(f"dedup: {len(dedup_claim.shared)}/{len(dedup_claim.items)} requests share phase2 labels with other apps")
+
+def reuse_near_duplicates(items):
+    """
+    在近似重复索引中查找 items, 返回 (复用的 {key: 投票结果}, 仍需投票的 items, 抽检的 {key: 复用的标签})
+    抽检的条目照常投票, 投票后与复用的标签比较, 最终使用投票的标签
+    """
+    reused, pending, audits = {}, [], {}
+    for key, value in items:
+        voting_result, similarity = near_dup.near_dup_index.lookup(value)
+        if voting_result is None:
+            pending.append((key, value))
+        elif near_dup.near_dup_index.should_audit(value):
+            audits[key] = voting_result["most_common_label"]
+            pending.append((key, value))
+        else:
+            logger.debug(f"near duplicate: key {key} reuses label {voting_result['most_common_label']} (similarity {similarity:.2f})")
+            reused[key] = shared_voting_result(voting_result)
+    if reused or audits:
+        logger.info(f"near dup: {len(reused)}/{len(items)} requests reuse phase2 labels, {len(audits)} audited")
+    return reused, pending, audits
+
+def index_near_duplicates(items, voting_results, audits):
+    # 投票得到的标签加入近似重复索引, 并记录抽检结果
+    for key, value in items:
+        voting_result = voting_results.get(key)
+        if not voting_result:
+            continue
+        if key in audits:
+            near_dup.near_dup_index.record_audit(audits[key], voting_result["most_common_label"])
+            if audits[key] != voting_result["most_common_label"]:
+                logger.info(f"near dup audit: key {key} voted {voting_result['most_common_label']}, reused label was {audits[key]}")
+        near_dup.near_dup_index.add(value, voting_result)
+
+def classify_pending_items_flow(items, app_name):
+    """
+    对 [(key, value)] 投票分类, 返回 {key: 投票结果}
+    开启近似重复复用时, 与已投票请求足够相似的条目直接复用其标签, 其余条目再经过跨app去重后投票
+    """
+    if near_dup.near_dup_index is None or not items:
+        return (yield from classify_unique_items_flow(items, app_name))
+    reused, pending_items, audits = reuse_near_duplicates(items)
+    voting_results = yield from classify_unique_items_flow(pending_items, app_name)
+    index_near_duplicates(pending_items, voting_results, audits)
+    voting_results.update(reused)
+    return voting_results
+
+def classify_unique_items_flow(items, app_name):
+    """
+    对 [(key, value)] 投票分类, 返回 {key: 投票结果}
+    开启跨app去重时, 相同的请求值在所有app中只投票一次
+    """
+    if request_dedup.dedup_store is None or not items:
+        return dict(zip([key for key, _ in items], (yield from classify_items_flow(items, app_name))))
+    dedup_claim = DedupClaim(request_dedup.dedup_store, "phase2", dict(items))
+    owned_items = list(dedup_claim.owned_items.items())
+    try:
+        voting_results = dict(zip([key for key, _ in owned_items], (yield from classify_items_flow(owned_items, app_name))))
+    except BaseException:
+        dedup_claim.release()
+        raise
+    dedup_claim.publish(voting_results)
+    # 其他app投票失败的请求值由本app重新投票
+    retry_items = list((yield call_step(dedup_claim.wait, dedup_claim.await_wait)).items())
+    voting_results.update(zip([key for key, _ in retry_items], (yield from classify_items_flow(retry_items, app_name))))
+    for key, voting_result in dedup_claim.shared.items():
+        voting_results[key] = shared_voting_result(voting_result)
+    log_shared_results(dedup_claim)
+    return voting_results
+
+def list_classify_inputs(app_name, dataset):
+    # 获取需要处理的 llm_phase1 输出文件
+    dir_path = os.path.join(result_root_path,dataset,app_name,'llm_phase1')
     need_process_json = []
     for file in os.listdir(dir_path):
         if file.endswith(".json"):
             need_process_json.append(os.path.join(dir_path, file))
     logger.debug(need_process_json)
-    
-    # 如果需要处理的json文件为空
-    if not need_process_json:
-        logger.info(f"No json file found, skip")
-        # phase2_end_time = time.time()
-        # save_llm_phase_time(os.path.join(result_root_path, dataset, app_name, "firmproj_stats.json"), "phase2", phase2_end_time - phase2_start_time)
-        return
+    return need_process_json
 
-    prompt = get_prompt_content("prompt/classify_url_prompt.txt")
+def load_classify_inputs(app_name, dataset):
+    """
+    读取 llm_phase1 的全部输出, 返回 (需要处理的json文件, 合并后的内容)
+    """
+    # 获取需要处理的json文件
+    need_process_json = list_classify_inputs(app_name, dataset)
 
     # 将所有的json文件内容都读取出来，避免结果出现多个文件的情况
     file_content = {}
@@ -180,26 +581,91 @@ def classify_url(app_name, dataset):
         # if not file_content:
         #     logger.info(f"Json file {json_file_name} is empty, skip")
         #     continue
-        
-    result_0 = {}
-    result_1 = {}
-    result_2 = {}
-    result_3 = {}
+    return need_process_json, file_content
+
+def record_classify_label(results, key, value, llm_response_content):
+    # 按LLM给出的类别保存 key-value, results 为 {类别: {key: value}}
+    if llm_response_content == "1":
+        results["1"][key] = value
+        logger.info(f'key:{key} 网络请求不完整，类别：1')
+    elif llm_response_content == "2":
+        results["2"][key] = value
+        logger.info(f'key:{key} 网络请求不完整，类别：2')
+    elif llm_response_content == "3":
+        results["3"][key] = value
+        logger.info(f'key:{key} 网络请求不完整，类别：3')
+    elif llm_response_content == "0":
+        results["0"][key] = value
+        logger.info(f"key:{key} 网络请求完整！类别：0")
+    else:
+        logger.warning(f"LLM 输出不规范!!!!!!!")
+
+def reuse_classify_labels(request_index, items):
+    """
+    增量模式: 格式化结果与上次相同的请求直接复用上次的分类标签, 返回 {key: 投票结果}
+    """
+    reused = {}
+    for key, value in items:
+        label = request_index.get(key, "phase2")
+        if label is not None and request_index.get(key, "phase1") == value:
+            reused[key] = build_voting_result(label, 1.0, 0.0, Counter(), 0, 0, 0, 0)
+    logger.info(f"incremental: {len(reused)}/{len(items)} requests unchanged, reuse phase2 labels")
+    return reused
+
+def record_classify_labels(request_index, items, voting_results):
+    # 增量模式: 把本次新分类的标签按请求指纹记录到索引中
+    for (key, value), voting_result in zip(items, voting_results):
+        if voting_result and request_index.get(key, "phase1") == value:
+            request_index.set(key, "phase2", voting_result["most_common_label"])
+    request_index.save()
+
+def save_classify_results(results, result_path, app_name):
+    save2json(results["0"], os.path.join(result_path, f"complete_0_{app_name}.json"))
+    save2json(results["1"], os.path.join(result_path, f"incomplete_1_{app_name}.json"))
+    save2json(results["2"], os.path.join(result_path, f"incomplete_2_{app_name}.json"))
+    save2json(results["3"], os.path.join(result_path, f"incomplete_3_{app_name}.json"))
+
+def classify_app_flow(app_name, dataset):
+    # 完成LLM第二阶段子任务 - 对 URL 进行分类
+    # 0: 完整的网络请求
+    # 1,2,3: 不完整的网络请求
+    phase2_start_time = time.time()
+    
+    # 设置输出目录
+    result_path = os.path.join(result_root_path,dataset,app_name,'llm_phase2')
+    if not os.path.exists(result_path):
+        # 创建文件夹
+        os.makedirs(result_path)
+
+    need_process_json, file_content = load_classify_inputs(app_name, dataset)
+    
+    # 如果需要处理的json文件为空
+    if not need_process_json:
+        logger.info(f"No json file found, skip")
+        # phase2_end_time = time.time()
+        # save_llm_phase_time(os.path.join(result_root_path, dataset, app_name, "firmproj_stats.json"), "phase2", phase2_end_time - phase2_start_time)
+        return
+
+    results = {"0": {}, "1": {}, "2": {}, "3": {}}
+
+    # 如果一个json文件内全是0,那么会得到一个逻辑空的json文件，需要在下一步处理时提前检查注意
+    items = [(key, value) for key, value in file_content.items() if value != "0"]
+    # 增量模式下未变化的请求复用上次的标签, 只对新增或变化的请求投票
+    request_index = IncrementalIndex.for_app(result_root_path, dataset, app_name) if incremental_index.incremental else None
+    reused_results = reuse_classify_labels(request_index, items) if request_index is not None else {}
+    pending_items = [(key, value) for key, value in items if key not in reused_results]
+    # 多轮投票(逐条或批量), 加上了异常处理，如果返回的是None的话，表示在LLM访问时出现了错误，直接跳过该key-value队，并输出日志记录error情况。
+    pending_results = yield from classify_pending_items_flow(pending_items, app_name)
+    if request_index is not None:
+        record_classify_labels(request_index, pending_items, [pending_results.get(key) for key, _ in pending_items])
+    voting_results = [reused_results.get(key) or pending_results.get(key) for key, _ in items]
 
     # 该APP使用的总token量
     total_usage = 0
     total_time = 0
-    total_items = len(file_content)
-    for index, (key, value) in enumerate(file_content.items(),start=1):
+    total_items = len(items)
+    for index, ((key, value), voting_result) in enumerate(zip(items, voting_results),start=1):
         logger.debug(f" {index}/{total_items} | Processing key: {key} value: {value}")
-        if value == "0":
-            # 如果一个json文件内全是0,那么会得到一个逻辑空的json文件，需要在下一步处理时提前检查注意
-            continue
-        
-        content = json.dumps(value)
-
-        # 多轮投票, 加上了异常处理，如果返回的是None的话，表示在LLM访问时出现了错误，直接跳过该key-value队，并输出日志记录error情况。
-        voting_result = dynamic_multi_round_voting(content,app_name,logger)
         if not voting_result:
             logger.error(f"faild app: {app_name}, faild key: {key}")
             continue
@@ -222,74 +688,120 @@ def classify_url(app_name, dataset):
         # usage = completion.usage
         # logger.debug(f"response_content: {llm_response_content}")
         # logger.debug(f"finish reason: {completion.choices[0].finish_reason}")
-        logger.info(f"success app: {app_name} ,success file: {file_path}")
+        logger.info(f"success app: {app_name} ,success key: {key}")
         logger.info(f"used token: {usage['total_tokens']} (input_tokens: {usage['total_input_tokens']},output_tokens: {usage['total_output_tokens']})")
         logger.info(f"used time: {voting_time}s")
         total_usage += usage['total_tokens']
         total_time += voting_time        
-        if llm_response_content == "1":
-            result_1[key] = value
-            logger.info(f'key:{key} 网络请求不完整，类别：1')
-            continue
-        elif llm_response_content == "2":
-            result_2[key] = value
-            logger.info(f'key:{key} 网络请求不完整，类别：2')
-            continue
-        elif llm_response_content == "3":
-            result_3[key] = value
-            logger.info(f'key:{key} 网络请求不完整，类别：3')
-            continue
-        elif llm_response_content == "0":
-            result_0[key] = value
-            logger.info(f"key:{key} 网络请求完整！类别：0")
-            continue
-        else:
-            logger.warning(f"LLM 输出不规范!!!!!!!")
+        record_classify_label(results, key, value, llm_response_content)
     
-    save2json(result_0, os.path.join(result_path, f"complete_0_{app_name}.json"))
-    save2json(result_1, os.path.join(result_path, f"incomplete_1_{app_name}.json"))
-    save2json(result_2, os.path.join(result_path, f"incomplete_2_{app_name}.json"))
-    save2json(result_3, os.path.join(result_path, f"incomplete_3_{app_name}.json"))
+    save_classify_results(results, result_path, app_name)
 
-    save_llm_phase_time(os.path.join(result_root_path, dataset, app_name, "firmproj_stats.json"), "llm_phase2_chat", total_time)
-    save_llm_usage(os.path.join(result_root_path, dataset, app_name, "firmproj_stats.json"), "llm_phase2_usage", total_usage)
+    app_stats = current_app_stats()
+    app_stats.add_time("llm_phase2_chat", total_time)
+    app_stats.add_usage("llm_phase2_usage", total_usage)
 
     phase2_end_time = time.time()
-    save_llm_phase_time(os.path.join(result_root_path, dataset, app_name, "firmproj_stats.json"), "phase2", phase2_end_time - phase2_start_time)
+    app_stats.set_time("phase2", phase2_end_time - phase2_start_time)
+
+@checkpoint_stage("phase2", list_classify_inputs)
+@record_app_stats("phase2", result_root_path)
+@record_cache_stats("llm_phase2_cache", result_root_path)
+def classify_url(app_name, dataset):
+    logger.info(f"========== llm phase2 | start process {app_name} ==========")
+    return run_flow(classify_app_flow(app_name, dataset))
 
-    time.sleep(random.randint(0, 10))
+@checkpoint_stage("phase2", list_classify_inputs)
+@record_app_stats("phase2", result_root_path)
+@record_cache_stats("llm_phase2_cache", result_root_path)
+async def aclassify_url(app_name, dataset):
+    # classify_url 的异步版本, 同一个app的所有 key-value 并发投票
+    logger.info(f"========== llm phase2 (async) | start process {app_name} ==========")
+    return await arun_flow(classify_app_flow(app_name, dataset))
 
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="llm phase2: classify requests")
+    parser.add_argument("--mode", choices=["thread", "async"], default="thread",
+                        help="thread: one app per worker thread; async: all apps on one event loop")
+    parser.add_argument("--workers", type=int, default=6, help="number of worker threads (thread mode)")
+    parser.add_argument("--concurrency", type=int, default=100, help="max in-flight LLM requests (upper bound of the adaptive limit)")
+    parser.add_argument("--max-apps", type=int, default=50, help="max apps processed at the same time (async mode)")
+    parser.add_argument("--stopping-policy", choices=list(STOPPING_POLICIES), default="consistency",
+                        help="early stopping rule of the multi-round voting")
+    parser.add_argument("--batch-size", type=int, default=CLASSIFY_BATCH_SIZE,
+                        help="max key-value items classified in one LLM call, 1 = one item per call")
+    parser.add_argument("--batch-token-budget", type=int, default=CLASSIFY_BATCH_TOKEN_BUDGET,
+                        help="max tokens of the items packed into one batched call")
+    add_cache_args(parser, llm_cache_path)
+    add_rate_limit_args(parser, llm_requests_per_minute, llm_tokens_per_minute)
+    add_stats_args(parser)
+    add_manifest_args(parser, run_manifest_path)
+    add_incremental_args(parser)
+    add_dedup_args(parser, dedup_store_path)
+    add_near_dup_args(parser, near_dup_index_path)
+    return parser.parse_args()
 
+async def main_async(applist, dataset, concurrency, max_apps):
+    set_async_concurrency(concurrency)
+    try:
+        return await run_apps_async(aclassify_url, applist, dataset, max_apps)
+    finally:
+        await aclose_clients()
 
 if __name__ == "__main__":
+    args = parse_args()
+    setup_response_cache(args)
+    setup_rate_limiter(args)
+    setup_metrics_store(args)
+    setup_run_manifest(args)
+    setup_incremental(args)
+    setup_dedup_store(args)
+    setup_near_dup(args)
+    STOPPING_POLICY = get_stopping_policy(args.stopping_policy)
+    CLASSIFY_BATCH_SIZE = args.batch_size
+    CLASSIFY_BATCH_TOKEN_BUDGET = args.batch_token_budget
     # applist = os.listdir("/data/firmproj/result/IoT-VER-Androzoo")
     applist = os.listdir(os.path.join(result_root_path, process_dataset))
-    with ThreadPoolExecutor(max_workers=6) as executor:
-        futures = {
-            executor.submit(classify_url, app, process_dataset):app 
-            for app in applist
-            }
-        
-        completed = 0
-        total = len(applist)
-        errors = []
-
-        for future in as_completed(futures):
-            app = futures[future]  # 获取当前任务对应的 app
-            completed += 1
-            try:
-                result = future.result()
-            except Exception as e:
-                # 捕获异常并记录详细信息
-                error_message = f"Error processing {app}: {str(e)}"
-                errors.append(error_message)
-                print(error_message)
-                result = "error"
-            print(f"Progress: {completed}/{total} ")
+    if args.mode == "async":
+        errors = asyncio.run(main_async(applist, process_dataset, args.concurrency, args.max_apps))
+    else:
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            futures = {
+                executor.submit(classify_url, app, process_dataset):app 
+                for app in applist
+                }
+            
+            completed = 0
+            total = len(applist)
+            errors = []
+
+            for future in as_completed(futures):
+                app = futures[future]  # 获取当前任务对应的 app
+                completed += 1
+                try:
+                    result = future.result()
+                except Exception as e:
+                    # 捕获异常并记录详细信息
+                    error_message = f"Error processing {app}: {str(e)}"
+                    errors.append(error_message)
+                    print(error_message)
+                    result = "error"
+                print(f"Progress: {completed}/{total} ")
+
+        # LLM client 连接池复用情况
+        logger.info(f"llm client pool stats: {get_client_pool_stats()}")
+
+    # LLM 响应缓存命中情况
+    logger.info(f"llm response cache stats: {response_cache_stats()}")
+    # LLM 限速器的等待次数、429 次数及最终的并发上限
+    logger.info(f"llm rate limiter stats: {rate_limiter_stats()}")
+    # 跨app去重的去重率
+    logger.info(f"request dedup stats: {dedup_stats()}")
+    # 近似重复复用的命中次数和抽检一致率
+    logger.info(f"near dup stats: {near_dup_stats()}")
 
     # 所有任务完成后，打印汇总的错误信息
-        if errors:
-            error_log_path = f"logs/llm_preprocess/error_{process_dataset}.log"
-            save_errors(errors, error_log_path)
-    
\ No newline at end of file
+    if errors:
+        error_log_path = f"logs/llm_preprocess/error_{process_dataset}.log"
+        save_errors(errors, error_log_path)
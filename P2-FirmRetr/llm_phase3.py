@@ -1,16 +1,34 @@
 import os
 import re
 import time
-import random
 import json
 import ast
+import asyncio
+import argparse
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from utils.myllm_sdk import create_chat_completion, dp_official_create_chat_completion
-from utils.myllm_sdk import get_prompt_content,model_redirect
-from utils.utils import get_json_content_from_file, save_llm_phase_time, save_llm_usage, save_errors
+from utils.myllm_sdk import get_prompt_content,model_redirect, get_client_pool_stats
+from utils.myllm_sdk import acreate_chat_completion, adp_official_create_chat_completion, set_async_concurrency, aclose_clients
+from utils.myllm_sdk import setup_response_cache, response_cache_stats, setup_rate_limiter, rate_limiter_stats
+from utils.rate_limiter import add_rate_limit_args
+from utils.llm_cache import record_cache_stats, add_cache_args
+from utils.run_manifest import checkpoint_stage, current_checkpoint, fingerprint_value, setup_run_manifest, add_manifest_args
+from utils.app_stats import record_app_stats, current_app_stats, setup_metrics_store, add_stats_args
+from utils import url_dedup
+from utils.url_dedup import setup_url_dedup, add_url_dedup_args, url_dedup_stats
+from utils.link_extractor import link_extractor, setup_link_extractor, add_link_extractor_args, link_extractor_stats
+from utils.response_compactor import response_compactor, setup_response_compactor, add_compactor_args, response_compactor_stats
+from utils.deepseek_tokenizer import count_tokens_batch
+from utils import http_engine
+from utils.http_engine import setup_http_engine, add_http_engine_args, http_engine_stats
+from utils import firmware_downloader
+from utils.firmware_downloader import setup_firmware_downloader, add_downloader_args, firmware_downloader_stats
+from utils.work_queue import get_work_queue
+from utils.flow import call_step, gather_steps, run_flow, arun_flow
+from utils.utils import get_json_content_from_file, save_errors, run_apps_async
 from multi_request import Request_multi
 from utils.logger import Logger, ensure_log_directory, get_latest_log_number
-from config import source_data_path, result_root_path, process_dataset
+from config import source_data_path, result_root_path, process_dataset, llm_cache_path, llm_requests_per_minute, llm_tokens_per_minute, run_manifest_path, download_history_path, firmware_store_path
 
 log_dir = "logs/llm_phase3"
 ensure_log_directory(log_dir)
@@ -21,8 +39,6 @@ logger = Logger(name="phase3_logger", level="DEBUG",
 
 MODEL = model_redirect("deepseek-v3")
 
-visited = []
-
 # 定义外部调用函数库 
 request_multi = Request_multi(logger)
 available_function = {
@@ -102,22 +118,78 @@ def get_list_from_llm_response(response):
         # 提取不到，则直接返回空字典
         return "[]"
 
+# 同一次函数调用的各个响应并发提取链接并下载, 所有app共用的任务队列
+DOWNLOAD_WORKERS = 16
+
+def get_download_executor():
+    return get_work_queue("download", DOWNLOAD_WORKERS)
+
+def call_function(function_name, function_args):
+    # 开启 HTTP 引擎时, make_request_name 的所有候选URL由引擎并发请求
+    if function_name == "make_request_name" and http_engine.http_engine is not None:
+        return http_engine.http_engine.make_request(**function_args)
+    return available_function[function_name](**function_args)
+
+async def acall_function(function_name, function_args):
+    # call_function 的异步版本
+    if function_name == "make_request_name" and http_engine.http_engine is not None:
+        return await http_engine.http_engine.amake_request(**function_args)
+    # 网络请求仍然是同步实现, 放到线程中执行
+    return await asyncio.to_thread(available_function[function_name], **function_args)
+
+def count_failed(results):
+    # startDownload 的结果中下载失败的数量, 提取链接的LLM调用失败(None)记为一次
+    if results is None:
+        return 1
+    return sum(1 for item in results if isinstance(item, dict) and item.get("error"))
+
+def download_responses_flow(function_response, urls, app_name, dataset):
+    """
+    并发处理一次函数调用的所有响应: 提取下载链接并下载, 再对下载结果做第二层提取
+    返回 (第一层提取使用的token数量, 下载失败的数量)
+    """
+    executor = get_download_executor()
+    download_results = yield gather_steps((start_download_flow(res, request_multi, urls[index] if index < len(urls) else "",
+                                                               app_name=app_name, dataset=dataset)
+                                           for index, res in enumerate(function_response)), executor)
+    download_tokens = 0
+    failed = 0
+    deeper_flows = []
+    for results, download_usage in download_results:
+        download_tokens += download_usage
+        failed += count_failed(results)
+        if not results:
+            logger.debug(f"startDownload function return []")
+            continue
+        # 下边这个感觉不是很必要
+        deeper_flows.extend(start_download_flow(result, request_multi, "", app_name=app_name, dataset=dataset)
+                            for result in results)
+    for results_2, _ in (yield gather_steps(deeper_flows, executor)):
+        logger.debug(f"file download result: {results_2}")
+        failed += count_failed(results_2)
+    return download_tokens, failed
+
 def get_function_call(message):
     # 获取函数调用的 function name 和 params
     
     pass
 
 
-def download_complete_file(app_name,dataset):
-    # 下载complete类型的固件
-    # 对complete.json文件进行处理的时候，需要提前检查是否是逻辑空的json文件，如果是，则跳过该文件
-    logger.info(f"========== llm phase3 | start process {app_name} ==========")
-    phase3_start_time = time.time()
+def list_complete_inputs(app_name, dataset):
+    # 获取需要处理的 llm_phase2 complete 类型输出文件
+    dir_path = os.path.join(result_root_path,dataset,app_name,'llm_phase2')
+    return [os.path.join(dir_path, file) for file in os.listdir(dir_path) if file.startswith('complete')]
+
+def load_complete_items(app_name, dataset):
+    """
+    读取 llm_phase2 中 complete 类型的请求
+    返回 (输入文件路径, json内容), 没有需要处理的内容时返回 (None, None)
+    """
     # path_prefix = "/data/firmproj/result"
     dir_path = os.path.join(result_root_path,dataset,app_name,'llm_phase2')
     if not os.path.exists(dir_path):
         logger.info(f"{app_name} llm_phase2 not exists. skip")
-        return
+        return None, None
     result_path = os.path.join(result_root_path,dataset,app_name,'llm_phase3')
     # logger.debug(result_path)
     if not os.path.exists(result_path):
@@ -129,127 +201,172 @@ def download_complete_file(app_name,dataset):
         logger.info(f"No json file found, skip")
         # phase3_end_time = time.time()
         # save_llm_phase_time(os.path.join(result_root_path, dataset, app_name, "firmproj_stats.json"), "phase3", phase3_end_time - phase3_start_time)
-        return
+        return None, None
     
     input_file = [file for file in os.listdir(dir_path) if file.startswith('complete')][0]
     input_file_path = os.path.join(dir_path,input_file)
 
-    
-
-    function_call_prompt = get_prompt_content("prompt/2_prompt_functioncall.txt")
-
     # 读取json内容
     json_content = get_json_content_from_file(input_file_path)
     logger.debug(f"file_content: \n{json_content}")
     if not json_content:
         logger.info(f"json_content is empty")
+        return None, None
+    return input_file_path, json_content
+
+def build_function_call_message(function_call_prompt, value):
+    query_content = json.dumps(value)
+    return [
+        {'role': 'system', 'content': function_call_prompt},
+        {'role': 'user', 'content': query_content}
+    ]
+
+def parse_function_call(completion, llm_time, app_name, dataset, input_file_path):
+    """
+    记录函数调用的LLM结果, 返回 (函数名, 函数参数, 使用的token数量)
+    """
+    llm_response_content = completion.choices[0].message
+    usage = completion.usage
+    logger.debug(f"response_message: {llm_response_content}")
+    logger.debug(f"finish reason: {completion.choices[0].finish_reason}")
+    logger.info(f"success app: {app_name} ,success file: {input_file_path}")
+    logger.info(f"used token: {usage.total_tokens} (input_tokens: {usage.prompt_tokens},output_tokens: {usage.completion_tokens})")
+    logger.info(f"used time: {llm_time}s")
+
+    # 获取返回的需要调用的函数名及其参数
+    function_name = completion.choices[0].message.tool_calls[0].function.name
+    logger.debug(f"LLM decided to call function: {function_name}")
+    function_args = json.loads(completion.choices[0].message.tool_calls[0].function.arguments)
+    function_args.update({"app_name":app_name,"dataset":dataset})
+    logger.debug(f"LLM decided to call function arguments: {function_args}")
+    return function_name, function_args, usage.total_tokens
+
+def save_phase3_stats(app_name, dataset, total_function_call_time, total_function_call_tokens, total_download_time, total_download_tokens, phase3_start_time):
+    # 累加LLM chat时间和usage, 由 record_app_stats 在该app处理完后一次写入
+    app_stats = current_app_stats()
+    app_stats.add_time("llm_phase3_chat1", total_function_call_time)
+    app_stats.add_usage("llm_phase3_usage1", total_function_call_tokens)
+    app_stats.add_time("llm_phase3_chat2", total_download_time)
+    app_stats.add_usage("llm_phase3_usage2", total_download_tokens)
+    phase3_end_time = time.time()
+    app_stats.set_time("phase3", phase3_end_time - phase3_start_time)
+
+def complete_item_flow(index, total_items, key, value, function_call_prompt, app_name, dataset, input_file_path):
+    """
+    处理一个 complete 类型的请求: LLM 选择要调用的函数, 调用后对所有响应提取下载链接并下载
+    返回 (函数调用时间, 函数调用tokens, 下载时间, 下载tokens)
+    """
+    # 断点续跑: 上次已经处理完的请求不再重复调用LLM和下载
+    checkpoint = current_checkpoint()
+    fingerprint = fingerprint_value(value)
+    stored = checkpoint.completed_item(key, fingerprint)
+    if stored is not None:
+        logger.info(f" {index}/{total_items} | key: {key} already processed, skip")
+        return tuple(stored)
+    logger.info(f" {index}/{total_items} | Processing key: {key} value: {value}")
+    message = build_function_call_message(function_call_prompt, value)
+    logger.debug(f"message: {message}")
+    llm_chat_start_time = time.time()
+    success, completion = yield call_step(dp_official_create_chat_completion, adp_official_create_chat_completion,
+                                          messages=message,
+                                          model="deepseek-chat",
+                                          temperature=0.5,
+                                          tools=functions_description,
+                                          )
+    llm_time = time.time() - llm_chat_start_time
+    if not success:
+        logger.error(f"error code: {completion['error_code']}, message: {completion['message']}")
+        logger.error(f"faild app: {app_name} ,faild file: {input_file_path}, error key:{key}")
+        checkpoint.mark_item(key, fingerprint, status="failed")
+        return 0, 0, 0, 0
+    function_name, function_args, tokens = parse_function_call(completion, llm_time, app_name, dataset, input_file_path)
+
+    function_response = yield call_step(call_function, acall_function, function_name, function_args)
+    logger.debug(f"function_call_response: {function_response}")
+
+    logger.info(f" download processing : {len(function_response)} function_response items")
+    download_start_time = time.time()
+    download_tokens, download_failed = yield from download_responses_flow(function_response, function_args.get('urls') or [],
+                                                                          app_name, dataset)
+    item_result = (llm_time, tokens, time.time() - download_start_time, download_tokens)
+    # 有下载失败的链接时记为 failed, --resume 时重新处理
+    checkpoint.mark_item(key, fingerprint, list(item_result), status="failed" if download_failed else "done")
+    return item_result
+
+def complete_app_flow(app_name, dataset):
+    # 下载complete类型的固件, 同步时逐个请求处理, 异步时同一个app的所有请求并发处理
+    # 对complete.json文件进行处理的时候，需要提前检查是否是逻辑空的json文件，如果是，则跳过该文件
+    phase3_start_time = time.time()
+    input_file_path, json_content = load_complete_items(app_name, dataset)
+    if not json_content:
         return
-    # 统计函数调用中所花费的时间和tokens
-    total_function_call_time = 0
-    total_function_call_tokens = 0
 
-    # 统计下载过程中所花费的时间和tokens
-    total_download_time = 0
-    total_download_tokens = 0
+    function_call_prompt = get_prompt_content("prompt/2_prompt_functioncall.txt")
 
     total_items = len(json_content)
-    for index, (key,value) in enumerate(json_content.items(),start=1):
-        logger.info(f" {index}/{total_items} | Processing key: {key} value: {value}")
-        query_content = json.dumps(value)
-        message = [
-            {'role': 'system', 'content': function_call_prompt},
-            {'role': 'user', 'content': query_content}
-        ]
-        logger.debug(f"message: {message}")
-        llm_chat_start_time = time.time()
-        success, completion = dp_official_create_chat_completion(messages=message,
-                                                     model="deepseek-chat",
-                                                     temperature=0.5,
-                                                     tools=functions_description,
-                                                     )
-        llm_chat_end_time = time.time()
-        if not success:
-            logger.error(f"error code: {completion['error_code']}, message: {completion['message']}")
-            logger.error(f"faild app: {app_name} ,faild file: {input_file_path}, error key:{key}")
-            continue
-        llm_response_content = completion.choices[0].message
-        usage = completion.usage
-        logger.debug(f"response_message: {llm_response_content}")
-        logger.debug(f"finish reason: {completion.choices[0].finish_reason}")
-        logger.info(f"success app: {app_name} ,success file: {input_file_path}")
-        logger.info(f"used token: {usage.total_tokens} (input_tokens: {usage.prompt_tokens},output_tokens: {usage.completion_tokens})")
-        logger.info(f"used time: {llm_chat_end_time - llm_chat_start_time}s")
-        total_function_call_time += llm_chat_end_time - llm_chat_start_time
-        total_function_call_tokens += usage.total_tokens
-        
-
-        # 获取返回的需要调用的函数名及其参数
-        function_name = completion.choices[0].message.tool_calls[0].function.name
-        logger.debug(f"LLM decided to call function: {function_name}")
-        function_args = json.loads(completion.choices[0].message.tool_calls[0].function.arguments)
-        function_args.update({"app_name":app_name,"dataset":dataset})
-        logger.debug(f"LLM decided to call function arguments: {function_args}")
-        function_to_call = available_function[function_name]
-        function_response = function_to_call(**function_args)
-        logger.debug(f"function_call_response: {function_response}")
-        
-        # 下面的代码直接copy自原始代码，未做逻辑功能修改。(能跑就行)
-        total_response = len(function_response)
-        for index, res in enumerate(function_response):
-            logger.info(f" download processing : {index+1}/{total_response} function_response items") 
-            download_start_time = time.time()
-            results, download_usage = startDownload(res, request_multi, function_args.get('urls')[index], app_name=app_name, dataset=dataset)
-            download_end_time = time.time()
-            total_download_tokens += download_usage
-            total_download_time += download_end_time - download_start_time
-            if not results:
-                logger.debug(f"startDownload function return []")
-                continue
-            # 下边这个感觉不是很必要
-            for index, result in enumerate(results):
-                try:
-                    logger.info(f"deeper download processing : {index+1}/{len(results)}")
-                    results_2, _ = startDownload(result, request_multi, "", app_name=app_name, dataset=dataset)
-                    logger.debug(f"file download result: {results_2}")
-                except UnboundLocalError as e:
-                    logger.error(f"{e}, failed app: {app_name}")
-                finally:
-                    continue
-            
-    # 保存LLM chat时间和usage, 
-    save_llm_phase_time(os.path.join(result_root_path, dataset, app_name, "firmproj_stats.json"), "llm_phase3_chat1", total_function_call_time)
-    save_llm_usage(os.path.join(result_root_path, dataset, app_name, "firmproj_stats.json"), "llm_phase3_usage1", total_function_call_tokens)
-    save_llm_phase_time(os.path.join(result_root_path, dataset, app_name, "firmproj_stats.json"), "llm_phase3_chat2", total_download_time)
-    save_llm_usage(os.path.join(result_root_path, dataset, app_name, "firmproj_stats.json"), "llm_phase3_usage2", total_download_tokens)
-    phase3_end_time = time.time()
-    save_llm_phase_time(os.path.join(result_root_path, dataset, app_name, "firmproj_stats.json"), "phase3", phase3_end_time - phase3_start_time)   
+    item_results = yield gather_steps(complete_item_flow(index, total_items, key, value, function_call_prompt,
+                                                         app_name, dataset, input_file_path)
+                                      for index, (key, value) in enumerate(json_content.items(), start=1))
+    # 函数调用和下载过程中所花费的时间和tokens
+    save_phase3_stats(app_name, dataset,
+                      sum(result[0] for result in item_results), sum(result[1] for result in item_results),
+                      sum(result[2] for result in item_results), sum(result[3] for result in item_results),
+                      phase3_start_time)
 
+@checkpoint_stage("phase3", list_complete_inputs)
+@record_app_stats("phase3", result_root_path)
+@record_cache_stats("llm_phase3_cache", result_root_path)
+def download_complete_file(app_name,dataset):
+    logger.info(f"========== llm phase3 | start process {app_name} ==========")
+    return run_flow(complete_app_flow(app_name, dataset))
 
-def startDownload(res, request_multi, function_args="", app_name=None, dataset=process_dataset):
-    global visited
+@checkpoint_stage("phase3", list_complete_inputs)
+@record_app_stats("phase3", result_root_path)
+@record_cache_stats("llm_phase3_cache", result_root_path)
+async def adownload_complete_file(app_name,dataset):
+    # download_complete_file 的异步版本
+    logger.info(f"========== llm phase3 (async) | start process {app_name} ==========")
+    return await arun_flow(complete_app_flow(app_name, dataset))
+
+
+def compact_download_response(res, function_args):
+    """
+    压缩送入LLM的响应: 只保留带链接的字段和结构骨架, 并限制在 token 上限以内
+    每个响应的压缩比例和截断情况写入日志和该app的统计
+    """
+    response, info = response_compactor.compact(res, count_tokens_batch)
+    if info is None:
+        return response
+    logger.info(f"response compaction: {function_args} ~{info['raw_tokens']} (estimated) -> {info['compact_tokens']} tokens"
+                f"{' (truncated)' if info['truncated'] else ''}")
+    app_stats = current_app_stats()
+    if app_stats is not None:
+        app_stats.add_usage("llm_phase3_response_raw", info["raw_tokens"])
+        app_stats.add_usage("llm_phase3_response_compact", info["compact_tokens"])
+        app_stats.add_count("llm_phase3_response", "compacted")
+        if info["truncated"]:
+            app_stats.add_count("llm_phase3_response", "truncated")
+    return response
+
+def build_download_messages(res, function_args):
     downloadlink_prompt = get_prompt_content("prompt/extract_download_link_prompt.txt")
-    messages = [
+    return [
         {"role": "system", "content": downloadlink_prompt},
         {"role": "user",
-         "content": "Request url: " + function_args + "\nResponse: " + str(res)}
+         "content": "Request url: " + function_args + "\nResponse: " + compact_download_response(res, function_args)}
     ]
 
-    llm_chat_start_time = time.time()
-    success, completion = create_chat_completion(model=MODEL,
-                                                 messages=messages,
-                                                 temperature=0.7)
-    llm_chat_end_time = time.time()
-    if not success:
-        logger.error(f"error code: {completion['error_code']}, message: {completion['message']} in startDownload")
-        logger.error(f"faild app: {app_name}, faild request url: {function_args}")
-        return None
-    
+def parse_download_links(completion, llm_time):
+    """
+    从LLM返回结果中解析下载链接列表, 并去掉已经访问过的链接
+    返回 (待下载的链接, 使用的token数量)
+    """
     llm_response_content = completion.choices[0].message.content
     usage = completion.usage
     logger.debug(f"response_content: {llm_response_content}")
     logger.debug(f"finish reason: {completion.choices[0].finish_reason}")
     logger.info(f"download used token: {usage.total_tokens} (input_tokens: {usage.prompt_tokens},output_tokens: {usage.completion_tokens})")
-    logger.info(f"download used time: {llm_chat_end_time - llm_chat_start_time}s")
+    logger.info(f"download used time: {llm_time}s")
     
     # # 保存 LLM chat时间和usage
     # save_llm_phase_time(os.path.join(result_root_path, dataset, app_name, "firmproj_stats.json"), "llm_phase3_chat2", llm_chat_end_time - llm_chat_start_time)
@@ -261,17 +378,103 @@ def startDownload(res, request_multi, function_args="", app_name=None, dataset=p
 
     # 将str转换为list 列表 
     downloadlink_list = ast.literal_eval(llm_response_content)
-    downloadlink_list = list(set(downloadlink_list))
     logger.debug(f"downloadlist: {downloadlink_list}")
+    return downloadlink_list, usage.total_tokens
+
+def download_links(request_multi, downloadlink_list, app_name, dataset):
+    # 所有app共用的去重集合, 本次运行访问过或之前下载过的链接不再下载
+    seen = []
+    downloadlink_list = url_dedup.url_dedup.claim(downloadlink_list, seen)
+    downloader = firmware_downloader.firmware_downloader
+    if downloader is None:
+        if not downloadlink_list:
+            return []
+        # 结果与链接按顺序一一对应, 与流式下载一样只记录成功的链接
+        downloaded = []
+        try:
+            result = request_multi.make_request_multi("GET", downloadlink_list, download=True,app_name=app_name,dataset=dataset)
+            downloaded = [url for url, item in zip(downloadlink_list, result or [])
+                          if not (isinstance(item, dict) and item.get("error"))]
+            return result
+        finally:
+            url_dedup.url_dedup.record_downloaded(downloaded, app_name, dataset)
+            url_dedup.url_dedup.release([url for url in downloadlink_list if url not in downloaded])
+
+    # 流式下载, 按内容哈希去重后硬链接到该app的 firmware 目录; 只记录下载成功的链接, 失败的下次运行重试
+    downloaded = []
+    try:
+        result = downloader.download_all(downloadlink_list, app_name, dataset)
+        downloaded = [item["url"] for item in result if not item.get("error")]
+    finally:
+        url_dedup.url_dedup.record_downloaded(downloaded, app_name, dataset)
+        url_dedup.url_dedup.release([url for url in downloadlink_list if url not in downloaded])
+    for item in result:
+        if item.get("error"):
+            logger.error(f"download failed: {item['url']}, {item['error']}, app: {app_name}")
+        elif item.get("sniffed"):
+            # 开头的字节表明不是固件(html/json/图片等), 下载已取消
+            logger.info(f"not firmware ({item['sniffed']}), download cancelled: {item['url']}, app: {app_name}")
+        else:
+            logger.info(f"downloaded: {item['url']} -> {item['path']} ({item['size']} bytes, sha256 {item['sha256']})")
+
+    # 其他app(或之前的运行)下载过的链接: 等待其下载结束, 相同的镜像硬链接到该app的 firmware 目录
+    for url in seen:
+        url_dedup.url_dedup.wait(url)
+        item = downloader.link_existing(url, app_name, dataset)
+        if item is None:
+            logger.debug(f"no stored image for {url}, app: {app_name}")
+            continue
+        logger.info(f"linked: {url} -> {item['path']} (sha256 {item['sha256']})")
+        result.append(item)
+    return result
+
+def extract_download_links_locally(res, function_args):
+    """
+    按 extract_download_link_prompt.txt 的规则在本地提取下载链接
+    返回待下载的链接; 响应是无法识别的结构化内容、需要交给LLM时返回 None
+    """
+    downloadlink_list, need_llm = link_extractor.extract(res, function_args)
+    if need_llm:
+        return None
+    logger.debug(f"local downloadlist: {downloadlink_list}")
+    return downloadlink_list
+
+async def adownload_links(request_multi, downloadlink_list, app_name, dataset):
+    # 下载仍然是同步实现, 放到线程中执行
+    return await asyncio.to_thread(download_links, request_multi, downloadlink_list, app_name, dataset)
 
-    for url in downloadlink_list:
-        if url in visited:
-            downloadlink_list.remove(url)
-        visited.append(url)
+def start_download_flow(res, request_multi, function_args="", app_name=None, dataset=process_dataset):
+    """
+    从一个响应中提取下载链接(本地规则无法识别时交给LLM)并下载
+    返回 (下载结果, LLM 使用的token数量), LLM 调用失败时下载结果为 None
+    """
+    downloadlink_list = extract_download_links_locally(res, function_args)
+    if downloadlink_list is not None:
+        if not downloadlink_list:
+            return [], 0
+        return (yield call_step(download_links, adownload_links, request_multi, downloadlink_list, app_name, dataset)), 0
+
+    messages = build_download_messages(res, function_args)
+
+    llm_chat_start_time = time.time()
+    success, completion = yield call_step(create_chat_completion, acreate_chat_completion,
+                                          model=MODEL,
+                                          messages=messages,
+                                          temperature=0.7)
+    llm_chat_end_time = time.time()
+    if not success:
+        logger.error(f"error code: {completion['error_code']}, message: {completion['message']} in startDownload")
+        logger.error(f"faild app: {app_name}, faild request url: {function_args}")
+        return None, 0
+    
+    downloadlink_list, tokens = parse_download_links(completion, llm_chat_end_time - llm_chat_start_time)
     
-    result = request_multi.make_request_multi("GET", downloadlink_list, download=True,app_name=app_name,dataset=dataset)
+    result = yield call_step(download_links, adownload_links, request_multi, downloadlink_list, app_name, dataset)
 
-    return result, usage.total_tokens
+    return result, tokens
+
+def startDownload(res, request_multi, function_args="", app_name=None, dataset=process_dataset):
+    return run_flow(start_download_flow(res, request_multi, function_args, app_name, dataset))
     
 
 
@@ -279,43 +482,96 @@ def download_incomplete_file():
     # 下载incomplete类型的固件
     pass
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="llm phase3: function call and firmware download")
+    parser.add_argument("--mode", choices=["thread", "async"], default="thread",
+                        help="thread: one app per worker thread; async: all apps on one event loop")
+    parser.add_argument("--workers", type=int, default=5, help="number of worker threads (thread mode)")
+    parser.add_argument("--concurrency", type=int, default=100, help="max in-flight LLM requests (upper bound of the adaptive limit)")
+    parser.add_argument("--max-apps", type=int, default=50, help="max apps processed at the same time (async mode)")
+    add_cache_args(parser, llm_cache_path)
+    add_rate_limit_args(parser, llm_requests_per_minute, llm_tokens_per_minute)
+    add_stats_args(parser)
+    add_manifest_args(parser, run_manifest_path)
+    add_url_dedup_args(parser, download_history_path)
+    add_link_extractor_args(parser)
+    add_compactor_args(parser)
+    add_http_engine_args(parser)
+    add_downloader_args(parser, firmware_store_path)
+    return parser.parse_args()
+
+async def main_async(applist, dataset, concurrency, max_apps):
+    set_async_concurrency(concurrency)
+    try:
+        return await run_apps_async(adownload_complete_file, applist, dataset, max_apps)
+    finally:
+        await aclose_clients()
+
 if __name__ == "__main__":
+    args = parse_args()
+    setup_response_cache(args)
+    setup_rate_limiter(args)
+    setup_metrics_store(args)
+    setup_run_manifest(args)
+    setup_url_dedup(args)
+    setup_link_extractor(args)
+    setup_response_compactor(args)
+    setup_http_engine(args)
+    setup_firmware_downloader(args, result_root_path)
     # app = "com.aidong.ishoes.apk"
     # applist = os.listdir(os.path.join(source_data_path, process_dataset))
 
     with open("./IoT-VER-applist.txt", "r") as file:
         applist = file.read().splitlines()
-    # 每次跑1000个app
-    index = 9000
-    applist = applist[index:]
-    # applist = applist[index:index+1000]
+    # 中断后使用 --resume 续跑, 运行清单中已完成的app和请求会被跳过
     # 注意保存日志！！！
 
-    with ThreadPoolExecutor(max_workers=5) as executor:
-        futures = {
-            executor.submit(download_complete_file, app, process_dataset):app
-            for app in applist
-            }
-
-        completed = 0
-        total = len(applist)
-        errors = []  # 用于记录所有错误信息
-
-        for future in as_completed(futures):
-            app = futures[future]  # 获取当前任务对应的 app
-            completed += 1
-            try:
-                result = future.result()  # 获取任务结果，可能会抛出异常
-                
-            except Exception as e:
-                # 捕获异常并记录详细信息
-                error_message = f"Error processing {app}: {str(e)}"
-                errors.append(error_message)
-                print(error_message)
-                result = "error"
-            print(f"Progress: {completed}/{total} - {result}")
-
-        # 所有任务完成后，打印汇总的错误信息
-        if errors:
-            error_log_path = f"logs/llm_preprocess/error_{process_dataset}.log"
-            save_errors(errors, error_log_path)
\ No newline at end of file
+    if args.mode == "async":
+        errors = asyncio.run(main_async(applist, process_dataset, args.concurrency, args.max_apps))
+    else:
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            futures = {
+                executor.submit(download_complete_file, app, process_dataset):app
+                for app in applist
+                }
+
+            completed = 0
+            total = len(applist)
+            errors = []  # 用于记录所有错误信息
+
+            for future in as_completed(futures):
+                app = futures[future]  # 获取当前任务对应的 app
+                completed += 1
+                try:
+                    result = future.result()  # 获取任务结果，可能会抛出异常
+                    
+                except Exception as e:
+                    # 捕获异常并记录详细信息
+                    error_message = f"Error processing {app}: {str(e)}"
+                    errors.append(error_message)
+                    print(error_message)
+                    result = "error"
+                print(f"Progress: {completed}/{total} - {result}")
+
+        # LLM client 连接池复用情况
+        logger.info(f"llm client pool stats: {get_client_pool_stats()}")
+
+    # LLM 响应缓存命中情况
+    logger.info(f"llm response cache stats: {response_cache_stats()}")
+    # LLM 限速器的等待次数、429 次数及最终的并发上限
+    logger.info(f"llm rate limiter stats: {rate_limiter_stats()}")
+    # 下载链接去重情况
+    logger.info(f"download url dedup stats: {url_dedup_stats()}")
+    # 本地提取下载链接省去的LLM调用次数
+    logger.info(f"download link extractor stats: {link_extractor_stats()}")
+    # 送入LLM的响应压缩比例和截断次数
+    logger.info(f"response compaction stats: {response_compactor_stats()}")
+    # 函数调用的 HTTP 请求情况(DNS缓存、HTTP/2、超时和错误)
+    logger.info(f"http engine stats: {http_engine_stats()}")
+    # 固件下载的续传次数、下载量和按内容去重的镜像数
+    logger.info(f"firmware downloader stats: {firmware_downloader_stats()}")
+
+    # 所有任务完成后，打印汇总的错误信息
+    if errors:
+        error_log_path = f"logs/llm_preprocess/error_{process_dataset}.log"
+        save_errors(errors, error_log_path)
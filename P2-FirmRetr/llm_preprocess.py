@@ -3,13 +3,20 @@ import re
 import time
 import random
 import json
-from rapidfuzz import fuzz, process
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import Counter
+import argparse
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 from utils.myllm_sdk import create_chat_completion, model_redirect
-from utils.utils import save_llm_phase_time, save_llm_usage, save_errors
-from utils.deepseek_tokenizer import count_tokens
+from utils.utils import save_errors
+from utils.app_stats import record_app_stats, current_app_stats, setup_metrics_store, add_stats_args
+from utils.run_manifest import checkpoint_stage, setup_run_manifest, add_manifest_args
+from utils import incremental_index
+from utils.incremental_index import IncrementalIndex, setup_incremental, add_incremental_args
+from utils.deepseek_tokenizer import count_tokens_batch, get_tokenizer
+from utils.keyword_matcher import KeywordMatcher, TwoTierKeywordFilter
 from utils.logger import Logger, ensure_log_directory, get_latest_log_number
-from config import source_data_path, result_root_path, process_dataset
+from config import source_data_path, result_root_path, process_dataset, run_manifest_path
 
 # script_name = os.path.basename(__file__)
 # log_dir = f"logs/{os.path.splitext(script_name)[0]}"
@@ -84,37 +91,38 @@ BLACK_SET = [
 
 ]
 
-# 自定义预处理函数
-def preprocess(text):
-    return text.lower()
+# 关键词匹配器缓存, 每个词表只构建一次
+_keyword_matchers = {}
+
+def get_keyword_matcher(keyword_set:list[str]) -> KeywordMatcher:
+    key = tuple(keyword_set)
+    matcher = _keyword_matchers.get(key)
+    if matcher is None:
+        matcher = _keyword_matchers[key] = KeywordMatcher(keyword_set)
+    return matcher
 
 def check_partial_keywords_in_text(text:str, keyword_set:list[str]):
-    # 将文本转换为小写并分割单词（支持常见分隔符）
-    words = re.findall(r'\b[\w$-]+\b', text.lower())
-    if words[0] == "possible":
-        words = words[2:]
-    words = [word for word in words if word != "url"]
-    logger.debug(words)
-    # 存储匹配结果
-    matched_keywords = []
-    for keyword in keyword_set:
-
-        results = process.extract(keyword, words, processor=preprocess, scorer=fuzz.WRatio, score_cutoff=85)
-        # logger.debug(results)
-        if len(results) > 0:
-            matched_keywords.append(keyword)
+    # 词表模糊匹配-综合匹配(WRatio >= 85), 所有关键词与所有单词一次性打分, 命中即返回
+    matched_keywords = get_keyword_matcher(keyword_set).match(text, stop_at_first=True)
     logger.debug(f"matched_keywords:{matched_keywords}")
     if len(matched_keywords) > 0:
         return True
     else:
-        return False    
-    # # 遍历分割后的单词
-    # for word in words:
-    #     # 遍历词典中的关键词，检查是否是当前单词的子字符串
-    #     for keyword in keyword_set:
-    #         if keyword.lower() in word:  # 部分匹配
-    #             return True
-    return False
+        return False
+
+def check_partial_keywords_in_texts(texts:list[str], keyword_set:list[str]) -> list[bool]:
+    # check_partial_keywords_in_text 的批量版本, 所有文本的单词去重后只打分一次
+    matched_keywords_list = get_keyword_matcher(keyword_set).match_batch(texts)
+    for matched_keywords in matched_keywords_list:
+        logger.debug(f"matched_keywords:{matched_keywords}")
+    return [len(matched_keywords) > 0 for matched_keywords in matched_keywords_list]
+
+
+# 两级过滤器: 精确匹配命中直接保留, 未命中的再走 check_partial_keywords_in_text 模糊匹配
+keyword_filter = TwoTierKeywordFilter(FILTER_SET, get_keyword_matcher(FILTER_SET))
+
+def filter_by_keywords(texts:list[str]):
+    return keyword_filter.filter_batch(texts, fuzzy_check=lambda fuzzy_texts: check_partial_keywords_in_texts(fuzzy_texts, FILTER_SET))
 
 
 def extract_urls_and_suffixes(data):
@@ -144,15 +152,22 @@ def extract_urls_and_suffixes(data):
     return results
 
 
-def pre_filter(app_name, dataset):
-    logger.info(f"==================== llm preprocess | start process {app_name} ===================")
-    phase0_start_time = time.time()
+def list_preprocess_inputs(app_name, dataset):
+    # 获取静态分析输出的json文件
     appdir_path = os.path.join(source_data_path,dataset,app_name)
     need_process_json = []
     for file in os.listdir(appdir_path):
         if file.endswith(".json"):
             need_process_json.append(os.path.join(appdir_path, file))
     logger.debug(need_process_json)
+    return need_process_json
+
+@checkpoint_stage("preprocess", list_preprocess_inputs)
+@record_app_stats("preprocess", result_root_path)
+def pre_filter(app_name, dataset):
+    logger.info(f"==================== llm preprocess | start process {app_name} ===================")
+    phase0_start_time = time.time()
+    need_process_json = list_preprocess_inputs(app_name, dataset)
     # 可能会存在apk目录为空
     if not need_process_json:
         logger.info(f"apk dir is empty, skip!")
@@ -164,6 +179,17 @@ def pre_filter(app_name, dataset):
         # 创建文件夹
         os.makedirs(result_path)
     
+    # 增量模式: 记录本次输入中各请求的指纹, 之前处理过的请求直接复用过滤结果
+    request_index = None
+    if incremental_index.incremental:
+        request_index = IncrementalIndex.for_app(result_root_path, dataset, app_name)
+        all_content = {}
+        for json_file in need_process_json:
+            all_content.update(get_json_content_from_file(json_file))
+        request_index.start_run(all_content)
+
+    # 记录两级过滤器每一级的判定次数
+    app_tier_stats = Counter()
     for index, json_file in enumerate(need_process_json,start=1):
         # json file name
         json_file_name = os.path.basename(json_file)
@@ -176,9 +202,18 @@ def pre_filter(app_name, dataset):
             continue
         else:
             # main filter process
-            filtered_content = {}
-            for key, value in content.items():
-                tokens = count_tokens(value)
+            reused_flags = {}
+            if request_index is not None:
+                for key in content:
+                    flag = request_index.get(key, "preprocess")
+                    if flag is not None:
+                        reused_flags[key] = flag
+                logger.info(f"incremental: {len(reused_flags)}/{len(content)} requests unchanged, reuse filter results")
+            new_content = {key: value for key, value in content.items() if key not in reused_flags}
+            candidate_content = {}
+            # 整个json文件(新增或变化)的value一次性批量统计token数量
+            tokens_list = count_tokens_batch(list(new_content.values()))
+            for (key, value), tokens in zip(new_content.items(), tokens_list):
                 # logger.info(tokens)
                 # 只对tokens数量小于1k的进行处理
                 if tokens < 1000:
@@ -191,19 +226,32 @@ def pre_filter(app_name, dataset):
                                 if suffix in black_extension:
                                     logger.info(f"key:{key} suffix:{suffix} is not firmware.")
                                     continue
-                        
-                    # # filter-1 词表模糊匹配-综合匹配，阈值90以上
-                    flag = check_partial_keywords_in_text(value,FILTER_SET)
-                    if flag:
-                        filtered_content[key] = value
-                        logger.info(f"{key} is valid. similarity > 90%")
-                        # 满足条件，直接开始下一轮循环
-                        continue                  
+                    candidate_content[key] = value
+
+            # # filter-1 关键词精确匹配 + 词表模糊匹配-综合匹配，阈值90以上, 整个json文件一次性匹配
+            flags, tier_stats = filter_by_keywords(list(candidate_content.values()))
+            app_tier_stats.update(tier_stats)
+            new_flags = {key: False for key in new_content}
+            for (key, value), flag in zip(candidate_content.items(), flags):
+                if flag:
+                    new_flags[key] = True
+                    logger.info(f"{key} is valid. similarity > 90%")
+            if request_index is not None:
+                for key, flag in new_flags.items():
+                    request_index.set(key, "preprocess", flag)
+            # 按原来的顺序输出通过过滤的请求
+            filtered_content = {key: value for key, value in content.items()
+                                if reused_flags.get(key, new_flags.get(key))}
             logger.info(f"app {app_name} have {len(filtered_content)} valid requets.")
             with open(f"{result_path}/{app_name}_filtered.json", "w") as f:
                 json.dump(filtered_content, f, indent=4)
+    if request_index is not None:
+        request_index.save()
+    logger.info(f"app {app_name} keyword filter tiers: {dict(app_tier_stats)}")
     phase0_end_time = time.time()
-    save_llm_phase_time(os.path.join(result_root_path, dataset, app_name, "firmproj_stats.json"), "llm_preprocess", phase0_end_time - phase0_start_time)
+    app_stats = current_app_stats()
+    app_stats.set_stats("llm_preprocess_filter", app_tier_stats)
+    app_stats.set_time("llm_preprocess", phase0_end_time - phase0_start_time)
     return f"Processed {app_name}"
 
 def pre_filter_error(app:str, process_dataset:str):
@@ -212,14 +260,56 @@ def pre_filter_error(app:str, process_dataset:str):
     return f"Processed {app}"
 
 
+def init_preprocess_worker():
+    """
+    进程池中每个worker进程的初始化: 提前加载 tokenizer, 重新构建关键词匹配器
+    每个进程只占用一个核, cdist 不再额外开线程
+    """
+    global keyword_filter
+    get_tokenizer()
+    matcher = _keyword_matchers[tuple(FILTER_SET)] = KeywordMatcher(FILTER_SET, workers=1)
+    keyword_filter = TwoTierKeywordFilter(FILTER_SET, matcher)
+
+def pre_filter_in_process(app_name, dataset):
+    # 进程池任务: 返回处理结果以及该app的两级过滤统计, 由主进程合并
+    before = Counter(keyword_filter.stats)
+    result = pre_filter(app_name, dataset)
+    return result, dict(keyword_filter.stats - before)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="llm preprocess: keyword pre-filter for static analysis results")
+    parser.add_argument("--dataset", default=process_dataset, help="dataset name under source_data_path")
+    parser.add_argument("--workers", type=int, default=10, help="number of workers")
+    parser.add_argument("--executor", choices=["thread", "process"], default="thread",
+                        help="thread: ThreadPoolExecutor; process: ProcessPoolExecutor (one process per core)")
+    add_stats_args(parser)
+    add_manifest_args(parser, run_manifest_path)
+    add_incremental_args(parser)
+    return parser.parse_args()
+
+
 if __name__ == "__main__":
-    process_dataset = "LOCAL_APK"
+    args = parse_args()
+    process_dataset = args.dataset
+    setup_metrics_store(args)
+    setup_run_manifest(args)
+    setup_incremental(args)
     applist = os.listdir(os.path.join(source_data_path, process_dataset))
     # applist = ["com.roku.rokuhome.apk"]
-    # 使用线程池执行任务
-    with ThreadPoolExecutor(max_workers=10) as executor:
+    if args.executor == "process":
+        # 过滤过程是纯CPU计算, 使用进程池绕开GIL; fork 方式启动, 子进程沿用当前的 logger
+        executor = ProcessPoolExecutor(max_workers=args.workers,
+                                       mp_context=multiprocessing.get_context("fork"),
+                                       initializer=init_preprocess_worker)
+        task = pre_filter_in_process
+    else:
+        # 使用线程池执行任务
+        executor = ThreadPoolExecutor(max_workers=args.workers)
+        task = pre_filter
+
+    with executor:
         futures = {
-            executor.submit(pre_filter, app, process_dataset): app  # 将 future 和对应的 app 关联起来
+            executor.submit(task, app, process_dataset): app  # 将 future 和对应的 app 关联起来
             for app in applist
         }
 
@@ -233,6 +323,10 @@ if __name__ == "__main__":
 
             try:
                 result = future.result()  # 获取任务结果，可能会抛出异常
+                if args.executor == "process":
+                    # 合并子进程中的过滤统计
+                    result, app_tier_stats = result
+                    keyword_filter.stats.update(app_tier_stats)
                 
             except Exception as e:
                 # 捕获异常并记录详细信息
@@ -242,7 +336,12 @@ if __name__ == "__main__":
                 result = "error"
             print(f"Progress: {completed}/{total} - {result}")
 
+        # 汇总两级过滤器的判定次数, 评估节省的模糊匹配量
+        tier_stats = dict(keyword_filter.stats)
+        print(f"Keyword filter tiers: {tier_stats}")
+        logger.info(f"keyword filter tiers: {tier_stats}")
+
         # 所有任务完成后，打印汇总的错误信息
         if errors:
             error_log_path = f"logs/llm_preprocess/error_{process_dataset}.log"
-            save_errors(errors, error_log_path)
\ No newline at end of file
+            save_errors(errors, error_log_path)
@@ -0,0 +1,302 @@
+import os
+import time
+import queue
+import argparse
+import threading
+import multiprocessing
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+import llm_preprocess
+import llm_phase1
+import llm_phase2
+import llm_phase3
+from utils.myllm_sdk import setup_response_cache, response_cache_stats, setup_rate_limiter, rate_limiter_stats, get_client_pool_stats
+from utils.rate_limiter import add_rate_limit_args
+from utils.llm_cache import add_cache_args
+from utils.app_stats import setup_metrics_store, add_stats_args
+from utils.run_manifest import setup_run_manifest, add_manifest_args
+from utils.incremental_index import setup_incremental, add_incremental_args
+from utils.request_dedup import setup_dedup_store, add_dedup_args, dedup_stats
+from utils.near_dup import setup_near_dup, add_near_dup_args, near_dup_stats
+from utils.url_dedup import setup_url_dedup, add_url_dedup_args, url_dedup_stats
+from utils.link_extractor import setup_link_extractor, add_link_extractor_args, link_extractor_stats
+from utils.response_compactor import setup_response_compactor, add_compactor_args, response_compactor_stats
+from utils.http_engine import setup_http_engine, add_http_engine_args, http_engine_stats
+from utils.firmware_downloader import setup_firmware_downloader, add_downloader_args, firmware_downloader_stats
+from utils.stopping_policy import STOPPING_POLICIES, get_stopping_policy
+from utils.utils import save_errors
+from utils.logger import Logger, ensure_log_directory, get_latest_log_number
+from config import source_data_path, result_root_path, process_dataset, llm_cache_path, llm_requests_per_minute, llm_tokens_per_minute, run_manifest_path, dedup_store_path, near_dup_index_path, download_history_path, firmware_store_path
+
+log_dir = "logs/pipeline"
+ensure_log_directory(log_dir)
+last_log_num = get_latest_log_number(log_dir, "pipeline", process_dataset)
+logger = Logger(name="pipeline_logger", level="INFO",
+                log_file=f"{log_dir}/pipeline_logger_{process_dataset}_{last_log_num+1}.log",
+                log_file_level="DEBUG")
+
+STAGE_NAMES = ["preprocess", "phase1", "phase2", "phase3"]
+
+# 队列结束标记, 每个worker线程取到一个后退出
+_DONE = object()
+
+
+class PipelineStage:
+    """
+    流水线中的一个阶段: workers 个线程从本阶段的有界队列中取app, 处理完成后立即放入下一阶段的队列
+    下一阶段队列满时阻塞, 上游不会无限堆积; 某个阶段失败的app不再进入后续阶段
+    """
+
+    def __init__(self, name, func, workers, queue_size, on_finish):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.next_stage = None
+        self.on_finish = on_finish
+        self.stats = Counter()
+        self.errors = []
+        self._lock = threading.Lock()
+        self._alive = workers
+        self._threads = []
+
+    def start(self, dataset):
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._run, args=(dataset,), name=f"{self.name}_{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def close(self):
+        # 上游不会再放入新的app
+        for _ in range(self.workers):
+            self.queue.put(_DONE)
+
+    def join(self):
+        for thread in self._threads:
+            thread.join()
+
+    def _run(self, dataset):
+        while True:
+            app = self.queue.get()
+            if app is _DONE:
+                break
+            start_time = time.time()
+            try:
+                self.func(app, dataset)
+            except Exception as e:
+                error_message = f"Error processing {app} in {self.name}: {str(e)}"
+                logger.error(error_message)
+                with self._lock:
+                    self.errors.append(error_message)
+                    self.stats["failed"] += 1
+                    self.stats["busy_time"] += time.time() - start_time
+                self.on_finish(app, f"error in {self.name}")
+                continue
+            with self._lock:
+                self.stats["completed"] += 1
+                self.stats["busy_time"] += time.time() - start_time
+            if self.next_stage is not None:
+                self.next_stage.queue.put(app)
+            else:
+                self.on_finish(app, "done")
+
+        # 本阶段最后一个worker退出时, 通知下一阶段不会再有新的app
+        with self._lock:
+            self._alive -= 1
+            last = self._alive == 0
+        if last and self.next_stage is not None:
+            self.next_stage.close()
+
+
+class PreprocessInProcess:
+    """
+    在进程池中执行 preprocess, 由 preprocess 阶段的线程提交并等待结果, 两级过滤统计合并回主进程
+    """
+
+    def __init__(self, workers):
+        self._executor = ProcessPoolExecutor(max_workers=workers,
+                                             mp_context=multiprocessing.get_context("fork"),
+                                             initializer=llm_preprocess.init_preprocess_worker)
+        self._lock = threading.Lock()
+        # fork 方式在第一次提交时启动全部子进程, 在启动流水线线程之前完成, 避免带着其他线程持有的锁 fork
+        self._executor.submit(int).result()
+
+    def __call__(self, app_name, dataset):
+        result, app_tier_stats = self._executor.submit(llm_preprocess.pre_filter_in_process, app_name, dataset).result()
+        with self._lock:
+            llm_preprocess.keyword_filter.stats.update(app_tier_stats)
+        return result
+
+    def shutdown(self):
+        self._executor.shutdown()
+
+
+class Pipeline:
+    """
+    preprocess -> phase1 -> phase2 -> phase3 流式处理: 一个app完成上一阶段后立即进入下一阶段
+    各阶段有独立的worker数量, 阶段之间通过有界队列衔接, CPU 过滤和 LLM/网络阶段可以重叠执行
+    """
+
+    def __init__(self, stage_funcs, workers, queue_size):
+        self.total = 0
+        self.completed = 0
+        self.start_time = None
+        self.first_finish_time = None
+        self._lock = threading.Lock()
+        self.stages = [PipelineStage(name, func, workers[name], queue_size, self._finish)
+                       for name, func in stage_funcs]
+        for stage, next_stage in zip(self.stages, self.stages[1:]):
+            stage.next_stage = next_stage
+
+    def _finish(self, app, result):
+        with self._lock:
+            self.completed += 1
+            completed = self.completed
+            if result == "done" and self.first_finish_time is None:
+                self.first_finish_time = time.time() - self.start_time
+                logger.info(f"first app finished all stages after {self.first_finish_time:.1f}s: {app}")
+        print(f"Progress: {completed}/{self.total} - {app} {result}")
+
+    def run(self, applist, dataset):
+        self.total = len(applist)
+        self.start_time = time.time()
+        for stage in self.stages:
+            stage.start(dataset)
+        # 第一个阶段的队列同样有界, 按处理速度逐个放入app
+        for app in applist:
+            self.stages[0].queue.put(app)
+        self.stages[0].close()
+        for stage in self.stages:
+            stage.join()
+
+        total_time = time.time() - self.start_time
+        for stage in self.stages:
+            busy_time = stage.stats["busy_time"]
+            logger.info(f"stage {stage.name}: completed {stage.stats['completed']}, failed {stage.stats['failed']}, "
+                        f"workers {stage.workers}, utilization {busy_time / (total_time * stage.workers):.1%}")
+        logger.info(f"pipeline finished {self.total} apps in {total_time:.1f}s")
+        return [error for stage in self.stages for error in stage.errors]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="streaming pipeline: preprocess -> phase1 -> phase2 -> phase3 per app")
+    parser.add_argument("--dataset", default=process_dataset, help="dataset name under source_data_path")
+    parser.add_argument("--applist", default=None, help="file with one app per line, default: all apps of the dataset")
+    parser.add_argument("--stages", nargs="+", choices=STAGE_NAMES, default=STAGE_NAMES,
+                        help="stages to run, in pipeline order")
+    parser.add_argument("--queue-size", type=int, default=50, help="max apps waiting in front of each stage")
+    parser.add_argument("--preprocess-workers", type=int, default=10, help="number of preprocess workers")
+    parser.add_argument("--preprocess-executor", choices=["thread", "process"], default="thread",
+                        help="thread: run the keyword filter in the worker threads; process: in a process pool")
+    parser.add_argument("--phase1-workers", type=int, default=6, help="apps processed at the same time in phase1")
+    parser.add_argument("--phase2-workers", type=int, default=6, help="apps processed at the same time in phase2")
+    parser.add_argument("--phase3-workers", type=int, default=5, help="apps processed at the same time in phase3")
+    parser.add_argument("--group-input-tokens", type=int, default=llm_phase1.GROUP_INPUT_TOKENS,
+                        help="max input tokens (prompt included) of one phase1 llm call")
+    parser.add_argument("--group-output-tokens", type=int, default=llm_phase1.GROUP_OUTPUT_TOKENS,
+                        help="max estimated output tokens of one phase1 llm call")
+    parser.add_argument("--group-workers", type=int, default=llm_phase1.GROUP_WORKERS,
+                        help="threads of the phase1 llm work queue shared by all apps")
+    parser.add_argument("--stopping-policy", choices=list(STOPPING_POLICIES), default="consistency",
+                        help="early stopping rule of the phase2 multi-round voting")
+    parser.add_argument("--batch-size", type=int, default=llm_phase2.CLASSIFY_BATCH_SIZE,
+                        help="max key-value items classified in one phase2 LLM call, 1 = one item per call")
+    parser.add_argument("--batch-token-budget", type=int, default=llm_phase2.CLASSIFY_BATCH_TOKEN_BUDGET,
+                        help="max tokens of the items packed into one batched phase2 call")
+    add_cache_args(parser, llm_cache_path)
+    add_rate_limit_args(parser, llm_requests_per_minute, llm_tokens_per_minute)
+    add_stats_args(parser)
+    add_manifest_args(parser, run_manifest_path)
+    add_incremental_args(parser)
+    add_dedup_args(parser, dedup_store_path)
+    add_near_dup_args(parser, near_dup_index_path)
+    add_url_dedup_args(parser, download_history_path)
+    add_link_extractor_args(parser)
+    add_compactor_args(parser)
+    add_http_engine_args(parser)
+    add_downloader_args(parser, firmware_store_path)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    setup_response_cache(args)
+    setup_rate_limiter(args)
+    setup_metrics_store(args)
+    manifest = setup_run_manifest(args)
+    setup_incremental(args)
+    setup_dedup_store(args)
+    setup_near_dup(args)
+    setup_url_dedup(args)
+    setup_link_extractor(args)
+    setup_response_compactor(args)
+    setup_http_engine(args)
+    if "phase3" in args.stages:
+        setup_firmware_downloader(args, result_root_path)
+    llm_phase1.GROUP_INPUT_TOKENS = args.group_input_tokens
+    llm_phase1.GROUP_OUTPUT_TOKENS = args.group_output_tokens
+    llm_phase1.GROUP_WORKERS = args.group_workers
+    llm_phase2.STOPPING_POLICY = get_stopping_policy(args.stopping_policy)
+    llm_phase2.CLASSIFY_BATCH_SIZE = args.batch_size
+    llm_phase2.CLASSIFY_BATCH_TOKEN_BUDGET = args.batch_token_budget
+
+    if args.applist:
+        with open(args.applist, "r") as file:
+            applist = [app for app in file.read().splitlines() if app]
+    else:
+        applist = os.listdir(os.path.join(source_data_path, args.dataset))
+
+    preprocess_pool = None
+    if "preprocess" in args.stages and args.preprocess_executor == "process":
+        preprocess_pool = PreprocessInProcess(args.preprocess_workers)
+    stage_funcs = {
+        "preprocess": preprocess_pool or llm_preprocess.pre_filter,
+        "phase1": llm_phase1.format_url,
+        "phase2": llm_phase2.classify_url,
+        "phase3": llm_phase3.download_complete_file,
+    }
+    workers = {
+        "preprocess": args.preprocess_workers,
+        "phase1": args.phase1_workers,
+        "phase2": args.phase2_workers,
+        "phase3": args.phase3_workers,
+    }
+    pipeline = Pipeline([(name, stage_funcs[name]) for name in STAGE_NAMES if name in args.stages],
+                        workers, args.queue_size)
+    try:
+        errors = pipeline.run(applist, args.dataset)
+    finally:
+        if preprocess_pool is not None:
+            preprocess_pool.shutdown()
+
+    if "preprocess" in args.stages:
+        logger.info(f"keyword filter tiers: {dict(llm_preprocess.keyword_filter.stats)}")
+    # LLM client 连接池复用情况
+    logger.info(f"llm client pool stats: {get_client_pool_stats()}")
+    # 运行清单中各阶段app的完成情况
+    if manifest is not None:
+        logger.info(f"run manifest: {manifest.summary(args.dataset)}")
+    # LLM 响应缓存命中情况
+    logger.info(f"llm response cache stats: {response_cache_stats()}")
+    # LLM 限速器的等待次数、429 次数及最终的并发上限
+    logger.info(f"llm rate limiter stats: {rate_limiter_stats()}")
+    # 跨app去重的去重率
+    logger.info(f"request dedup stats: {dedup_stats()}")
+    # 近似重复复用的命中次数和抽检一致率
+    logger.info(f"near dup stats: {near_dup_stats()}")
+    # 下载链接去重情况
+    if "phase3" in args.stages:
+        logger.info(f"download url dedup stats: {url_dedup_stats()}")
+        # 本地提取下载链接省去的LLM调用次数
+        logger.info(f"download link extractor stats: {link_extractor_stats()}")
+        # 送入LLM的响应压缩比例和截断次数
+        logger.info(f"response compaction stats: {response_compactor_stats()}")
+        # 函数调用的 HTTP 请求情况(DNS缓存、HTTP/2、超时和错误)
+        logger.info(f"http engine stats: {http_engine_stats()}")
+        # 固件下载的续传次数、下载量和按内容去重的镜像数
+        logger.info(f"firmware downloader stats: {firmware_downloader_stats()}")
+
+    # 所有任务完成后，打印汇总的错误信息
+    if errors:
+        error_log_path = f"logs/pipeline/error_{args.dataset}.log"
+        save_errors(errors, error_log_path)
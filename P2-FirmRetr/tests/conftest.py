@@ -0,0 +1,16 @@
+import os
+import sys
+import pytest
+
+# 测试从任意目录运行时都能导入 utils
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_firmware_server import serve_fake_firmware  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def fake_server():
+    server, base = serve_fake_firmware()
+    yield base
+    server.shutdown()
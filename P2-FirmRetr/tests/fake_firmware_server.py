@@ -0,0 +1,110 @@
+import os
+import re
+import json
+import time
+import hashlib
+import threading
+from urllib.parse import urlsplit
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+def fake_firmware_body(name, size):
+    # 模拟固件的内容(uImage 头), 同名的文件内容相同
+    seed = hashlib.sha256(name.encode("utf-8")).digest()
+    return (b"\x27\x05\x19\x56" + seed * (size // len(seed) + 1))[:size]
+
+
+def firmware_size(name):
+    return 3 * 1024 * 1024 if "big" in name else 4100
+
+
+def serve_fake_firmware(port=0):
+    """
+    本地的模拟固件服务器, 用于测试引擎和下载器: 返回 (server, base_url)
+    /api/check: 升级信息 json; /fw/<name>: 固件文件(支持 Range/If-Range); /flaky/<name>: 第一次下载到一半时断开;
+    /badrange/<name>: Range 请求返回从 0 开始的 206; /empty: 空的 200 响应;
+    /login: 2MB 的 html 登录页; /banner.png: 图片; /slow: 延迟响应; 其他: 500
+    """
+    interrupted = set()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def handle(self):
+            try:
+                super().handle()
+            except ConnectionError:
+                # 客户端取消了下载
+                pass
+
+        def do_GET(self):
+            base = f"http://127.0.0.1:{self.server.server_port}"
+            path = urlsplit(self.path).path
+            if path.startswith("/api/check"):
+                body = json.dumps({"code": 0, "data": {"version": "1.2.3", "url": f"{base}/fw/device_v1.2.3.bin"}}).encode()
+                self._send(200, "application/json", body)
+            elif path.startswith(("/fw/", "/flaky/")):
+                name = os.path.basename(path)
+                self._send_file(fake_firmware_body(name, firmware_size(name)),
+                                cut=path.startswith("/flaky/") and path not in interrupted)
+                interrupted.add(path)
+            elif path.startswith("/badrange/"):
+                body = fake_firmware_body(os.path.basename(path), 4100)
+                etag = '"' + hashlib.md5(body).hexdigest() + '"'
+                status = 206 if self.headers.get("Range") else 200
+                self._send(status, "application/octet-stream", body,
+                           {"ETag": etag, "Content-Range": f"bytes 0-{len(body) - 1}/{len(body)}"})
+            elif path.startswith("/empty"):
+                self._send(200, "application/octet-stream", b"")
+            elif path.startswith("/login"):
+                body = b"<!DOCTYPE html><html><head><title>Login</title></head><body>" + b"<div></div>" * 200000
+                self._send(200, "text/html", body)
+            elif path.startswith("/banner.png"):
+                self._send(200, "image/png", b"\x89PNG\r\n\x1a\n" + os.urandom(512 * 1024))
+            elif path.startswith("/slow"):
+                time.sleep(3)
+                self._send(200, "text/plain", b"slow")
+            else:
+                self._send(500, "text/html", b"<h1>Internal Server Error</h1>")
+
+        do_POST = do_GET
+
+        def _send(self, status, content_type, body, headers=None):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _send_file(self, body, cut=False):
+            etag = '"' + hashlib.md5(body).hexdigest() + '"'
+            match = re.match(r"bytes=(\d+)-", self.headers.get("Range", ""))
+            if match and self.headers.get("If-Range", etag) == etag:
+                start = int(match.group(1))
+                if start >= len(body):
+                    self._send(416, "text/plain", b"", {"Content-Range": f"bytes */{len(body)}"})
+                    return
+                self._send(206, "application/octet-stream", body[start:],
+                           {"ETag": etag, "Content-Range": f"bytes {start}-{len(body) - 1}/{len(body)}"})
+                return
+            if cut:
+                # 声明完整长度, 只发送一半后断开连接
+                self.send_response(200)
+                self.send_header("Content-Type", "application/octet-stream")
+                self.send_header("Content-Length", str(len(body)))
+                self.send_header("ETag", etag)
+                self.end_headers()
+                self.wfile.write(body[:len(body) // 2])
+                self.wfile.flush()
+                self.close_connection = True
+                return
+            self._send(200, "application/octet-stream", body, {"ETag": etag, "Accept-Ranges": "bytes"})
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
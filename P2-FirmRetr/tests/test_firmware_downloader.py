@@ -0,0 +1,130 @@
+import os
+import json
+import hashlib
+import pytest
+from fake_firmware_server import fake_firmware_body, firmware_size
+from utils.firmware_downloader import FirmwareDownloader, FirmwareStore
+
+
+@pytest.fixture
+def downloader(tmp_path):
+    downloader = FirmwareDownloader(FirmwareStore(str(tmp_path / "store")), str(tmp_path / "result"),
+                                    chunk_size=64 * 1024)
+    yield downloader
+    downloader.close()
+
+
+def expected_sha256(name):
+    return hashlib.sha256(fake_firmware_body(name, firmware_size(name))).hexdigest()
+
+
+def write_partial(downloader, url, data, name):
+    # 模拟上次中断的下载: 部分内容和带 ETag 的元数据
+    body = fake_firmware_body(name, firmware_size(name))
+    part_path = downloader.store.partial_path(url)
+    with open(part_path, "wb") as file:
+        file.write(data)
+    with open(part_path + ".json", "w", encoding="utf-8") as file:
+        json.dump({"url": url, "etag": '"' + hashlib.md5(body).hexdigest() + '"', "length": len(body)}, file)
+    return part_path
+
+
+def test_identical_images_are_stored_once_and_hard_linked(downloader, fake_server):
+    first = downloader.download(f"{fake_server}/fw/same.bin", "app_a", "check")
+    second = downloader.download(f"{fake_server}/fw/same.bin?mirror=1", "app_b", "check")
+    assert first["sha256"] == second["sha256"] == expected_sha256("same.bin")
+    assert first["path"] != second["path"]
+    assert os.path.samefile(first["path"], second["path"])
+    assert os.path.samefile(first["path"], downloader.store.object_path(first["sha256"]))
+    stats = downloader.summary()
+    assert stats["images"] == 1 and stats["duplicate_images"] == 1
+
+
+def test_link_existing_reuses_the_stored_image(downloader, fake_server):
+    url = f"{fake_server}/fw/shared_sdk.bin"
+    downloaded = downloader.download(url, "app_a", "check")
+    linked = downloader.link_existing(url, "app_b", "check")
+    assert linked["sha256"] == downloaded["sha256"]
+    assert os.path.dirname(linked["path"]).endswith(os.path.join("app_b", "firmware"))
+    assert os.path.samefile(linked["path"], downloaded["path"])
+    assert downloader.link_existing(f"{fake_server}/fw/never_downloaded.bin", "app_b", "check") is None
+
+
+def test_interrupted_download_resumes_with_range(downloader, fake_server):
+    result = downloader.download(f"{fake_server}/flaky/resume_big.bin", "app_a", "check")
+    assert "error" not in result
+    assert result["sha256"] == expected_sha256("resume_big.bin")
+    assert result["size"] == firmware_size("resume_big.bin")
+    stats = downloader.summary()
+    assert stats["interrupted"] == 1 and stats["resumed"] == 1
+
+
+def test_range_not_satisfiable_restarts_from_scratch(downloader, fake_server):
+    url = f"{fake_server}/fw/too_long.bin"
+    part_path = write_partial(downloader, url, b"\x00" * (firmware_size("too_long.bin") + 10), "too_long.bin")
+    result = downloader.download(url, "app_a", "check")
+    assert result["sha256"] == expected_sha256("too_long.bin")
+    assert not os.path.exists(part_path)
+    assert "resumed" not in downloader.summary()
+
+
+def test_unexpected_content_range_restarts_from_scratch(downloader, fake_server):
+    url = f"{fake_server}/badrange/shifted.bin"
+    body = fake_firmware_body("shifted.bin", 4100)
+    write_partial(downloader, url, body[:2000], "shifted.bin")
+    result = downloader.download(url, "app_a", "check")
+    assert result["size"] == len(body)
+    assert result["sha256"] == hashlib.sha256(body).hexdigest()
+    assert "resumed" not in downloader.summary()
+
+
+def test_resume_without_validator_or_length_restarts(downloader, fake_server):
+    url = f"{fake_server}/fw/no_validator.bin"
+    part_path = downloader.store.partial_path(url)
+    with open(part_path, "wb") as file:
+        file.write(b"stale content")
+    result = downloader.download(url, "app_a", "check")
+    assert result["sha256"] == expected_sha256("no_validator.bin")
+    assert "resumed" not in downloader.summary()
+
+
+def test_empty_body_is_a_failure(downloader, fake_server):
+    url = f"{fake_server}/empty"
+    result = downloader.download(url, "app_a", "check")
+    assert result["error"] == "empty response body"
+    assert not os.path.exists(downloader.store.partial_path(url))
+    assert "images" not in downloader.summary()
+
+
+def test_http_error_is_reported(downloader, fake_server):
+    result = downloader.download(f"{fake_server}/error", "app_a", "check")
+    assert result["error"] == "HTTP Error 500"
+    assert result["content"] is None
+
+
+@pytest.mark.parametrize("path, label", [("/login", "html"), ("/banner.png", "png")])
+def test_non_firmware_downloads_are_cancelled(downloader, fake_server, path, label):
+    url = fake_server + path
+    result = downloader.download(url, "app_a", "check")
+    assert result["sniffed"] == label
+    assert result["content"] is None and "path" not in result
+    assert not os.path.exists(downloader.store.partial_path(url))
+    stats = downloader.summary()
+    assert stats[f"cancelled_{label}"] == 1
+    assert stats["bytes_avoided"] > 0
+
+
+def test_text_responses_return_their_content(downloader, fake_server):
+    result = downloader.download(f"{fake_server}/api/check", "app_a", "check")
+    assert result["sniffed"] == "json"
+    assert result["content"]["data"]["version"] == "1.2.3"
+
+
+def test_sniffing_can_be_disabled(tmp_path, fake_server):
+    downloader = FirmwareDownloader(FirmwareStore(str(tmp_path / "store")), str(tmp_path / "result"), sniff_bytes=0)
+    try:
+        result = downloader.download(f"{fake_server}/api/check", "app_a", "check")
+    finally:
+        downloader.close()
+    assert "sniffed" not in result
+    assert result["content"]["code"] == 0
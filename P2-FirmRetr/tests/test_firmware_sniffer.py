@@ -0,0 +1,124 @@
+import gzip
+import struct
+import zlib
+import random
+import pytest
+from utils.firmware_sniffer import SNIFF_BYTES, Verdict, sniff, _is_text, is_text_verdict
+
+# 固定的伪随机负载, 模拟压缩或加密后的数据
+PAYLOAD = random.Random(0).randbytes(SNIFF_BYTES)
+
+
+def uimage_header():
+    # 64 字节的 legacy uImage 头: magic, hcrc, time, size, load, ep, dcrc, os, arch, type, comp, name
+    name = b"Linux-4.14.90".ljust(32, b"\x00")
+    return struct.pack(">IIIIIIIBBBB32s", 0x27051956, 0, 1600000000, len(PAYLOAD), 0x80008000, 0x80008000,
+                       zlib.crc32(PAYLOAD), 5, 2, 2, 1, name) + PAYLOAD
+
+
+def trx_header():
+    # TRX v1: magic, 长度, crc32, flags | version, 三个分区偏移
+    return b"HDR0" + struct.pack("<IIHHIII", 28 + len(PAYLOAD), 0, 0, 1, 28, 28 + 1024, 28 + 4096) + PAYLOAD
+
+
+def squashfs_header(magic=b"hsqs"):
+    # squashfs 4.0 超级块的开头: magic, inode 数, mkfs 时间, 块大小, 分片数, 压缩算法, block_log, flags, ...
+    return magic + struct.pack("<IIIIHHHHH", 100, 1600000000, 131072, 4, 1, 17, 0, 10, 4) + PAYLOAD
+
+
+def zip_header():
+    # 本地文件头: version, flags, method, time, date, crc32, 压缩/原始长度, 文件名长度, 扩展字段长度
+    name = b"firmware.bin"
+    return b"PK\x03\x04" + struct.pack("<HHHHHIIIHH", 20, 0, 8, 0, 0, 0, len(PAYLOAD), len(PAYLOAD) * 2,
+                                       len(name), 0) + name + PAYLOAD
+
+
+def elf_header():
+    # 32 位小端 ARM 可执行文件
+    ident = b"\x7fELF" + bytes([1, 1, 1, 0]) + bytes(8)
+    return ident + struct.pack("<HHIIIIIHHHHHH", 2, 40, 1, 0x8000, 52, 0, 0x5000000, 52, 32, 1, 40, 0, 0) + PAYLOAD
+
+
+def intel_hex():
+    lines = [":020000040800F2"]
+    for address in range(0, 256, 16):
+        data = PAYLOAD[address:address + 16]
+        record = bytes([len(data), address >> 8, address & 0xff, 0]) + data
+        lines.append(":" + (record + bytes([-sum(record) & 0xff])).hex().upper())
+    lines.append(":00000001FF")
+    return ("\r\n".join(lines) + "\r\n").encode()
+
+
+def dfuse_header():
+    # DfuSe 前缀: signature, version, 文件长度, target 数; 之后是第一个 target 的前缀
+    target = b"Target" + struct.pack("<BI", 1, 1) + b"ST...".ljust(255, b"\x00") + struct.pack("<II", 1024, 1)
+    return b"DfuSe" + struct.pack("<BIB", 1, 11 + len(target) + len(PAYLOAD), 1) + target + PAYLOAD
+
+
+@pytest.mark.parametrize("head, label", [
+    (uimage_header(), "uimage"),
+    (trx_header(), "trx"),
+    (squashfs_header(), "squashfs"),
+    (squashfs_header(b"sqsh"), "squashfs"),
+    (gzip.compress(PAYLOAD, mtime=0), "gzip"),
+    (zip_header(), "zip"),
+    (elf_header(), "elf"),
+    (intel_hex(), "intel_hex"),
+    (dfuse_header(), "dfuse"),
+], ids=["uimage", "trx", "squashfs", "squashfs-be", "gzip", "zip", "elf", "intel_hex", "dfuse"])
+def test_firmware_headers(head, label):
+    assert sniff(head[:SNIFF_BYTES]) == Verdict("firmware", label, 0)
+    # 只收到开头几十个字节时也能识别
+    assert sniff(head[:64]).label == label
+
+
+def test_intel_hex_tolerates_a_truncated_last_line_and_a_bom():
+    head = intel_hex()
+    assert sniff(head[:len(head) - 5]) == Verdict("firmware", "intel_hex", 0)
+    assert sniff(b"\xef\xbb\xbf" + head) == Verdict("firmware", "intel_hex", 0)
+    # 混入其他文本就不是 Intel HEX
+    assert sniff(b"note: flash this\n" + head).label == "text"
+
+
+def test_signatures_embedded_after_a_vendor_header():
+    head = b"VNDR" + bytes(60) + uimage_header()
+    assert sniff(head[:SNIFF_BYTES]) == Verdict("firmware", "uimage", 64)
+    # 短 magic 只在开头匹配, 不在窗口内搜索
+    assert sniff(b"\x01\x02" + gzip.compress(PAYLOAD)).kind == "unknown"
+
+
+@pytest.mark.parametrize("head, kind, label, offset", [
+    (b"\x89PNG\r\n\x1a\n" + PAYLOAD, "non_firmware", "png", 0),
+    (b"RIFF\x00\x00\x00\x00WEBPVP8 " + PAYLOAD, "non_firmware", "webp", 8),
+    (b"%PDF-1.7\n" + PAYLOAD, "non_firmware", "pdf", 0),
+    (b"<!DOCTYPE html>\n<html><body>404 Not Found</body></html>", "non_firmware", "html", 0),
+    (b'<?xml version="1.0"?><update url="http://a.com/fw.bin"/>', "non_firmware", "xml", 0),
+    (b'  {"code": 0, "url": "http://a.com/fw.bin"}', "non_firmware", "json", 0),
+    (b"firmware 1.2 released", "non_firmware", "text", 0),
+    (PAYLOAD, "unknown", "binary", 0),
+    (b"", "unknown", "binary", 0),
+], ids=["png", "webp", "pdf", "html", "xml", "json", "text", "binary", "empty"])
+def test_non_firmware_and_unknown_content(head, kind, label, offset):
+    assert sniff(head[:SNIFF_BYTES]) == Verdict(kind, label, offset)
+
+
+def test_empty_html_responses_use_the_content_type():
+    assert sniff(b"", "text/html; charset=utf-8") == Verdict("non_firmware", "html", 0)
+    assert is_text_verdict(sniff(b'{"url": "x"}')) and not is_text_verdict(sniff(b"<html>"))
+
+
+@pytest.mark.parametrize("head, expected", [
+    (b"plain ascii\r\n\twith tabs", True),
+    ("固件升级说明: 修复若干问题".encode("utf-8"), True),
+    # 截断在多字节字符中间
+    ("固件升级".encode("utf-8")[:-1], True),
+    # 少量控制字符仍是文本
+    (b"\x1b[0m" + b"a" * 100, True),
+    (b"", False),
+    (b"text\x00with nul", False),
+    ("固件".encode("utf-8")[:-1] + b" and more text after a broken character", False),
+    (bytes(range(0x80, 0x100)), False),
+    (PAYLOAD[:512], False),
+], ids=["ascii", "utf8", "utf8-cut", "control", "empty", "nul", "broken-utf8", "high-bytes", "random"])
+def test_is_text(head, expected):
+    assert _is_text(head) is expected
@@ -0,0 +1,92 @@
+import asyncio
+import threading
+import pytest
+from utils.flow import call_step, gather_steps, run_flow, arun_flow
+from utils.work_queue import LLMWorkQueue
+
+
+def double(value):
+    return value * 2
+
+
+async def adouble(value):
+    await asyncio.sleep(0)
+    return value * 2
+
+
+def fail(message):
+    raise ValueError(message)
+
+
+async def afail(message):
+    raise ValueError(message)
+
+
+def item_flow(value, calls):
+    calls.append(value)
+    return (yield call_step(double, adouble, value)) + 1
+
+
+def sum_flow(values, calls, executor=None):
+    results = yield gather_steps((item_flow(value, calls) for value in values), executor)
+    return sum(results)
+
+
+def cleanup_flow(cleaned):
+    try:
+        yield call_step(fail, afail, "boom")
+    finally:
+        cleaned.append(True)
+
+
+def recover_flow():
+    try:
+        yield call_step(fail, afail, "boom")
+    except ValueError as e:
+        return f"recovered {e}"
+
+
+def test_sync_and_async_drivers_give_the_same_result():
+    sync_calls, async_calls = [], []
+    assert run_flow(sum_flow([1, 2, 3], sync_calls)) == 15
+    assert asyncio.run(arun_flow(sum_flow([1, 2, 3], async_calls))) == 15
+    assert sync_calls == async_calls == [1, 2, 3]
+
+
+def test_flow_without_steps_returns_directly():
+    def empty_flow():
+        return "done"
+        yield
+
+    assert run_flow(empty_flow()) == "done"
+    assert asyncio.run(arun_flow(empty_flow())) == "done"
+
+
+def test_gather_runs_sub_flows_on_the_executor():
+    queue = LLMWorkQueue(max_workers=2, name="flow_test")
+    threads = set()
+
+    def record_thread(value):
+        threads.add(threading.current_thread().name)
+        return value
+
+    def thread_flow(value):
+        return (yield call_step(record_thread, adouble, value))
+
+    def gather_flow():
+        return (yield gather_steps([thread_flow(value) for value in range(4)], queue))
+
+    try:
+        assert run_flow(gather_flow()) == [0, 1, 2, 3]
+    finally:
+        queue.shutdown()
+    assert all(name.startswith("flow_test") for name in threads)
+
+
+@pytest.mark.parametrize("driver", [run_flow, lambda flow: asyncio.run(arun_flow(flow))])
+def test_step_errors_are_thrown_into_the_flow(driver):
+    cleaned = []
+    with pytest.raises(ValueError, match="boom"):
+        driver(cleanup_flow(cleaned))
+    assert cleaned == [True]
+    assert driver(recover_flow()) == "recovered boom"
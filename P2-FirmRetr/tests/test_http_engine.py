@@ -0,0 +1,25 @@
+import time
+import pytest
+from utils.http_engine import HttpEngine
+
+
+@pytest.fixture
+def engine():
+    engine = HttpEngine(per_host=2, total_timeout=1)
+    yield engine
+    engine.close()
+
+
+def test_candidates_are_fetched_concurrently_with_per_url_errors(engine, fake_server):
+    urls = [f"{fake_server}/api/check?sn=1", f"{fake_server}/fw/probe.bin", f"{fake_server}/slow",
+            f"{fake_server}/error", "http://a\x00b/"]
+    start = time.time()
+    check, firmware, slow, error, invalid = engine.fetch_all("GET", urls, {"User-Agent": "firmproj"}, {"model": "x"})
+    assert time.time() - start < 2.5
+    assert check == {"status_code": 200, "content": {"code": 0, "data": {
+        "version": "1.2.3", "url": f"{fake_server}/fw/device_v1.2.3.bin"}}}
+    assert firmware["content"]["download_url"] == f"{fake_server}/fw/probe.bin?model=x"
+    assert slow["error"].startswith("total timeout")
+    assert error["error"] == "HTTP Error 500" and error["status_code"] == 500
+    assert invalid["error"].startswith("InvalidURL")
+    assert engine.summary()["requests"] == len(urls)
@@ -0,0 +1,74 @@
+import pytest
+from utils.keyword_matcher import KeywordMatcher, AhoCorasick, TwoTierKeywordFilter
+from utils.keyword_matcher import legacy_check_partial_keywords, generate_synthetic_requests
+
+# llm_preprocess.FILTER_SET 的一部分, 覆盖下划线、驼峰和短关键词
+KEYWORDS = ["downloadfirmware", "download_firmware", "FirmwareUpdate", "checkFirmwareStatus", "firmware_url",
+            "firmware", "fwurl", "update_info", "fw_update", "checkUpdate", "upgrade", "update", "downloadUrl",
+            "otaCheck", "deviceOTA", "ota", "version", "getLatestVersion"]
+
+TEXTS = [
+    "[Possible Url]: https://api.example.com/v1/firmware/latest",
+    "[Possible Url]: https://api.example.com/v1/user/profile",
+    "RetrofitPoint:{\nMethod Name = [checkFirmwareStatus] baseUrl login",
+    "RetrofitPoint:{\nMethod Name = [getUserInfo] token deviceId",
+    "checkFrmwareStatus deviceId",
+    "rotation timezone region",
+    "ota_check appVersion",
+    "otaCheck",
+    "download-firmware param",
+    "DOWNLOAD_FIRMWARE",
+    "url url url",
+    "possible url",
+    "",
+]
+
+
+@pytest.fixture(scope="module")
+def matcher():
+    return KeywordMatcher(KEYWORDS, workers=1)
+
+
+def fixed_inputs():
+    return TEXTS + generate_synthetic_requests(KEYWORDS, num=300, seed=7)
+
+
+def test_match_batch_makes_the_legacy_decisions(matcher):
+    texts = fixed_inputs()
+    legacy = [legacy_check_partial_keywords(text, KEYWORDS) for text in texts]
+    assert [len(matched) > 0 for matched in matcher.match_batch(texts)] == legacy
+    assert matcher.is_match_batch(texts) == legacy
+    # 固定输入中两种判定都要出现, 避免比较退化
+    assert any(legacy) and not all(legacy)
+
+
+def test_single_text_match_agrees_with_batch(matcher):
+    texts = fixed_inputs()
+    assert [matcher.is_match(text) for text in texts] == matcher.is_match_batch(texts)
+    assert [matcher.match(text) for text in texts] == matcher.match_batch(texts)
+
+
+def test_matched_keywords_are_the_legacy_hits_in_keyword_order(matcher):
+    texts = TEXTS[:6]
+    expected = [[keyword for keyword in KEYWORDS if legacy_check_partial_keywords(text, [keyword])] for text in texts]
+    assert matcher.match_batch(texts) == expected
+    assert "checkFirmwareStatus" in expected[2] and expected[3] == []
+
+
+def test_exact_tier_only_accepts_whole_words(matcher):
+    # WRatio 对长单词中的短子串只给 60 分, 精确匹配也不能接受这样的子串命中
+    texts = ["getNotarizedCertificateChainForService timezone", "ota timezone", "[Possible Url]: /v1/ota"]
+    flags, stats = TwoTierKeywordFilter(KEYWORDS, matcher).filter_batch(texts)
+    assert flags == [legacy_check_partial_keywords(text, KEYWORDS) for text in texts] == [False, True, True]
+    assert stats["exact_accept"] == 2 and stats["fuzzy_reject"] == 1
+    # 不限制单词边界时仍然是子串匹配
+    assert AhoCorasick(["ota"]).search("getnotarized") == ["ota"]
+    assert AhoCorasick(["ota"]).search("getnotarized", whole_words=True) == []
+    assert AhoCorasick(["ota", "otacheck"]).search("x otacheck-v2", whole_words=True) == []
+
+
+def test_two_tier_filter_makes_the_legacy_decisions(matcher):
+    texts = fixed_inputs()
+    flags, stats = TwoTierKeywordFilter(KEYWORDS, matcher).filter_batch(texts)
+    assert flags == [legacy_check_partial_keywords(text, KEYWORDS) for text in texts]
+    assert stats["exact_accept"] > 0
@@ -0,0 +1,85 @@
+import json
+import pytest
+from utils.link_extractor import LinkExtractor, extract_links, base_url, parse_body
+
+REQUEST_URL = "http://ota.example.com/api/v2/check?sn=1&model=x"
+
+
+@pytest.mark.parametrize("content", [
+    {"code": 0, "data": {"url": "https://cdn.example.com/fw/v1.2.bin", "md5": "abc"}},
+    json.dumps({"code": 0, "data": {"url": "https://cdn.example.com/fw/v1.2.bin", "md5": "abc"}}),
+    # python 字面量形式的 json
+    "{'code': 0, 'data': {'url': 'https://cdn.example.com/fw/v1.2.bin', 'md5': 'abc'}}",
+    b'{"data": [{"url": "https://cdn.example.com/fw/v1.2.bin"}]}',
+])
+def test_json_bodies(content):
+    assert extract_links(content, REQUEST_URL) == (["https://cdn.example.com/fw/v1.2.bin"], False)
+
+
+def test_json_links_keep_order_and_are_deduplicated():
+    body = {"list": [{"url": "http://a.com/2.bin."}, {"url": "http://a.com/1.bin"}, {"mirror": "http://a.com/2.bin"}],
+            "note": "see http://a.com/notes.txt; or http://a.com/1.bin"}
+    assert extract_links(body)[0] == ["http://a.com/2.bin", "http://a.com/1.bin", "http://a.com/notes.txt"]
+
+
+def test_xml_bodies_include_text_and_attributes():
+    body = ('<?xml version="1.0"?><update><firmware href="https://cdn.example.com/a.img" version="1.0"/>'
+            '<file>images/b.bin</file><size>1024</size></update>')
+    assert extract_links(body, REQUEST_URL) == (
+        ["https://cdn.example.com/a.img", "http://ota.example.com/api/v2/images/b.bin"], False)
+
+
+def test_text_bodies():
+    body = "new version 1.2.3 available: https://cdn.example.com/fw.zip, patch: patch_1.2.3.bin\nfirmware.example.com"
+    assert extract_links(body, REQUEST_URL) == (
+        ["https://cdn.example.com/fw.zip", "http://ota.example.com/api/v2/patch_1.2.3.bin"], False)
+    # 没有请求地址时无法拼接文件名
+    assert extract_links(body) == (["https://cdn.example.com/fw.zip"], False)
+    # html 页面不按 xml 解析
+    assert parse_body("<!DOCTYPE html><html><body>x</body></html>")[0] == "text"
+
+
+@pytest.mark.parametrize("request_url, name, expected", [
+    (REQUEST_URL, "fw_v2.bin", "http://ota.example.com/api/v2/fw_v2.bin"),
+    (REQUEST_URL, "/files/fw_v2.bin", "http://ota.example.com/api/v2/files/fw_v2.bin"),
+    ("https://host.com/check", "dir/fw.tar.gz", "https://host.com/dir/fw.tar.gz"),
+    ("https://host.com", "fw.hex", "https://host.com/fw.hex"),
+])
+def test_relative_file_names_are_joined_onto_the_base_url(request_url, name, expected):
+    assert extract_links({"file": name}, request_url) == ([expected], False)
+
+
+def test_base_url():
+    assert base_url(REQUEST_URL) == "http://ota.example.com/api/v2"
+    assert base_url("not a url") == ""
+    assert base_url("http://[::1") == ""
+
+
+def test_version_numbers_and_domains_are_not_file_names():
+    assert extract_links({"version": "1.2.3", "size": 10}, REQUEST_URL) == ([], False)
+    # 域名不是文件名, 但可能是链接, 交给LLM判断
+    assert extract_links({"version": "1.2.3", "host": "firmware.example.com"}, REQUEST_URL) == ([], True)
+
+
+def test_maybe_link_values_fall_back_to_the_llm():
+    extractor = LinkExtractor()
+    # 像路径但不是已知的链接或文件名
+    assert extract_links({"path": "/download/latest"}, REQUEST_URL) == ([], True)
+    assert extractor.extract({"status_code": 200, "content": {"path": "/download/latest"}}, REQUEST_URL) == ([], True)
+    assert extractor.extract({"status_code": 200, "content": {"file": "fw.bin"}}, REQUEST_URL) == (
+        ["http://ota.example.com/api/v2/fw.bin"], False)
+    assert extractor.extract({"status_code": 200, "content": {"code": 0, "msg": "latest"}}, REQUEST_URL) == ([], False)
+    # 出错的响应不送入LLM
+    assert extractor.extract({"status_code": 500, "content": {"path": "/download"}}, REQUEST_URL) == ([], False)
+    assert extractor.extract({"error": "timeout", "content": None}, REQUEST_URL) == ([], False)
+    assert extractor.summary() == {"llm_fallback": 1, "extracted": 1, "empty": 3, "llm_calls_avoided": 4}
+
+
+def test_text_bodies_never_fall_back_to_the_llm():
+    assert extract_links("see /download/latest for details", REQUEST_URL) == ([], False)
+
+
+def test_disabled_extractor_always_asks_the_llm():
+    extractor = LinkExtractor(enabled=False)
+    assert extractor.extract({"url": "http://a.com/fw.bin"}) == ([], True)
+    assert extractor.summary() == {"llm_calls_avoided": 0}
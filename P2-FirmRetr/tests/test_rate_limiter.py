@@ -0,0 +1,178 @@
+import asyncio
+from types import SimpleNamespace
+from email.utils import format_datetime
+from datetime import datetime, timezone
+import pytest
+from utils import rate_limiter
+from utils.rate_limiter import TokenBucket, AdaptiveRateLimiter, get_retry_after
+
+
+class FakeClock:
+    # 替换 rate_limiter 中的 time 模块: sleep 只推进时间并记录等待的秒数
+    def __init__(self, start=1000.0):
+        self.now = start
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(rate_limiter, "time", clock)
+    # 没有 Retry-After 时的随机抖动固定为 0
+    monkeypatch.setattr(rate_limiter, "random", SimpleNamespace(uniform=lambda a, b: 0))
+    return clock
+
+
+def rate_limit_error(headers=None):
+    return SimpleNamespace(status_code=429, response=SimpleNamespace(headers=headers or {}))
+
+
+def test_token_bucket_refills_at_the_configured_rate(clock):
+    bucket = TokenBucket(60)
+    assert bucket.capacity == 10
+    # 满桶可以突发 capacity 个请求, 之后按每秒 1 个透支
+    assert [bucket.reserve(1, clock.now) for _ in range(10)] == [0] * 10
+    assert bucket.reserve(1, clock.now) == pytest.approx(1)
+    assert bucket.reserve(1, clock.now) == pytest.approx(2)
+    clock.advance(2)
+    assert bucket.reserve(1, clock.now) == pytest.approx(1)
+    # 空闲再久也不会超过桶容量
+    clock.advance(3600)
+    assert [bucket.reserve(1, clock.now) for _ in range(10)] == [0] * 10
+    assert bucket.reserve(1, clock.now) == pytest.approx(1)
+
+
+def test_token_bucket_adjust_refunds_unused_tokens(clock):
+    bucket = TokenBucket(600)
+    assert bucket.reserve(150, clock.now) == pytest.approx(5)
+    bucket.adjust(-100, clock.now)
+    assert bucket.reserve(0, clock.now) == 0
+    assert TokenBucket(0).reserve(10 ** 9, clock.now) == 0
+
+
+def test_acquire_sleeps_until_the_bucket_has_tokens(clock):
+    limiter = AdaptiveRateLimiter(rpm=60)
+    for _ in range(11):
+        limiter.release(limiter.acquire())
+    assert clock.sleeps == [pytest.approx(1)]
+    assert limiter.snapshot()["throttled"] == 1
+
+
+@pytest.mark.parametrize("headers, expected", [
+    ({"retry-after": "7"}, 7),
+    ({"retry-after-ms": "1500", "retry-after": "7"}, 1.5),
+    ({"retry-after": format_datetime(datetime.fromtimestamp(1030, timezone.utc), usegmt=True)}, 30),
+    ({"retry-after": "-3"}, 0),
+    ({"retry-after": "soon"}, None),
+    ({}, None),
+])
+def test_retry_after_header_formats(clock, headers, expected):
+    assert get_retry_after(rate_limit_error(headers)) == expected
+    assert get_retry_after(SimpleNamespace()) is None
+
+
+@pytest.mark.parametrize("headers, delay", [
+    ({"retry-after": "7"}, 7),
+    ({"retry-after-ms": "2500"}, 2.5),
+    ({"retry-after": format_datetime(datetime.fromtimestamp(1012, timezone.utc), usegmt=True)}, 12),
+])
+def test_rate_limit_pauses_new_requests_for_retry_after(clock, headers, delay):
+    limiter = AdaptiveRateLimiter(max_concurrency=8)
+    limiter.release(limiter.acquire(), error=rate_limit_error(headers))
+    limiter.release(limiter.acquire())
+    assert clock.sleeps == [pytest.approx(delay)]
+    stats = limiter.snapshot()
+    assert stats["rate_limited"] == 1 and stats["retry_after"] == 1
+
+
+def test_rate_limit_backs_off_exponentially_and_recovers(clock):
+    limiter = AdaptiveRateLimiter(max_concurrency=8)
+    for _ in range(3):
+        limiter.release(limiter.acquire(), error=rate_limit_error())
+    # 没有 Retry-After: 1, 2, 4 秒
+    assert clock.sleeps == [pytest.approx(1), pytest.approx(2)]
+    assert limiter._blocked_until == pytest.approx(clock.now + 4)
+    # 冷却时间内只减小一次
+    assert limiter.concurrency == 4
+
+    clock.advance(rate_limiter.DECREASE_COOLDOWN)
+    limiter.release(limiter.acquire(), error=rate_limit_error())
+    assert limiter.concurrency == 2
+
+    # 请求成功后退避重新从 1 秒开始, 并发上限加性恢复
+    clock.advance(60)
+    limiter.release(limiter.acquire())
+    assert limiter.concurrency == pytest.approx(2.5)
+    clock.sleeps.clear()
+    limiter.release(limiter.acquire(), error=rate_limit_error())
+    limiter.release(limiter.acquire())
+    assert clock.sleeps == [pytest.approx(1)]
+    for _ in range(100):
+        limiter.release(limiter.acquire())
+    assert limiter.concurrency == 8
+
+
+def test_interrupted_throttle_wait_returns_the_slot(clock, monkeypatch):
+    limiter = AdaptiveRateLimiter(max_concurrency=1)
+    limiter.release(limiter.acquire(), error=rate_limit_error({"retry-after": "30"}))
+
+    def interrupted(seconds):
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(clock, "sleep", interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        limiter.acquire()
+    assert limiter.snapshot()["in_flight"] == 0
+
+
+def test_cancelled_waiter_releases_its_slot(clock):
+    async def scenario():
+        limiter = AdaptiveRateLimiter(max_concurrency=1)
+        holder = await limiter.aacquire()
+        waiter = asyncio.create_task(limiter.aacquire())
+        await asyncio.sleep(0)
+        assert len(limiter._async_waiters) == 1
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert limiter._async_waiters == []
+        limiter.release(holder)
+        # 被取消的等待者没有占用并发, 新的请求可以立即获得
+        ticket = await asyncio.wait_for(limiter.aacquire(), 1)
+        limiter.release(ticket)
+        return limiter.snapshot()["in_flight"]
+
+    assert asyncio.run(scenario()) == 0
+
+
+def test_cancelled_waiter_passes_its_wakeup_on(clock):
+    async def scenario():
+        limiter = AdaptiveRateLimiter(max_concurrency=1)
+        holder = await limiter.aacquire()
+        first = asyncio.create_task(limiter.aacquire())
+        second = asyncio.create_task(limiter.aacquire())
+        await asyncio.sleep(0)
+        # 唤醒 first 后、first 还没有运行时取消它, 这次唤醒要交给 second
+        limiter.release(holder)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        ticket = await asyncio.wait_for(second, 1)
+        assert limiter.snapshot()["in_flight"] == 1
+        limiter.release(ticket)
+        return limiter.snapshot()["in_flight"]
+
+    assert asyncio.run(scenario()) == 0
@@ -0,0 +1,101 @@
+import json
+import base64
+import random
+import pytest
+from utils.response_compactor import (ResponseCompactor, compact_json, compact_response, fit_token_budget,
+                                      TRUNCATED)
+
+BLOB = base64.b64encode(bytes(range(256)) * 2).decode()
+
+
+def count_tokens(text):
+    # 代替 tokenizer: 每 4 个字符 1 个 token, 向上取整
+    return (len(text) + 3) // 4
+
+
+def count_tokens_batch(texts):
+    return [count_tokens(text) for text in texts]
+
+
+def firmware_response(items=50):
+    return {"code": 0, "msg": "success", "token": BLOB,
+            "data": {"list": [{"id": index, "name": f"model-{index}", "version": f"1.{index}",
+                               "md5": "d41d8cd98f00b204e9800998ecf8427e", "icon": BLOB,
+                               "downloadUrl": f"https://cdn.example.com/fw/{index}.bin",
+                               "description": "release notes " * 40}
+                              for index in range(items)],
+                     "banner": BLOB, "config": {"theme": "dark", "retry": 3}}}
+
+
+@pytest.mark.parametrize("budget", [1, 5, 17, 64, 100, 333, 1000])
+def test_fit_token_budget_never_exceeds_the_budget(budget):
+    rng = random.Random(budget)
+    for _ in range(20):
+        text = "".join(rng.choice("abc /:.\n") for _ in range(rng.randint(0, 6000)))
+        fitted, tokens, truncated = fit_token_budget(text, budget, count_tokens)
+        assert tokens == count_tokens(fitted) <= budget
+        assert truncated == (count_tokens(text) > budget)
+        if truncated and fitted:
+            assert fitted.endswith(TRUNCATED) and text.startswith(fitted[:-len(TRUNCATED)])
+        else:
+            assert fitted in (text, "")
+
+
+def test_fit_token_budget_keeps_text_within_budget_unchanged():
+    assert fit_token_budget("x" * 40, 10, count_tokens) == ("x" * 40, 10, False)
+    assert fit_token_budget("", 0, count_tokens) == ("", 0, False)
+
+
+def test_link_fields_and_their_context_survive():
+    compacted, relevant = compact_json(firmware_response())
+    assert relevant
+    items = compacted["data"]["list"]
+    assert len(items) == 21 and items[-1] == "<30 more items>"
+    assert items[3]["downloadUrl"] == "https://cdn.example.com/fw/3.bin"
+    # 与链接同一层的版本号和校验值原样保留
+    assert items[3]["version"] == "1.3" and items[3]["md5"] == "d41d8cd98f00b204e9800998ecf8427e"
+    # 骨架之外的无关字段直接丢弃
+    assert "description" not in items[3] and "icon" not in items[3]
+
+
+def test_link_shaped_values_survive_under_any_key():
+    body = {"a": {"b": {"c": {"d": {"e": "firmware_v2.img"}}}}, "x": "http://example.com/" + "p" * 400}
+    compacted, relevant = compact_json(body)
+    assert relevant
+    assert compacted["a"]["b"]["c"]["d"]["e"] == "firmware_v2.img"
+    # URL 不截断
+    assert compacted["x"] == body["x"]
+
+
+def test_base64_blobs_become_placeholders():
+    body = firmware_response(items=2)
+    compacted, _ = compact_json(body)
+    assert compacted["token"] == f"<base64 {len(BLOB)} chars>"
+    assert compacted["data"]["banner"] == f"<base64 {len(BLOB)} chars>"
+    # 字段名像链接也不保留 base64 内容
+    assert compact_json({"file": BLOB}) == ({"file": f"<base64 {len(BLOB)} chars>"}, False)
+    assert BLOB not in json.dumps(compacted)
+
+
+def test_bodies_without_links_keep_only_a_skeleton():
+    compacted, relevant = compact_json({"code": 0, "msg": "no update", "data": [{"id": 1}, {"id": 2}, {"id": 3}]})
+    assert not relevant
+    assert compacted == {"code": 0, "msg": "<str 9>", "data": [{"id": 1}, "<2 more items>"]}
+
+
+@pytest.mark.parametrize("budget", [50, 200, 1000])
+def test_compactor_stays_within_budget_and_keeps_the_first_links(budget):
+    compactor = ResponseCompactor(budget=budget)
+    res = {"status_code": 200, "content": json.dumps(firmware_response())}
+    text, info = compactor.compact(res, count_tokens_batch)
+    assert info["compact_tokens"] == count_tokens(text) <= budget
+    assert info["raw_tokens"] > budget and info["truncated"] == (count_tokens(compact_response(res)) > budget)
+    assert text.startswith('{"status_code": 200}\ncontent: ')
+    if budget >= 200:
+        assert "https://cdn.example.com/fw/0.bin" in text
+    assert compactor.summary()["truncated"] == int(info["truncated"])
+
+
+def test_zero_budget_sends_the_raw_response():
+    res = {"status_code": 200, "content": {"url": "http://a.com/fw.bin"}}
+    assert ResponseCompactor(budget=0).compact(res, count_tokens_batch) == (str(res), None)
@@ -0,0 +1,113 @@
+import math
+import json
+import random
+from collections import Counter
+import pytest
+from utils.stopping_policy import (ConsistencyEntropyPolicy, DirichletPolicy, SPRTPolicy, get_stopping_policy,
+                                   load_vote_sequences, replay, simulate)
+
+
+def old_rule_rounds(votes, initial_rounds=5, max_rounds=10):
+    # 原来的 dynamic_multi_round_voting: 先投 initial_rounds 票, 之后每一票都检查一致性 >= 0.8 且熵 <= 0.5
+    for rounds in range(initial_rounds, min(len(votes), max_rounds) + 1):
+        counter = Counter(votes[:rounds])
+        consistency = counter.most_common(1)[0][1] / rounds
+        entropy = -sum(count / rounds * math.log(count / rounds) for count in counter.values())
+        if consistency >= 0.8 and entropy <= 0.5:
+            return rounds
+    return len(votes)
+
+
+def random_sequences(count=500, seed=3):
+    rng = random.Random(seed)
+    sequences = []
+    for _ in range(count):
+        bias = rng.random()
+        sequences.append(["0" if rng.random() < bias else rng.choice("123") for _ in range(10)])
+    return sequences
+
+
+def test_sprt_stops_on_three_unanimous_votes_but_not_two():
+    policy = SPRTPolicy()
+    assert not policy.should_stop(["1", "1"])
+    assert policy.should_stop(["1", "1", "1"])
+    assert replay(["1", "1", "1", "0", "0"], policy) == (3, "1", False)
+    # 一票不一致后需要更多一致的票
+    assert not policy.should_stop(["1", "1", "1", "0"])
+    assert policy.should_stop(["1", "1", "1", "1", "0"])
+
+
+def test_consistency_policy_reproduces_the_old_rule_on_replay():
+    policy = get_stopping_policy("consistency")
+    assert policy.min_rounds == 5
+    for votes in random_sequences():
+        rounds, label, exhausted = replay(votes, policy)
+        assert rounds == old_rule_rounds(votes)
+        assert label == Counter(votes[:rounds]).most_common(1)[0][0]
+        assert not exhausted
+
+
+def test_consistency_policy_needs_more_than_four_of_five():
+    # 4:1 的一致性为 0.8, 但熵 0.5004 超过阈值
+    policy = ConsistencyEntropyPolicy()
+    assert not policy.should_stop(["0", "0", "0", "0", "1"])
+    assert policy.should_stop(["0"] * 5)
+    # 5:1 时一致性 0.83, 熵 0.45
+    assert replay(["0", "0", "0", "0", "1", "0", "0", "0", "0", "0"], policy)[0] == 6
+
+
+def test_dirichlet_posterior_is_deterministic_and_tracks_agreement():
+    policy = DirichletPolicy()
+    assert policy.posterior(["2", "2", "2"]) == DirichletPolicy().posterior(["0", "0", "0"])
+    assert policy.posterior(["0", "1"]) < policy.posterior(["0", "0", "1"]) < policy.posterior(["0", "0"])
+    assert not policy.should_stop(["0", "0"])
+    assert policy.should_stop(["0", "0", "0"])
+    assert not policy.should_stop(["0", "0", "1", "1"])
+    assert replay(["3", "0", "3", "3", "3", "3"], policy) == (6, "3", False)
+
+
+def test_replay_reports_sequences_that_run_out_of_votes():
+    policy = SPRTPolicy()
+    assert replay(["0", "1"], policy) == (2, "0", True)
+    # 达到 max_rounds 仍未终止不算用完
+    assert replay(["0", "1"] * 5, policy, max_rounds=10) == (10, "0", False)
+
+
+def test_simulate_compares_votes_tokens_and_labels():
+    sequences = [
+        {"votes": ["1"] * 5, "tokens": [10] * 5},
+        {"votes": ["0", "1", "1", "1", "1", "0"], "tokens": [10, 10, 10]},
+        {"votes": ["2", "3"], "tokens": []},
+    ]
+    report = simulate(sequences, [SPRTPolicy(), ConsistencyEntropyPolicy()])
+    sprt = report["sprt"]
+    assert sprt["votes"] == 3 + 5 + 2
+    # 缺少的 token 记录按该序列的平均值 10 估计
+    assert sprt["tokens"] == 30 + 50 + 0
+    assert sprt["token_saving"] == 0
+    assert sprt["vote_saving"] == pytest.approx(1 - 10 / 13, abs=1e-4)
+    assert sprt["label_agreement"] == 1.0 and sprt["exhausted"] == 1
+    consistency = report["consistency"]
+    assert consistency["votes"] == 13 and consistency["exhausted"] == 2
+    assert simulate([], [SPRTPolicy()])["sprt"]["avg_votes"] == 0
+
+
+def test_get_stopping_policy_rejects_unknown_names():
+    assert isinstance(get_stopping_policy("sprt", p1=0.8), SPRTPolicy)
+    with pytest.raises(ValueError):
+        get_stopping_policy("majority")
+
+
+def test_load_vote_sequences_prefers_vote_sequence_records(tmp_path):
+    record = {"app": "a", "votes": ["0", "0", "0"], "tokens": [5, 6, 7]}
+    logged = tmp_path / "new.log"
+    logged.write_text(f"{{MainThread}} [INFO]: predictions: ['0']\n"
+                      f"2024 [INFO]: vote sequence: {json.dumps(record)}\n", encoding="utf-8")
+    legacy = tmp_path / "old.log"
+    legacy.write_text("{T1} [INFO]: predictions: ['1']\n"
+                      "{T1} [INFO]: used token: 11 (input_tokens: 8,output_tokens: 3)\n"
+                      "{T1} [INFO]: predictions: ['1', '2']\n"
+                      "{T1} [INFO]: used token: 12 (input_tokens: 8,output_tokens: 4)\n"
+                      "{T1} [INFO]: predictions: ['3']\n", encoding="utf-8")
+    assert load_vote_sequences([str(logged), str(legacy)]) == [
+        record, {"votes": ["1", "2"], "tokens": [11, 12]}, {"votes": ["3"], "tokens": []}]
@@ -0,0 +1,252 @@
+import os
+import json
+import time
+import sqlite3
+import asyncio
+import argparse
+import threading
+import functools
+import contextvars
+from collections import defaultdict
+from utils.utils import update_stats_file
+
+# 当前app的统计累加器, 线程(work_queue 会复制上下文)和asyncio任务各自继承调用方的作用域
+_current_stats = contextvars.ContextVar("app_stats", default=None)
+
+
+class AppStats:
+    """
+    单个app在一个阶段内的统计累加器, 只在内存中累加, 处理完该app后一次性写入 firmproj_stats.json
+    键名与 save_llm_phase_time / save_llm_usage / save_llm_stats 保持一致:
+    {stage}_times, {stage}_tokens, {stage}_stats
+    """
+
+    def __init__(self, stats_path, app_name="", dataset="", phase=""):
+        self.stats_path = stats_path
+        self.app_name = app_name
+        self.dataset = dataset
+        self.phase = phase
+        self.data = {}
+        self._lock = threading.Lock()
+
+    def _add(self, key, value):
+        with self._lock:
+            self.data[key] = self.data.get(key, 0) + value
+
+    def add_time(self, stage, seconds):
+        self._add(f"{stage}_times", seconds)
+
+    def add_usage(self, stage, tokens):
+        self._add(f"{stage}_tokens", tokens)
+
+    def set_time(self, stage, seconds):
+        with self._lock:
+            self.data[f"{stage}_times"] = seconds
+
+    def add_count(self, stage, name, count=1):
+        # {stage}_stats 中的计数项
+        with self._lock:
+            stats = self.data.setdefault(f"{stage}_stats", {})
+            stats[name] = stats.get(name, 0) + count
+
+    def set_stats(self, stage, stats: dict):
+        with self._lock:
+            self.data[f"{stage}_stats"] = dict(stats)
+
+    def flush(self):
+        """
+        合并进已有的 firmproj_stats.json (临时文件 + rename, 不会写出半个文件), 并追加到全局的指标存储
+        app 的结果目录不存在时(没有任何产出)只追加指标存储
+        """
+        with self._lock:
+            data = dict(self.data)
+        if not data:
+            return
+        if os.path.exists(os.path.dirname(self.stats_path)):
+            update_stats_file(self.stats_path, data)
+        if metrics_store is not None:
+            metrics_store.append({
+                "time": time.time(),
+                "dataset": self.dataset,
+                "app": self.app_name,
+                "phase": self.phase,
+                "stats": data,
+            })
+
+
+def current_app_stats():
+    # 当前作用域的 AppStats, 不在 record_app_stats 作用域内时返回 None
+    return _current_stats.get()
+
+
+def record_app_stats(phase, stats_root):
+    """
+    装饰 func(app_name, dataset), 为该app创建 AppStats 作用域, 函数返回(或抛出异常)后统一写入一次
+    支持同步函数和 async 函数, 需要放在 record_cache_stats 外层, 缓存统计才会一起写入
+    """
+    def create(app_name, dataset):
+        stats_path = os.path.join(stats_root, dataset, app_name, "firmproj_stats.json")
+        return AppStats(stats_path, app_name, dataset, phase)
+
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(app_name, dataset, *args, **kwargs):
+                stats = create(app_name, dataset)
+                token = _current_stats.set(stats)
+                try:
+                    return await func(app_name, dataset, *args, **kwargs)
+                finally:
+                    _current_stats.reset(token)
+                    stats.flush()
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(app_name, dataset, *args, **kwargs):
+            stats = create(app_name, dataset)
+            token = _current_stats.set(stats)
+            try:
+                return func(app_name, dataset, *args, **kwargs)
+            finally:
+                _current_stats.reset(token)
+                stats.flush()
+        return wrapper
+    return decorator
+
+
+class JsonlMetricsStore:
+    """
+    全局的 JSONL 指标存储, 每个app每个阶段追加一行
+    每行一次 write 并立即 flush, 多个进程以追加模式写同一个文件也不会交错
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = None
+        self._pid = None
+
+    def append(self, record):
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._lock:
+            # fork 出的子进程重新打开文件
+            if self._file is None or self._pid != os.getpid():
+                self._file = open(self.path, "a", encoding="utf-8")
+                self._pid = os.getpid()
+            self._file.write(line)
+            self._file.flush()
+
+    def records(self):
+        with open(self.path, "r", encoding="utf-8") as file:
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None and self._pid == os.getpid():
+                self._file.close()
+            self._file = None
+
+
+class SqliteMetricsStore:
+    """
+    全局的 SQLite 指标存储, 表 metrics(time, dataset, app, phase, stats)
+    stats 为 JSON 文本, 可以用 json_extract 直接聚合
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+
+    def _connect(self):
+        # 连接不能跨 fork 使用, 子进程重新连接
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS metrics ("
+                "time REAL NOT NULL, dataset TEXT, app TEXT, phase TEXT, stats TEXT NOT NULL)"
+            )
+            self._conn.commit()
+            self._pid = os.getpid()
+        return self._conn
+
+    def append(self, record):
+        with self._lock:
+            conn = self._connect()
+            conn.execute("INSERT INTO metrics (time, dataset, app, phase, stats) VALUES (?, ?, ?, ?, ?)",
+                         (record["time"], record["dataset"], record["app"], record["phase"],
+                          json.dumps(record["stats"], ensure_ascii=False)))
+            conn.commit()
+
+    def records(self):
+        with self._lock:
+            rows = self._connect().execute("SELECT time, dataset, app, phase, stats FROM metrics ORDER BY time").fetchall()
+        for row_time, dataset, app, phase, stats in rows:
+            yield {"time": row_time, "dataset": dataset, "app": app, "phase": phase, "stats": json.loads(stats)}
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None and self._pid == os.getpid():
+                self._conn.close()
+            self._conn = None
+
+
+metrics_store = None
+
+
+def open_metrics_store(path):
+    # 按后缀选择存储格式: .sqlite/.db 为 SQLite, 其他为 JSONL
+    store_dir = os.path.dirname(path)
+    if store_dir and not os.path.exists(store_dir):
+        os.makedirs(store_dir, exist_ok=True)
+    if path.endswith((".sqlite", ".db")):
+        return SqliteMetricsStore(path)
+    return JsonlMetricsStore(path)
+
+
+def setup_metrics_store(args):
+    # 根据命令行参数(add_stats_args)开启全局指标存储
+    global metrics_store
+    if getattr(args, "metrics_store", None):
+        metrics_store = open_metrics_store(args.metrics_store)
+    return metrics_store
+
+
+def add_stats_args(parser):
+    parser.add_argument("--metrics-store", default=None,
+                        help="run-wide metrics store, one record per app (.jsonl, or .sqlite/.db)")
+
+
+def summarize(records):
+    """
+    按 (dataset, phase) 汇总各个app的数值型统计, 嵌套的 *_stats 字典逐项求和
+    """
+    summary = defaultdict(lambda: {"apps": 0})
+    for record in records:
+        totals = summary[(record["dataset"], record["phase"])]
+        totals["apps"] += 1
+        for key, value in record["stats"].items():
+            if isinstance(value, dict):
+                nested = totals.setdefault(key, {})
+                for name, count in value.items():
+                    if isinstance(count, (int, float)):
+                        nested[name] = nested.get(name, 0) + count
+            elif isinstance(value, (int, float)):
+                totals[key] = totals.get(key, 0) + value
+    return dict(summary)
+
+
+if __name__ == "__main__":
+    # 汇总全局指标存储: python3 -m utils.app_stats /data/firmproj/result/metrics.jsonl
+    parser = argparse.ArgumentParser(description="aggregate per-app stats from a run-wide metrics store")
+    parser.add_argument("path", help="metrics store (.jsonl, or .sqlite/.db)")
+    args = parser.parse_args()
+
+    store = open_metrics_store(args.path)
+    for (dataset, phase), totals in summarize(store.records()).items():
+        print(f"{dataset} {phase}: {json.dumps(totals, ensure_ascii=False)}")
+    store.close()
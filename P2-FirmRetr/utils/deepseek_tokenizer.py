@@ -1,23 +1,58 @@
 # pip3 install transformers
 # python3 deepseek_tokenizer.py
+import os
+import threading
 import transformers
 
+# tokenizer 文件与本文件放在同一目录下
+chat_tokenizer_dir = os.path.dirname(os.path.abspath(__file__))
+
+# 进程内共享的 tokenizer, 只在第一次使用时从磁盘加载
+_tokenizer = None
+_tokenizer_lock = threading.Lock()
+
+
+def get_tokenizer():
+        """
+        获取进程内共享的 tokenizer (懒加载, 线程安全)
+        """
+        global _tokenizer
+        if _tokenizer is None:
+                with _tokenizer_lock:
+                        # 双重检查, 避免多个线程同时加载
+                        if _tokenizer is None:
+                                _tokenizer = transformers.AutoTokenizer.from_pretrained(
+                                        chat_tokenizer_dir, trust_remote_code=True
+                                        )
+        return _tokenizer
+
+
 def count_tokens(content: str):
 
-        chat_tokenizer_dir = "/data/guoxb/firmproj-llm/utils"
+        return count_tokens_batch([content])[0]
+
+
+def count_tokens_batch(contents: list[str]) -> list[int]:
+        """
+        批量统计 token 数量, 使用 fast tokenizer 的批量编码
+        返回值与 contents 一一对应
+        """
+        if not contents:
+                return []
 
-        tokenizer = transformers.AutoTokenizer.from_pretrained( 
-                chat_tokenizer_dir, trust_remote_code=True
-                )
-        
-        result = tokenizer.encode(content)
-        token_length = len(result)
+        tokenizer = get_tokenizer()
+        # fast tokenizer 在多线程下并发调用同一个实例可能会出现 "Already borrowed" 错误,
+        # 这里加锁串行化, 批量编码内部本身是多线程的
+        with _tokenizer_lock:
+                result = tokenizer(contents, add_special_tokens=True)["input_ids"]
 
-        return token_length
+        return [len(ids) for ids in result]
 
 
 if __name__ == "__main__":
 
         content = "Hello, world!"
         token_length = count_tokens(content)
-        print(f"The length of the token is {token_length}")
\ No newline at end of file
+        print(f"The length of the token is {token_length}")
+        token_lengths = count_tokens_batch([content, "firmware update", ""])
+        print(f"The length of the tokens are {token_lengths}")
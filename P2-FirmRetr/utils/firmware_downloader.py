@@ -0,0 +1,436 @@
+import os
+import re
+import json
+import time
+import shutil
+import sqlite3
+import hashlib
+import argparse
+import threading
+from collections import Counter
+from urllib.parse import urlsplit, unquote
+import httpx
+from utils.url_dedup import canonicalize_url
+from utils.http_engine import TEXT_CONTENT_TYPES
+from utils.firmware_sniffer import SNIFF_BYTES, sniff, is_text_verdict
+
+_disposition_filename = re.compile(r"filename\*?=(?:UTF-8'')?\"?([^\";]+)\"?", re.IGNORECASE)
+_unsafe_filename = re.compile(r"[^\w.@+-]")
+_content_range = re.compile(r"bytes\s+(\d+)-(\d+)/(\d+|\*)", re.IGNORECASE)
+
+
+class DownloadError(Exception):
+    pass
+
+
+class RangeRestart(DownloadError):
+    # 断点续传失败, 需要从头下载
+    pass
+
+
+class NotFirmware(DownloadError):
+    # 开头的字节表明不是固件, 下载已取消; 文本类内容附带在 content 中
+    def __init__(self, verdict, content=None):
+        super().__init__(f"not firmware: {verdict.label}")
+        self.verdict = verdict
+        self.content = content
+
+
+def filename_for(url, headers):
+    # Content-Disposition 中的文件名, 其次为URL路径的最后一级, 去掉不安全的字符
+    match = _disposition_filename.search(headers.get("content-disposition", ""))
+    name = unquote(match.group(1)) if match else unquote(os.path.basename(urlsplit(url).path))
+    name = _unsafe_filename.sub("_", os.path.basename(name)).strip("._")
+    return name[:200] or "download"
+
+
+class FirmwareStore:
+    """
+    按内容去重的固件存储: {root}/objects/{sha256[:2]}/{sha256} 每个镜像只保存一份, 再硬链接到各app的结果目录
+    {root}/partial/ 保存未完成的下载(可用 Range 续传), {root}/index.sqlite 记录镜像和来源URL
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.partial_dir = os.path.join(root, "partial")
+        os.makedirs(self.partial_dir, exist_ok=True)
+        os.makedirs(os.path.join(root, "objects"), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(root, "index.sqlite"), timeout=60, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS images (sha256 TEXT PRIMARY KEY, size INTEGER, updated REAL NOT NULL)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sources ("
+            "url TEXT NOT NULL, sha256 TEXT NOT NULL, app TEXT, dataset TEXT, path TEXT, updated REAL NOT NULL, "
+            "PRIMARY KEY (url, app, dataset))"
+        )
+        self._conn.commit()
+
+    def partial_path(self, url):
+        return os.path.join(self.partial_dir, hashlib.sha256(canonicalize_url(url).encode("utf-8")).hexdigest())
+
+    def object_path(self, sha256):
+        return os.path.join(self.root, "objects", sha256[:2], sha256)
+
+    def commit(self, part_path, sha256, size):
+        """
+        完成的下载移入对象存储, 已有相同内容的镜像时丢弃本次下载, 返回 (对象路径, 是否为新镜像)
+        """
+        object_path = self.object_path(sha256)
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        try:
+            os.link(part_path, object_path)
+            created = True
+        except FileExistsError:
+            created = False
+        os.unlink(part_path)
+        meta_path = part_path + ".json"
+        if os.path.exists(meta_path):
+            os.unlink(meta_path)
+        with self._lock:
+            self._conn.execute("INSERT OR IGNORE INTO images (sha256, size, updated) VALUES (?, ?, ?)",
+                               (sha256, size, time.time()))
+            self._conn.commit()
+        return object_path, created
+
+    def link(self, object_path, target_dir, filename):
+        """
+        镜像硬链接到 target_dir/filename, 同名的不同文件加上序号; 跨文件系统无法硬链接时复制
+        """
+        os.makedirs(target_dir, exist_ok=True)
+        stem, ext = os.path.splitext(filename)
+        object_stat = os.stat(object_path)
+        for index in range(1000):
+            target = os.path.join(target_dir, filename if index == 0 else f"{stem}_{index}{ext}")
+            if os.path.exists(target):
+                if os.path.samefile(target, object_path):
+                    return target
+                target_stat = os.stat(target)
+                if target_stat.st_size == object_stat.st_size and self._same_content(target, object_path):
+                    return target
+                continue
+            try:
+                os.link(object_path, target)
+            except FileExistsError:
+                continue
+            except OSError:
+                shutil.copyfile(object_path, target)
+            return target
+        raise DownloadError(f"too many files named {filename} in {target_dir}")
+
+    @staticmethod
+    def _same_content(path, other, chunk_size=1 << 20):
+        with open(path, "rb") as file, open(other, "rb") as other_file:
+            while True:
+                chunk = file.read(chunk_size)
+                if chunk != other_file.read(chunk_size):
+                    return False
+                if not chunk:
+                    return True
+
+    def record_source(self, url, sha256, app_name, dataset, path):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO sources (url, sha256, app, dataset, path, updated) VALUES (?, ?, ?, ?, ?, ?)",
+                (canonicalize_url(url), sha256, app_name, dataset, path, time.time()))
+            self._conn.commit()
+
+    def find_source(self, url):
+        """
+        链接最近一次下载得到的镜像, 返回 (sha256, 大小, 文件路径), 没有时返回 None
+        """
+        with self._lock:
+            return self._conn.execute(
+                "SELECT sources.sha256, images.size, sources.path FROM sources "
+                "LEFT JOIN images ON images.sha256 = sources.sha256 "
+                "WHERE sources.url IN (?, ?) ORDER BY sources.updated DESC LIMIT 1",
+                (canonicalize_url(url), url)).fetchone()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class FirmwareDownloader:
+    """
+    流式固件下载: 按 chunk_size 分块写入磁盘(内存占用固定), 同时计算 SHA-256
+    中断的下载保存在 partial 目录, 之后(本次重试或下次运行)用 Range 请求从断点续传, ETag/Last-Modified 变化时重新下载
+    完成后按内容哈希去重存入 FirmwareStore, 并硬链接到 {result_root}/{dataset}/{app}/firmware/
+    从头下载时先检查前 sniff_bytes 字节(firmware_sniffer), html 登录页、json 错误信息、图片等立即取消, 不写入磁盘
+    """
+
+    def __init__(self, store, result_root, chunk_size=1 << 20, retries=3, connect_timeout=10, read_timeout=60,
+                 max_text=2 * 1024 * 1024, sniff_bytes=SNIFF_BYTES, verify=False):
+        self.store = store
+        self.result_root = result_root
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.max_text = max_text
+        self.sniff_bytes = sniff_bytes
+        self.stats = Counter()
+        self._lock = threading.Lock()
+        self._client = httpx.Client(
+            timeout=httpx.Timeout(None, connect=connect_timeout, read=read_timeout, write=read_timeout, pool=None),
+            limits=httpx.Limits(max_connections=64, max_keepalive_connections=32, keepalive_expiry=60),
+            follow_redirects=True, verify=verify)
+
+    def _count(self, name, value=1):
+        with self._lock:
+            self.stats[name] += value
+
+    @staticmethod
+    def _load_meta(part_path):
+        try:
+            with open(part_path + ".json", "r", encoding="utf-8") as file:
+                return json.load(file)
+        except (OSError, json.JSONDecodeError):
+            return {}
+
+    @staticmethod
+    def _save_meta(part_path, meta):
+        with open(part_path + ".json", "w", encoding="utf-8") as file:
+            json.dump(meta, file)
+
+    def _hash_existing(self, part_path):
+        # 续传时先对已下载的部分计算哈希, 分块读取
+        digest = hashlib.sha256()
+        with open(part_path, "rb") as file:
+            for chunk in iter(lambda: file.read(self.chunk_size), b""):
+                digest.update(chunk)
+        return digest
+
+    def _stream(self, url, part_path, meta):
+        """
+        下载到 part_path, 已有部分时发送 Range 请求续传; 返回 (sha256 digest, 大小, 响应头)
+        """
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        validator = meta.get("etag") or meta.get("last_modified")
+        if offset and not validator and not meta.get("length"):
+            # 没有 ETag/Last-Modified 也不知道文件大小, 无法确认服务器上的文件没有变化, 从头下载
+            offset = 0
+        headers = {}
+        if offset:
+            headers["Range"] = f"bytes={offset}-"
+            if validator:
+                headers["If-Range"] = validator
+        with self._client.stream("GET", url, headers=headers) as response:
+            if response.status_code == 416 and offset:
+                # 服务器认为请求的范围无效(文件变小或已完整), 从头下载
+                raise RangeRestart("range not satisfiable")
+            if response.status_code >= 400:
+                raise DownloadError(f"HTTP Error {response.status_code}")
+            if response.status_code == 206 and offset:
+                self._check_content_range(response, offset, meta)
+                digest = self._hash_existing(part_path)
+                mode = "ab"
+                self._count("resumed")
+            else:
+                # 不支持 Range 或内容已变化, 从头下载
+                digest, offset, mode = hashlib.sha256(), 0, "wb"
+                length = response.headers.get("content-length", "")
+                meta["length"] = int(length) if length.isdigit() else None
+            meta.update({"url": url, "etag": response.headers.get("etag"),
+                         "last_modified": response.headers.get("last-modified")})
+            self._save_meta(part_path, meta)
+            size = offset
+            # 从头下载时先缓存开头的字节, 确认可能是固件后再写入磁盘
+            head = bytearray() if offset == 0 and self.sniff_bytes else None
+            chunks = response.iter_bytes()
+            with open(part_path, mode) as file:
+                for chunk in chunks:
+                    if head is not None:
+                        head.extend(chunk)
+                        if len(head) < self.sniff_bytes:
+                            continue
+                        chunk, head = bytes(head), None
+                        self._check_head(chunk, response, chunks)
+                    file.write(chunk)
+                    digest.update(chunk)
+                    size += len(chunk)
+                if head:
+                    # 响应比嗅探窗口短
+                    chunk = bytes(head)
+                    self._check_head(chunk, response, chunks)
+                    file.write(chunk)
+                    digest.update(chunk)
+                    size += len(chunk)
+            if size == 0:
+                os.unlink(part_path)
+                raise DownloadError("empty response body")
+            self._count("bytes", size - offset)
+            return digest, size, response.headers
+
+    @staticmethod
+    def _check_content_range(response, offset, meta):
+        # 206 响应必须从 offset 开始, 且文件总大小与第一次下载时相同, 否则从头下载, 避免拼接出错误的镜像
+        content_range = response.headers.get("content-range", "").strip()
+        match = _content_range.match(content_range)
+        if match is None or int(match.group(1)) != offset:
+            raise RangeRestart(f"unexpected Content-Range {content_range!r} for offset {offset}")
+        if meta.get("length") and match.group(3) != "*" and int(match.group(3)) != meta["length"]:
+            raise RangeRestart(f"file size changed: {match.group(3)} != {meta['length']}")
+
+    def _check_head(self, head, response, chunks):
+        """
+        嗅探响应开头的字节, 不是固件时抛出 NotFirmware, 离开 stream 时连接被关闭, 剩余内容不再传输
+        文本类(json/xml/text)继续读取至多 max_text 字节作为 content 返回, 供下一层提取链接
+        """
+        verdict = sniff(head, response.headers.get("content-type", ""))
+        self._count(f"sniffed_{verdict.kind}")
+        if verdict.kind != "non_firmware":
+            return
+        content = None
+        received = len(head)
+        if is_text_verdict(verdict):
+            body = bytearray(head)
+            for chunk in chunks:
+                body.extend(chunk)
+                if len(body) > self.max_text:
+                    break
+            received = len(body)
+            if len(body) <= self.max_text:
+                content = self._parse_text(bytes(body))
+        length = response.headers.get("content-length", "")
+        if length.isdigit():
+            self._count("bytes_avoided", max(0, int(length) - received))
+        raise NotFirmware(verdict, content)
+
+    def download(self, url, app_name, dataset):
+        """
+        下载一个链接, 返回与 make_request_multi 相同格式的结果:
+        {"url", "status_code", "sha256", "size", "path", "content"}, 文本类文件的 content 为其内容(json 解析后), 出错时附带 "error"
+        嗅探确认不是固件而取消的下载只有 {"url", "status_code", "sniffed", "content"}, sniffed 为识别出的格式
+        """
+        part_path = self.store.partial_path(url)
+        meta = self._load_meta(part_path)
+        error = None
+        for attempt in range(self.retries + 1):
+            try:
+                digest, size, headers = self._stream(url, part_path, meta)
+                break
+            except RangeRestart as e:
+                error = str(e)
+                os.unlink(part_path)
+            except NotFirmware as e:
+                self._discard(part_path)
+                self._count("cancelled")
+                self._count(f"cancelled_{e.verdict.label}")
+                return {"url": url, "status_code": 200, "sniffed": e.verdict.label, "content": e.content}
+            except DownloadError as e:
+                return self._failed(url, str(e))
+            except (httpx.HTTPError, OSError) as e:
+                # 连接中断: 保留已下载的部分, 下一次尝试从断点续传
+                error = f"{type(e).__name__}: {e}"
+                self._count("interrupted")
+        else:
+            return self._failed(url, error)
+
+        sha256 = digest.hexdigest()
+        object_path, created = self.store.commit(part_path, sha256, size)
+        self._count("images" if created else "duplicate_images")
+        target = self.store.link(object_path, os.path.join(self.result_root, dataset, app_name or "", "firmware"),
+                                 filename_for(url, headers))
+        self.store.record_source(url, sha256, app_name, dataset, target)
+        self._count("downloaded")
+        return {"url": url, "status_code": 200, "sha256": sha256, "size": size, "path": target,
+                "content": self._text_content(target, headers, size)}
+
+    def link_existing(self, url, app_name, dataset):
+        """
+        其他app或之前的运行已经下载过的链接不再下载, 镜像直接硬链接到该app的 firmware 目录
+        没有对应的镜像(下载失败、不是固件或由原下载器下载)时返回 None
+        """
+        found = self.store.find_source(url)
+        if found is None:
+            return None
+        sha256, size, path = found
+        object_path = self.store.object_path(sha256)
+        if not os.path.exists(object_path):
+            return None
+        filename = os.path.basename(path) if path else filename_for(url, {})
+        target = self.store.link(object_path, os.path.join(self.result_root, dataset, app_name or "", "firmware"), filename)
+        self.store.record_source(url, sha256, app_name, dataset, target)
+        self._count("linked")
+        return {"url": url, "status_code": 200, "sha256": sha256, "size": size, "path": target, "content": None}
+
+    @staticmethod
+    def _discard(part_path):
+        for path in (part_path, part_path + ".json"):
+            if os.path.exists(path):
+                os.unlink(path)
+
+    def _text_content(self, path, headers, size):
+        # 文本类文件(升级描述、下载列表等)返回内容, 供下一层提取链接; 固件镜像不返回内容
+        content_type = headers.get("content-type", "").lower()
+        if not any(kind in content_type for kind in TEXT_CONTENT_TYPES) or size > self.max_text:
+            return None
+        with open(path, "rb") as file:
+            return self._parse_text(file.read())
+
+    @staticmethod
+    def _parse_text(data):
+        text = data.decode("utf-8", errors="replace")
+        try:
+            return json.loads(text)
+        except json.JSONDecodeError:
+            return text
+
+    def _failed(self, url, error):
+        self._count("failed")
+        return {"url": url, "error": error, "status_code": None, "content": None}
+
+    def download_all(self, urls, app_name=None, dataset=None):
+        return [self.download(url, app_name, dataset) for url in urls]
+
+    def summary(self):
+        with self._lock:
+            return dict(self.stats)
+
+    def close(self):
+        self._client.close()
+        self.store.close()
+
+
+firmware_downloader = None
+
+
+def setup_firmware_downloader(args, result_root):
+    # 根据命令行参数(add_downloader_args)选择固件下载方式
+    global firmware_downloader
+    if args.downloader == "stream":
+        firmware_downloader = FirmwareDownloader(FirmwareStore(args.firmware_store), result_root,
+                                                 sniff_bytes=0 if args.no_sniff else SNIFF_BYTES,
+                                                 verify=getattr(args, "http_verify", False))
+    return firmware_downloader
+
+
+def firmware_downloader_stats() -> dict:
+    if firmware_downloader is None:
+        return {}
+    return firmware_downloader.summary()
+
+
+def add_downloader_args(parser, default_store):
+    parser.add_argument("--downloader", choices=["stream", "request_multi"], default="stream",
+                        help="stream: chunked, resumable downloads deduplicated by sha256; request_multi: the original downloader")
+    parser.add_argument("--firmware-store", default=default_store,
+                        help="content-addressed firmware store, images are hard-linked into each app's firmware directory")
+    parser.add_argument("--no-sniff", action="store_true",
+                        help="download every link completely instead of cancelling responses whose leading bytes are not firmware")
+
+
+if __name__ == "__main__":
+    # 下载一组链接到本地目录: python3 -m utils.firmware_downloader /tmp/firmware_check http://host/fw.bin ...
+    parser = argparse.ArgumentParser(description="download firmware urls into a content-addressed store")
+    parser.add_argument("root", help="work directory, the store is {root}/store, images are linked into {root}/result")
+    parser.add_argument("urls", nargs="+")
+    args = parser.parse_args()
+
+    downloader = FirmwareDownloader(FirmwareStore(os.path.join(args.root, "store")), os.path.join(args.root, "result"))
+    for url in args.urls:
+        result = downloader.download(url, "cli", "check")
+        print(url, {key: value for key, value in result.items() if key != "content"},
+              "content:", str(result["content"])[:80])
+    print(downloader.summary())
+    downloader.close()
@@ -0,0 +1,137 @@
+import re
+import argparse
+from collections import namedtuple
+
+# 嗅探结果: kind 为 firmware / non_firmware / unknown, label 为识别出的格式, offset 为签名所在位置
+Verdict = namedtuple("Verdict", ["kind", "label", "offset"])
+
+# 下载开始后检查的字节数
+SNIFF_BYTES = 8 * 1024
+
+# 固件及其常见容器格式的签名 (名称, 偏移, magic), 参考 binwalk 的签名库
+FIRMWARE_SIGNATURES = [
+    ("uimage", 0, b"\x27\x05\x19\x56"),
+    ("trx", 0, b"HDR0"),
+    ("squashfs", 0, b"hsqs"),
+    ("squashfs", 0, b"sqsh"),
+    ("squashfs", 0, b"shsq"),
+    ("squashfs", 0, b"qshs"),
+    ("gzip", 0, b"\x1f\x8b\x08"),
+    ("zip", 0, b"PK\x03\x04"),
+    ("elf", 0, b"\x7fELF"),
+    ("dfuse", 0, b"DfuSe"),
+    ("xz", 0, b"\xfd7zXZ\x00"),
+    ("7z", 0, b"7z\xbc\xaf\x27\x1c"),
+    ("bzip2", 0, b"BZh"),
+    ("lzma", 0, b"\x5d\x00\x00"),
+    ("ubi", 0, b"UBI#"),
+    ("jffs2", 0, b"\x85\x19"),
+    ("jffs2", 0, b"\x19\x85"),
+    ("cramfs", 0, b"\x45\x3d\xcd\x28"),
+    ("android_boot", 0, b"ANDROID!"),
+    ("netgear_chk", 0, b"*#$^"),
+    ("tar", 257, b"ustar"),
+]
+
+# 在嗅探窗口内任意位置出现即可认为含有固件内容的签名 (较长的 magic, 误报少)
+EMBEDDED_SIGNATURES = [
+    ("uimage", b"\x27\x05\x19\x56"),
+    ("trx", b"HDR0"),
+    ("squashfs", b"hsqs"),
+    ("squashfs", b"sqsh"),
+    ("elf", b"\x7fELF"),
+    ("ubi", b"UBI#"),
+    ("xz", b"\xfd7zXZ\x00"),
+]
+
+# 明确不是固件的二进制格式
+NON_FIRMWARE_SIGNATURES = [
+    ("png", 0, b"\x89PNG\r\n\x1a\n"),
+    ("jpeg", 0, b"\xff\xd8\xff"),
+    ("gif", 0, b"GIF8"),
+    ("webp", 8, b"WEBP"),
+    ("pdf", 0, b"%PDF"),
+    ("mp4", 4, b"ftyp"),
+]
+
+_intel_hex_line = re.compile(rb"^:[0-9A-Fa-f]{10,}$")
+_srec_line = re.compile(rb"^S[0-9][0-9A-Fa-f]{6,}$")
+_html = re.compile(rb"^\s*(<!doctype html|<html|<head|<body|<script|<meta|<title|<div|<!--)", re.IGNORECASE)
+_xml = re.compile(rb"^\s*<\?xml", re.IGNORECASE)
+_json = re.compile(rb"^\s*[\[{]")
+_printable = set(range(0x20, 0x7f)) | {0x09, 0x0a, 0x0d}
+
+
+def _is_text(head):
+    # 可打印字符占绝大多数(或为合法的 UTF-8 文本)时视为文本
+    if not head:
+        return False
+    if b"\x00" in head:
+        return False
+    printable = sum(1 for byte in head if byte in _printable)
+    if printable / len(head) >= 0.95:
+        return True
+    try:
+        head.decode("utf-8")
+        return True
+    except UnicodeDecodeError as e:
+        # 嗅探窗口可能截断最后一个多字节字符
+        return e.start >= len(head) - 3
+
+
+def _text_kind(head):
+    lines = [line.strip() for line in head.splitlines()[:-1] or head.splitlines() if line.strip()]
+    if lines and all(_intel_hex_line.match(line) for line in lines):
+        return Verdict("firmware", "intel_hex", 0)
+    if lines and all(_srec_line.match(line) for line in lines):
+        return Verdict("firmware", "srec", 0)
+    if _html.match(head):
+        return Verdict("non_firmware", "html", 0)
+    if _xml.match(head):
+        return Verdict("non_firmware", "xml", 0)
+    if _json.match(head):
+        return Verdict("non_firmware", "json", 0)
+    return Verdict("non_firmware", "text", 0)
+
+
+def sniff(head, content_type=""):
+    """
+    根据响应开头的字节(建议 SNIFF_BYTES 字节)判断内容类型
+    无法识别的二进制返回 unknown(可能是加密或私有格式的固件), 由调用方决定是否继续下载
+    """
+    head = bytes(head)
+    if head.startswith(b"\xef\xbb\xbf"):
+        head = head[3:]
+    for label, offset, magic in FIRMWARE_SIGNATURES:
+        if head[offset:offset + len(magic)] == magic:
+            return Verdict("firmware", label, offset)
+    for label, offset, magic in NON_FIRMWARE_SIGNATURES:
+        if head[offset:offset + len(magic)] == magic:
+            return Verdict("non_firmware", label, offset)
+    if _is_text(head):
+        return _text_kind(head)
+    for label, magic in EMBEDDED_SIGNATURES:
+        offset = head.find(magic)
+        if offset >= 0:
+            return Verdict("firmware", label, offset)
+    if not head and "html" in content_type.lower():
+        return Verdict("non_firmware", "html", 0)
+    return Verdict("unknown", "binary", 0)
+
+
+def is_text_verdict(verdict):
+    # 文本类结果(升级描述等)的内容仍然返回, 供下一层提取链接
+    return verdict.label in ("json", "xml", "text")
+
+
+if __name__ == "__main__":
+    # 识别本地文件: python3 -m utils.firmware_sniffer file1 file2 ...
+    parser = argparse.ArgumentParser(description="classify files by their leading magic bytes")
+    parser.add_argument("paths", nargs="+")
+    parser.add_argument("--bytes", type=int, default=SNIFF_BYTES, help="bytes to inspect")
+    args = parser.parse_args()
+
+    for path in args.paths:
+        with open(path, "rb") as file:
+            verdict = sniff(file.read(args.bytes))
+        print(f"{path}: {verdict.kind} ({verdict.label} at {verdict.offset})")
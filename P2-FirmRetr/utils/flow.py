@@ -0,0 +1,75 @@
+"""
+同步/异步共用的处理流程
+处理逻辑写成生成器(flow), 需要 LLM 或网络 IO 的地方 yield 一个步骤, 由驱动函数执行后把结果送回生成器:
+- call_step(sync_call, async_call, *args, **kwargs): run_flow 调用 sync_call, arun_flow await async_call
+- gather_steps(flows, executor): 子流程列表, 返回与 flows 一一对应的结果列表;
+  run_flow 在 executor (LLMWorkQueue) 中并发执行, 没有 executor 时依次执行; arun_flow 用 asyncio.gather 并发执行
+步骤抛出的异常会抛回生成器中, 流程中的 try/finally 在两种模式下行为相同
+同一个app的同步入口 (如 format_url) 和异步入口 (如 aformat_url) 只保留一份处理逻辑
+"""
+import asyncio
+
+
+class CallStep:
+    def __init__(self, sync_call, async_call, args, kwargs):
+        self.sync_call = sync_call
+        self.async_call = async_call
+        self.args = args
+        self.kwargs = kwargs
+
+
+class GatherStep:
+    def __init__(self, flows, executor=None):
+        self.flows = list(flows)
+        self.executor = executor
+
+
+def call_step(sync_call, async_call, *args, **kwargs):
+    return CallStep(sync_call, async_call, args, kwargs)
+
+
+def gather_steps(flows, executor=None):
+    return GatherStep(flows, executor)
+
+
+def run_flow(flow):
+    """
+    同步执行 flow, 返回生成器的返回值
+    """
+    try:
+        step = next(flow)
+        while True:
+            try:
+                if isinstance(step, GatherStep):
+                    if step.executor is None:
+                        result = [run_flow(sub_flow) for sub_flow in step.flows]
+                    else:
+                        result = step.executor.map(run_flow, step.flows)
+                else:
+                    result = step.sync_call(*step.args, **step.kwargs)
+            except BaseException as e:
+                step = flow.throw(e)
+            else:
+                step = flow.send(result)
+    except StopIteration as stop:
+        return stop.value
+
+
+async def arun_flow(flow):
+    """
+    run_flow 的异步版本
+    """
+    try:
+        step = next(flow)
+        while True:
+            try:
+                if isinstance(step, GatherStep):
+                    result = await asyncio.gather(*[arun_flow(sub_flow) for sub_flow in step.flows])
+                else:
+                    result = await step.async_call(*step.args, **step.kwargs)
+            except BaseException as e:
+                step = flow.throw(e)
+            else:
+                step = flow.send(result)
+    except StopIteration as stop:
+        return stop.value
@@ -0,0 +1,283 @@
+import time
+import json
+import socket
+import asyncio
+import argparse
+import ipaddress
+import threading
+from collections import Counter
+from urllib.parse import urlsplit
+import httpx
+import httpcore
+
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# 这些类型的响应按文本/json读取, 其他类型视为文件, 只记录链接和大小
+TEXT_CONTENT_TYPES = ("json", "xml", "text", "html", "javascript", "x-www-form-urlencoded")
+
+
+class CachedDnsBackend(httpcore.AsyncNetworkBackend):
+    """
+    带 DNS 缓存的 httpcore 网络后端: 同一个主机名在 ttl 秒内只解析一次, 依次尝试解析到的地址
+    TLS 握手仍使用原主机名(SNI 和证书校验不受影响)
+    """
+
+    def __init__(self, backend, ttl=300):
+        self._backend = backend
+        self.ttl = ttl
+        self._cache = {}
+        self.stats = Counter()
+
+    async def resolve(self, host, port, timeout=None):
+        try:
+            ipaddress.ip_address(host)
+            return [host]
+        except ValueError:
+            pass
+        cached = self._cache.get((host, port))
+        if cached is not None and cached[0] > time.monotonic():
+            self.stats["dns_hits"] += 1
+            return cached[1]
+        self.stats["dns_lookups"] += 1
+        try:
+            infos = await asyncio.wait_for(
+                asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM), timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            self.stats["dns_errors"] += 1
+            raise httpcore.ConnectError(f"dns lookup failed for {host}: {e}") from e
+        addresses = list(dict.fromkeys(info[4][0] for info in infos))
+        self._cache[(host, port)] = (time.monotonic() + self.ttl, addresses)
+        return addresses
+
+    async def connect_tcp(self, host, port, timeout=None, local_address=None, socket_options=None):
+        error = None
+        for address in await self.resolve(host, port, timeout):
+            try:
+                return await self._backend.connect_tcp(address, port, timeout, local_address, socket_options)
+            except (httpcore.ConnectError, httpcore.ConnectTimeout) as e:
+                error = e
+        raise error
+
+    async def connect_unix_socket(self, path, timeout=None, socket_options=None):
+        return await self._backend.connect_unix_socket(path, timeout, socket_options)
+
+    async def sleep(self, seconds):
+        await self._backend.sleep(seconds)
+
+
+class HttpEngine:
+    """
+    phase3 函数调用的异步 HTTP 探测引擎, 在独立的事件循环线程中运行, 所有app共用
+    - 共享连接池(按主机复用连接, 服务端支持时使用 HTTP/2)和 DNS 缓存
+    - 每个主机同时最多 per_host 个请求, 避免对同一个服务器并发过多
+    - 分阶段超时: 建立连接 connect_timeout, 两次读取(或写入)之间的空闲 read_timeout, 整个请求 total_timeout
+    同一次函数调用的所有候选URL并发请求, 结果格式与 Request_multi.make_request_multi 相同:
+    {"status_code": ..., "content": ...}, 出错时附带 "error"
+    """
+
+    def __init__(self, per_host=4, max_connections=100, connect_timeout=10, read_timeout=30,
+                 total_timeout=120, max_body=2 * 1024 * 1024, dns_ttl=300, http2=True, verify=False):
+        self.per_host = per_host
+        self.max_connections = max_connections
+        # httpx 的 read 超时是每次读取的空闲时间而不是首字节的截止时间, 整个请求的上限由 total_timeout 保证
+        self.timeout = httpx.Timeout(None, connect=connect_timeout, read=read_timeout,
+                                     write=read_timeout, pool=total_timeout)
+        self.total_timeout = total_timeout
+        self.max_body = max_body
+        self.http2 = http2 and HTTP2_AVAILABLE
+        self.verify = verify
+        self.dns = CachedDnsBackend(httpcore.AnyIOBackend(), dns_ttl)
+        self.stats = Counter()
+        self._lock = threading.Lock()
+        self._loop = None
+        self._client = None
+        self._host_slots = {}
+
+    def _ensure_loop(self):
+        # 第一次使用时启动事件循环线程
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="http_engine", daemon=True).start()
+                self._loop = loop
+        return self._loop
+
+    def _get_client(self):
+        if self._client is None:
+            transport = httpx.AsyncHTTPTransport(
+                http2=self.http2, verify=self.verify, retries=0,
+                limits=httpx.Limits(max_connections=self.max_connections,
+                                    max_keepalive_connections=self.max_connections,
+                                    keepalive_expiry=60))
+            # httpx 没有公开 network_backend 参数, 替换底层 httpcore 连接池的网络后端以共享 DNS 缓存
+            transport._pool._network_backend = self.dns
+            self._client = httpx.AsyncClient(transport=transport, timeout=self.timeout, follow_redirects=True)
+        return self._client
+
+    def _host_slot(self, url):
+        host = urlsplit(url).netloc.lower()
+        slot = self._host_slots.get(host)
+        if slot is None:
+            slot = self._host_slots[host] = asyncio.Semaphore(self.per_host)
+        return slot
+
+    @staticmethod
+    def _request_args(method, headers, parameter):
+        headers = {str(name): str(value) for name, value in (headers or {}).items()}
+        if not parameter:
+            return {"headers": headers}
+        if method == "GET":
+            if isinstance(parameter, dict):
+                return {"headers": headers, "params": {str(name): str(value) for name, value in parameter.items()}}
+            return {"headers": headers, "params": str(parameter).lstrip("?")}
+        if isinstance(parameter, dict):
+            if "json" in next((value for name, value in headers.items() if name.lower() == "content-type"), "json"):
+                return {"headers": headers, "json": parameter}
+            return {"headers": headers, "data": parameter}
+        return {"headers": headers, "content": str(parameter).encode("utf-8")}
+
+    async def _read(self, response):
+        # 文本类响应最多读取 max_body 字节, 文件类响应不读取内容, 返回其链接交给下载阶段
+        content_type = response.headers.get("content-type", "").lower()
+        if content_type and not any(kind in content_type for kind in TEXT_CONTENT_TYPES):
+            self.stats["binary"] += 1
+            return {"download_url": str(response.url), "content_type": content_type,
+                    "content_length": response.headers.get("content-length")}
+        body = bytearray()
+        async for chunk in response.aiter_bytes():
+            body.extend(chunk)
+            if len(body) >= self.max_body:
+                self.stats["body_truncated"] += 1
+                break
+        text = bytes(body[:self.max_body]).decode(response.encoding or "utf-8", errors="replace")
+        try:
+            return json.loads(text)
+        except json.JSONDecodeError:
+            return text
+
+    async def _fetch(self, method, url, request_args):
+        async with self._host_slot(url):
+            async with self._get_client().stream(method, url, **request_args) as response:
+                content = await self._read(response)
+                result = {"status_code": response.status_code, "content": content}
+                if response.http_version == "HTTP/2":
+                    self.stats["http2"] += 1
+                if response.status_code >= 400:
+                    result = {"error": f"HTTP Error {response.status_code}", **result}
+                return result
+
+    async def afetch(self, method, url, headers=None, parameter=None):
+        # 单个URL, 整个请求超过 total_timeout 时放弃
+        method = (method or "GET").upper()
+        start_time = time.time()
+        try:
+            result = await asyncio.wait_for(self._fetch(method, url, self._request_args(method, headers, parameter)),
+                                            self.total_timeout)
+        except asyncio.TimeoutError:
+            result = {"error": f"total timeout after {self.total_timeout}s", "status_code": None, "content": ""}
+        except httpx.TimeoutException as e:
+            result = {"error": f"{type(e).__name__}: {e}", "status_code": None, "content": ""}
+        except (httpx.HTTPError, httpx.InvalidURL, httpcore.ConnectError, OSError, ValueError) as e:
+            # 无效URL, DNS/连接失败等
+            result = {"error": f"{type(e).__name__}: {e}", "status_code": None, "content": ""}
+        except Exception as e:
+            # 其他异常只影响这一个URL, 不影响同一次函数调用的其他候选URL
+            result = {"error": f"{type(e).__name__}: {e}", "status_code": None, "content": ""}
+        with self._lock:
+            self.stats["requests"] += 1
+            self.stats["errors" if result.get("error") else "ok"] += 1
+            self.stats["time"] += time.time() - start_time
+        return result
+
+    async def afetch_all(self, method, urls, headers=None, parameter=None):
+        # 所有候选URL并发请求, 结果与 urls 一一对应
+        return await asyncio.gather(*[self.afetch(method, url, headers, parameter) for url in urls])
+
+    def fetch_all(self, method, urls, headers=None, parameter=None):
+        # 线程中调用: 提交到引擎的事件循环并等待结果
+        future = asyncio.run_coroutine_threadsafe(self.afetch_all(method, urls, headers, parameter), self._ensure_loop())
+        return future.result()
+
+    async def afetch_all_threadsafe(self, method, urls, headers=None, parameter=None):
+        # 其他事件循环中调用, 请求仍在引擎的事件循环中执行, 连接池和 DNS 缓存共用
+        future = asyncio.run_coroutine_threadsafe(self.afetch_all(method, urls, headers, parameter), self._ensure_loop())
+        return await asyncio.wrap_future(future)
+
+    def make_request(self, method, urls, headers=None, parameter=None, app_name=None, dataset=None, **kwargs):
+        # 与 make_request_name 函数调用的参数一致, 可以直接替换 Request_multi.make_request_multi
+        return self.fetch_all(method, urls or [], headers, parameter)
+
+    async def amake_request(self, method, urls, headers=None, parameter=None, app_name=None, dataset=None, **kwargs):
+        return await self.afetch_all_threadsafe(method, urls or [], headers, parameter)
+
+    def summary(self):
+        with self._lock:
+            stats = dict(self.stats)
+        stats.update(self.dns.stats)
+        if stats.get("requests"):
+            stats["avg_time"] = round(stats.pop("time") / stats["requests"], 3)
+        return stats
+
+    def close(self):
+        with self._lock:
+            loop, self._loop = self._loop, None
+        if loop is None:
+            return
+        if self._client is not None:
+            asyncio.run_coroutine_threadsafe(self._client.aclose(), loop).result()
+            self._client = None
+        loop.call_soon_threadsafe(loop.stop)
+
+
+http_engine = None
+
+
+def setup_http_engine(args):
+    # 根据命令行参数(add_http_engine_args)选择 phase3 函数调用的请求方式
+    global http_engine
+    if args.http_engine == "async":
+        http_engine = HttpEngine(per_host=args.http_per_host, max_connections=args.http_max_connections,
+                                 connect_timeout=args.http_connect_timeout,
+                                 read_timeout=args.http_read_timeout,
+                                 total_timeout=args.http_total_timeout,
+                                 http2=not args.no_http2, verify=args.http_verify)
+    return http_engine
+
+
+def http_engine_stats() -> dict:
+    if http_engine is None:
+        return {}
+    return http_engine.summary()
+
+
+def add_http_engine_args(parser):
+    parser.add_argument("--http-engine", choices=["async", "request_multi"], default="async",
+                        help="async: probe all candidate urls of a function call concurrently; request_multi: the original sequential requests")
+    parser.add_argument("--http-per-host", type=int, default=4, help="max concurrent requests to one host")
+    parser.add_argument("--http-max-connections", type=int, default=100, help="max pooled connections of the http engine")
+    parser.add_argument("--http-connect-timeout", type=float, default=10, help="seconds to establish a connection")
+    parser.add_argument("--http-read-timeout", type=float, default=30,
+                        help="max seconds without receiving data (per read, not a deadline for the first byte)")
+    parser.add_argument("--http-total-timeout", type=float, default=120, help="seconds for a whole request")
+    parser.add_argument("--no-http2", action="store_true", help="only use HTTP/1.1")
+    parser.add_argument("--http-verify", action="store_true", help="verify TLS certificates of probed servers")
+
+
+if __name__ == "__main__":
+    # 用引擎并发请求一组URL: python3 -m utils.http_engine http://host/a http://host/b
+    parser = argparse.ArgumentParser(description="probe urls concurrently with the http engine")
+    parser.add_argument("urls", nargs="+")
+    parser.add_argument("--method", default="GET")
+    parser.add_argument("--total-timeout", type=float, default=30)
+    args = parser.parse_args()
+
+    engine = HttpEngine(per_host=2, total_timeout=args.total_timeout)
+    start = time.time()
+    for url, result in zip(args.urls, engine.fetch_all(args.method, args.urls, {"User-Agent": "firmproj"})):
+        print(url, str(result)[:300])
+    print(f"elapsed: {time.time() - start:.2f}s, stats: {engine.summary()}")
+    engine.close()
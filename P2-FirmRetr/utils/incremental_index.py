@@ -0,0 +1,82 @@
+import os
+import json
+from utils.run_manifest import fingerprint_value
+from utils.utils import save_json_atomic
+
+INDEX_FILE_NAME = "incremental_index.json"
+
+
+class IncrementalIndex:
+    """
+    单个app的增量处理索引, 保存在 {result_root}/{dataset}/{app}/incremental_index.json
+    - entries: P1-ReqRec 输出中每个请求值的指纹 -> 各阶段对它的结果
+      {"preprocess": 是否通过过滤, "phase1": 格式化后的请求, "phase2": 分类标签}
+    - keys: 本次输入中的序号 -> 指纹; P1-ReqRec 按顺序编号, 应用更新后同一个请求的序号可能变化, 因此结果只按指纹复用
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.keys = {}
+        self.entries = {}
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as file:
+                    data = json.load(file)
+                self.keys = data.get("keys", {})
+                self.entries = data.get("entries", {})
+            except (json.JSONDecodeError, AttributeError):
+                # 索引损坏时当作没有历史结果, 全部重新处理
+                self.keys, self.entries = {}, {}
+
+    @classmethod
+    def for_app(cls, result_root, dataset, app_name):
+        return cls(os.path.join(result_root, dataset, app_name, INDEX_FILE_NAME))
+
+    def start_run(self, content: dict):
+        """
+        preprocess 阶段调用: 记录本次输入的 序号 -> 指纹, 并丢弃已经不在输入中的请求的历史结果
+        """
+        self.keys = {str(key): fingerprint_value(value) for key, value in content.items()}
+        current = set(self.keys.values())
+        self.entries = {fingerprint: entry for fingerprint, entry in self.entries.items() if fingerprint in current}
+
+    def fingerprint_of(self, key):
+        return self.keys.get(str(key))
+
+    def get(self, key, stage):
+        # 按本次输入的序号查询某个阶段的历史结果, 没有时返回 None
+        entry = self.entries.get(self.fingerprint_of(key))
+        if entry is None:
+            return None
+        return entry.get(stage)
+
+    def set(self, key, stage, value):
+        fingerprint = self.fingerprint_of(key)
+        if fingerprint is None:
+            return
+        entry = self.entries.setdefault(fingerprint, {})
+        entry[stage] = value
+        # 上游结果变化时, 下游的历史结果不再可信
+        for downstream in STAGES[STAGES.index(stage) + 1:]:
+            entry.pop(downstream, None)
+
+    def save(self):
+        if os.path.exists(os.path.dirname(self.path)):
+            save_json_atomic({"keys": self.keys, "entries": self.entries}, self.path)
+
+
+STAGES = ["preprocess", "phase1", "phase2"]
+
+incremental = False
+
+
+def setup_incremental(args):
+    # 根据命令行参数(add_incremental_args)开启增量处理
+    global incremental
+    incremental = getattr(args, "incremental", False)
+    return incremental
+
+
+def add_incremental_args(parser):
+    parser.add_argument("--incremental", action="store_true",
+                        help="reuse previous preprocess/phase1/phase2 results of unchanged requests (keyed by content fingerprint)")
@@ -0,0 +1,279 @@
+import re
+import threading
+from collections import Counter, deque
+import numpy as np
+from rapidfuzz import fuzz, process
+
+# 与 llm_preprocess.check_partial_keywords_in_text 原有的分词规则保持一致
+WORD_PATTERN = re.compile(r'\b[\w$-]+\b')
+# 可以出现在单词中的字符
+WORD_CHAR = re.compile(r'[\w$-]')
+
+
+def split_words(text: str) -> list[str]:
+    """
+    将文本转换为小写并分割单词（支持常见分隔符）
+    去掉 [Possible Url] 前缀以及单独的 url 单词
+    """
+    words = WORD_PATTERN.findall(text.lower())
+    if words and words[0] == "possible":
+        words = words[2:]
+    return [word for word in words if word != "url"]
+
+
+class KeywordMatcher:
+    """
+    基于 rapidfuzz.process.cdist 的关键词模糊匹配器
+
+    构造时对关键词做一次预处理, 匹配时将所有关键词与文本中的所有(去重后)单词
+    放在一个矩阵里一次性打分, 判定规则与原来逐个关键词调用
+    process.extract(..., scorer=fuzz.WRatio, score_cutoff=85) 相同
+    """
+
+    def __init__(self, keyword_set: list[str], score_cutoff=85, workers=-1, block_size=16):
+        self.keywords = list(keyword_set)
+        # 原实现中 processor 为小写化, 这里提前处理关键词, 单词在分词时已经小写
+        self._queries = [keyword.lower() for keyword in self.keywords]
+        self.score_cutoff = score_cutoff
+        self.workers = workers
+        # 短路模式下每次打分的关键词数量
+        self.block_size = block_size
+
+    def _hits(self, queries, words):
+        # 返回 bool 矩阵 [关键词, 单词], 低于 score_cutoff 的分数会被 cdist 置为 0
+        scores = process.cdist(queries, words, scorer=fuzz.WRatio,
+                               score_cutoff=self.score_cutoff, workers=self.workers)
+        return scores > 0
+
+    def match(self, text: str, stop_at_first=False) -> list[str]:
+        """
+        返回 text 中命中的关键词列表
+        stop_at_first=True 时按块打分, 命中第一个关键词后立即返回
+        """
+        words = list(set(split_words(text)))
+        if not words:
+            return []
+
+        if not stop_at_first:
+            hit_rows = np.flatnonzero(self._hits(self._queries, words).any(axis=1))
+            return [self.keywords[i] for i in hit_rows]
+
+        for start in range(0, len(self._queries), self.block_size):
+            hit_rows = np.flatnonzero(self._hits(self._queries[start:start + self.block_size], words).any(axis=1))
+            if hit_rows.size > 0:
+                return [self.keywords[start + hit_rows[0]]]
+        return []
+
+    def is_match(self, text: str) -> bool:
+        return len(self.match(text, stop_at_first=True)) > 0
+
+    def match_batch(self, texts: list[str]) -> list[list[str]]:
+        """
+        批量匹配, 所有文本的单词去重后只调用一次 cdist
+        返回值与 texts 一一对应
+        """
+        texts_words = [split_words(text) for text in texts]
+        vocabulary = sorted(set(word for words in texts_words for word in words))
+        if not vocabulary:
+            return [[] for _ in texts]
+
+        hits = self._hits(self._queries, vocabulary)
+        # 只记录至少命中一个关键词的单词
+        word_hits = {vocabulary[i]: np.flatnonzero(hits[:, i]) for i in np.flatnonzero(hits.any(axis=0))}
+
+        results = []
+        for words in texts_words:
+            rows = set()
+            for word in words:
+                if word in word_hits:
+                    rows.update(word_hits[word].tolist())
+            results.append([self.keywords[i] for i in sorted(rows)])
+        return results
+
+    def is_match_batch(self, texts: list[str]) -> list[bool]:
+        return [len(matched) > 0 for matched in self.match_batch(texts)]
+
+
+class AhoCorasick:
+    """
+    多模式串精确匹配自动机 (Aho-Corasick)
+    对小写化后的关键词建立 trie + fail 指针, 一次线性扫描即可找出文本中包含的所有关键词
+    """
+
+    def __init__(self, keyword_set: list[str]):
+        self.keywords = list(keyword_set)
+        self._lengths = [len(keyword) for keyword in self.keywords]
+        # 每个状态: 转移表, fail 指针, 以该状态结尾的关键词下标
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [[]]
+        for index, keyword in enumerate(self.keywords):
+            self._add(keyword.lower(), index)
+        self._build()
+
+    def _add(self, pattern, index):
+        state = 0
+        for char in pattern:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][char] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+            state = next_state
+        self._output[state].append(index)
+
+    def _build(self):
+        # BFS 计算 fail 指针, 并把 fail 链上的输出合并到当前状态
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                self._output[next_state] = self._output[next_state] + self._output[self._fail[next_state]]
+
+    def _is_whole_word(self, text, end, index):
+        # 关键词 index 在 text 中以 end 结尾的一次出现, 前后都不是单词字符
+        start = end - self._lengths[index] + 1
+        return ((start == 0 or not WORD_CHAR.match(text[start - 1])) and
+                (end + 1 == len(text) or not WORD_CHAR.match(text[end + 1])))
+
+    def search(self, text: str, stop_at_first=False, whole_words=False) -> list[str]:
+        """
+        返回 text (小写化后) 中出现的关键词, stop_at_first=True 时找到第一个即返回
+        whole_words=True 时只接受完整单词的出现, "rotation" 中的 "ota" 不算命中
+        """
+        goto, fail, output = self._goto, self._fail, self._output
+        text = text.lower()
+        state = 0
+        matched = set()
+        for position, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for index in output[state]:
+                if whole_words and not self._is_whole_word(text, position, index):
+                    continue
+                if stop_at_first:
+                    return [self.keywords[index]]
+                matched.add(index)
+        return [self.keywords[i] for i in sorted(matched)]
+
+
+class TwoTierKeywordFilter:
+    """
+    两级关键词过滤器
+    - 第一级: Aho-Corasick 精确匹配, 分词后的单词与某个关键词完全相同的文本直接接受
+      (WRatio 对相同的单词打分为 100, 第一级的判定与模糊匹配相同; 子串命中如 "rotation" 中的 "ota" 不算)
+    - 第二级: 第一级未命中的文本再交给 KeywordMatcher 做模糊匹配
+    stats 记录每一级做出判定的次数, 用于评估节省的模糊匹配量
+    """
+
+    def __init__(self, keyword_set: list[str], fuzzy_matcher: KeywordMatcher = None):
+        # 本身不是一个单词的关键词分词后不会与任何单词相同, 只做模糊匹配
+        self.exact_matcher = AhoCorasick([keyword for keyword in keyword_set if WORD_PATTERN.fullmatch(keyword)])
+        self.fuzzy_matcher = fuzzy_matcher if fuzzy_matcher else KeywordMatcher(keyword_set)
+        self._lock = threading.Lock()
+        self.stats = Counter()
+
+    def filter_batch(self, texts: list[str], fuzzy_check=None) -> tuple[list[bool], Counter]:
+        """
+        返回 (每个文本是否保留, 本次调用的分级统计)
+        fuzzy_check 为第二级的批量判定函数, 默认使用 fuzzy_matcher.is_match_batch
+        """
+        if fuzzy_check is None:
+            fuzzy_check = self.fuzzy_matcher.is_match_batch
+        # 在分词结果上做完整单词匹配, 与模糊匹配使用相同的单词 (去掉 [Possible Url] 前缀等)
+        flags = [len(self.exact_matcher.search(" ".join(split_words(text)), stop_at_first=True, whole_words=True)) > 0
+                 for text in texts]
+        stats = Counter(exact_accept=sum(flags))
+
+        fallthrough = [i for i, flag in enumerate(flags) if not flag]
+        if fallthrough:
+            fuzzy_flags = fuzzy_check([texts[i] for i in fallthrough])
+            for i, flag in zip(fallthrough, fuzzy_flags):
+                flags[i] = flag
+            stats["fuzzy_accept"] += sum(1 for flag in fuzzy_flags if flag)
+            stats["fuzzy_reject"] += sum(1 for flag in fuzzy_flags if not flag)
+
+        with self._lock:
+            self.stats.update(stats)
+        return flags, stats
+
+
+def legacy_check_partial_keywords(text: str, keyword_set: list[str]) -> bool:
+    # 原始实现: 逐个关键词调用 process.extract, 仅用于对照测试和性能对比
+    words = split_words(text)
+    matched_keywords = []
+    for keyword in keyword_set:
+        results = process.extract(keyword, words, processor=str.lower, scorer=fuzz.WRatio, score_cutoff=85)
+        if len(results) > 0:
+            matched_keywords.append(keyword)
+    return len(matched_keywords) > 0
+
+
+def generate_synthetic_requests(keyword_set, num=2000, seed=0):
+    # 构造与静态分析输出格式相近的请求字符串, 一部分混入带拼写错误的关键词
+    import random
+    rng = random.Random(seed)
+    filler = ["getUserInfo", "java.lang.String", "retrofit2.Call", "Continuation", "baseUrl", "login",
+              "com.example.iot.api", "token", "deviceId", "https://api.example.com/v1/", "Lretrofit2/http/GET",
+              "setLanguage", "uploadLog", "userprofile", "timezone", "region", "appVersion", "param"]
+
+    def typo(word):
+        if len(word) < 4:
+            return word
+        i = rng.randrange(len(word))
+        return word[:i] + rng.choice("abcdefghijklmnopqrstuvwxyz") + word[i + 1:]
+
+    requests = []
+    for index in range(num):
+        words = rng.sample(filler, rng.randint(4, 12))
+        if index % 3 == 0:
+            words.insert(rng.randrange(len(words) + 1), typo(rng.choice(keyword_set)))
+        prefix = "[Possible Url]: " if index % 2 == 0 else "RetrofitPoint:{\nMethod Name = ["
+        requests.append(prefix + " ".join(words))
+    return requests
+
+
+if __name__ == "__main__":
+    # 性能对比: python3 -m utils.keyword_matcher
+    import time
+    from llm_preprocess import FILTER_SET
+
+    requests = generate_synthetic_requests(FILTER_SET)
+    matcher = KeywordMatcher(FILTER_SET)
+    # 模拟 pre_filter 中一个json文件的value数量
+    file_size = 50
+
+    start = time.perf_counter()
+    legacy_result = [legacy_check_partial_keywords(text, FILTER_SET) for text in requests]
+    legacy_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    matcher_result = [matcher.is_match(text) for text in requests]
+    matcher_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    batch_result = []
+    for i in range(0, len(requests), file_size):
+        batch_result.extend(matcher.is_match_batch(requests[i:i + file_size]))
+    batch_time = time.perf_counter() - start
+
+    two_tier = TwoTierKeywordFilter(FILTER_SET, matcher)
+    start = time.perf_counter()
+    for i in range(0, len(requests), file_size):
+        two_tier.filter_batch(requests[i:i + file_size])
+    two_tier_time = time.perf_counter() - start
+
+    mismatch = sum(1 for a, b, c in zip(legacy_result, matcher_result, batch_result) if not a == b == c)
+    print(f"requests: {len(requests)}, accepted: {sum(legacy_result)}, mismatch: {mismatch}")
+    print(f"legacy extract loop    : {legacy_time:.3f}s")
+    print(f"cdist per value        : {matcher_time:.3f}s")
+    print(f"cdist per {file_size} values    : {batch_time:.3f}s")
+    print(f"two tier per {file_size} values : {two_tier_time:.3f}s, {dict(two_tier.stats)}")
@@ -0,0 +1,205 @@
+import re
+import ast
+import json
+import argparse
+import threading
+from collections import Counter
+from urllib.parse import urlsplit, urlunsplit
+import xml.etree.ElementTree as ET
+
+# 与 prompt/extract_download_link_prompt.txt 相同的规则, 在本地确定性地提取下载链接:
+# 遍历所有字段值, 收集 http(s) 链接和带扩展名的文件名, 文件名拼接到请求的 baseurl, 按出现顺序去重
+
+_url = re.compile(r"https?://[^\s'\"<>()\[\]{},]+", re.IGNORECASE)
+# 固件及其附带描述文件的常见扩展名, 避免把版本号、域名当作文件名
+FILE_EXTENSIONS = (
+    "bin", "img", "hex", "fw", "rom", "dfu", "ota", "pkg", "upd", "update", "trx", "chk", "ipk", "deb", "rpm", "apk",
+    "zip", "gz", "tgz", "tar", "bz2", "xz", "7z", "rar", "lzma", "squashfs", "ubi", "elf", "dat", "json", "xml",
+)
+_filename = re.compile(r"^/?(?:[\w.@%+-]+/)*[\w.@%+-]+\.(?:" + "|".join(FILE_EXTENSIONS) + r")$", re.IGNORECASE)
+_filename_in_text = re.compile(r"(?<![\w/.:-])(?:[\w.@%+-]+/)*[\w.@%+-]+\.(?:" + "|".join(FILE_EXTENSIONS) + r")(?![\w/.-])",
+                               re.IGNORECASE)
+# 可能是链接但没有被规则识别的字符串: 含有路径分隔符或扩展名
+_maybe_link = re.compile(r"/|\.[a-z][a-z0-9]{1,7}\b", re.IGNORECASE)
+
+
+def base_url(request_url):
+    # 请求地址去掉查询参数和最后一级路径
+    try:
+        parts = urlsplit(request_url.strip())
+    except ValueError:
+        return ""
+    if not parts.scheme or not parts.netloc:
+        return ""
+    path = parts.path.rsplit("/", 1)[0] if "/" in parts.path else ""
+    return urlunsplit((parts.scheme, parts.netloc, path, "", ""))
+
+
+def join_filename(base, filename):
+    if filename.startswith("/"):
+        return base + filename
+    return base + "/" + filename
+
+
+def parse_body(content):
+    """
+    响应内容转换为 (类型, 解析结果): json 为 dict/list, xml 为 Element, 其他为 text
+    字符串形式的 json / python 字面量同样按 json 处理
+    """
+    if isinstance(content, (dict, list)):
+        return "json", content
+    if isinstance(content, bytes):
+        content = content.decode("utf-8", errors="replace")
+    if not isinstance(content, str):
+        return "text", str(content)
+    text = content.strip()
+    if text[:1] in ("{", "["):
+        try:
+            return "json", json.loads(text)
+        except json.JSONDecodeError:
+            try:
+                value = ast.literal_eval(text)
+                if isinstance(value, (dict, list)):
+                    return "json", value
+            except (ValueError, SyntaxError, MemoryError, RecursionError):
+                pass
+    if text.startswith("<") and not text[:15].lower().startswith(("<!doctype html", "<html")):
+        try:
+            return "xml", ET.fromstring(text)
+        except ET.ParseError:
+            pass
+    return "text", text
+
+
+def iter_strings(value):
+    # 按出现顺序遍历 json / xml 中所有字符串(xml 包括文本和属性值)
+    stack = [value]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, str):
+            yield node
+        elif isinstance(node, dict):
+            stack.extend(reversed(list(node.values())))
+        elif isinstance(node, (list, tuple)):
+            stack.extend(reversed(node))
+        elif isinstance(node, ET.Element):
+            stack.extend(reversed(list(node.attrib.values()) + [node.text] + list(node) + [node.tail]))
+        elif node is not None and not isinstance(node, (int, float, bool)):
+            yield str(node)
+
+
+def extract_links(content, request_url=""):
+    """
+    返回 (链接列表, 是否存在未识别的疑似链接)
+    没有找到链接、但某个字段值看起来像路径或文件时, 第二个返回值为 True, 由调用方决定是否交给LLM
+    """
+    kind, body = parse_body(content)
+    base = base_url(request_url)
+    links = {}
+    unknown = False
+    strings = iter_strings(body) if kind != "text" else [body]
+    for text in strings:
+        text = text.strip()
+        if not text:
+            continue
+        urls = _url.findall(text)
+        for url in urls:
+            links.setdefault(url.rstrip(".;"), None)
+        if kind == "text":
+            names = _filename_in_text.findall(_url.sub(" ", text)) if base else []
+        else:
+            names = [text] if not urls and base and _filename.match(text) else []
+        for name in names:
+            links.setdefault(join_filename(base, name), None)
+        if not urls and not names and kind != "text" and _maybe_link.search(text):
+            unknown = True
+    return list(links), unknown
+
+
+def split_response(res):
+    """
+    function call 返回的单个响应: {"status_code": ..., "content": ...} 或直接为响应内容
+    返回 (状态码, 响应内容), 出错的响应内容为 None
+    """
+    if isinstance(res, dict) and "content" in res:
+        status_code = res.get("status_code")
+        if res.get("error") or (isinstance(status_code, int) and status_code >= 400):
+            return status_code, None
+        return status_code, res["content"]
+    return None, res
+
+
+class LinkExtractor:
+    """
+    startDownload 使用的本地下载链接提取器, 统计省去的LLM调用次数
+    - extracted: 本地提取到链接
+    - empty: 出错的响应或没有疑似链接的内容, 直接返回空列表
+    - llm_fallback: 结构化内容中有无法识别的疑似链接, 仍交给LLM
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.stats = Counter()
+        self._lock = threading.Lock()
+
+    def extract(self, res, request_url=""):
+        """
+        返回 (链接列表, 是否需要LLM)
+        """
+        if not self.enabled:
+            return [], True
+        _, content = split_response(res)
+        if content is None:
+            self._count("empty")
+            return [], False
+        links, unknown = extract_links(content, request_url)
+        if links:
+            self._count("extracted")
+            return links, False
+        if unknown:
+            self._count("llm_fallback")
+            return [], True
+        self._count("empty")
+        return [], False
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def summary(self):
+        with self._lock:
+            stats = dict(self.stats)
+        stats["llm_calls_avoided"] = stats.get("extracted", 0) + stats.get("empty", 0)
+        return stats
+
+
+link_extractor = LinkExtractor()
+
+
+def setup_link_extractor(args):
+    # 根据命令行参数(add_link_extractor_args)选择下载链接的提取方式
+    link_extractor.enabled = args.link_extractor == "local"
+    return link_extractor
+
+
+def link_extractor_stats() -> dict:
+    return link_extractor.summary()
+
+
+def add_link_extractor_args(parser):
+    parser.add_argument("--link-extractor", choices=["local", "llm"], default="local",
+                        help="local: extract download links with rules, LLM only for unfamiliar structured bodies; llm: always ask the LLM")
+
+
+if __name__ == "__main__":
+    # 本地提取一个响应中的下载链接: python3 -m utils.link_extractor response.json --url http://host/path/check
+    parser = argparse.ArgumentParser(description="extract download links from an http response body")
+    parser.add_argument("path", help="file with the response body")
+    parser.add_argument("--url", default="", help="request url, base of relative file names")
+    args = parser.parse_args()
+
+    with open(args.path, "r", encoding="utf-8", errors="replace") as file:
+        links, unknown = extract_links(file.read(), args.url)
+    print(links)
+    if not links and unknown:
+        print("unrecognized link-like values, would fall back to the LLM")
@@ -0,0 +1,204 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import asyncio
+import threading
+import functools
+import contextvars
+from collections import Counter
+from contextlib import contextmanager
+from openai.types.chat import ChatCompletion
+from utils.utils import save_llm_stats
+from utils.app_stats import current_app_stats
+
+# 当前作用域(一个app)的缓存统计, 线程和asyncio任务各自继承调用方的作用域
+_scope_stats = contextvars.ContextVar("llm_cache_scope_stats", default=None)
+
+
+class ResponseCache:
+    """
+    基于 SQLite 的 LLM 响应缓存, 以 (model, messages, temperature, tools) 的哈希作为键
+    - 超过 max_bytes 时按最近访问时间淘汰 (LRU)
+    - readonly=True 时只读不写, 用于可复现的重跑
+    - 数据库出错(如被其他进程长时间锁住)时读取视为未命中, 写入跳过, 不影响LLM调用
+    """
+
+    def __init__(self, path, max_bytes=4 * 1024 ** 3, readonly=False):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.readonly = readonly
+        self._lock = threading.Lock()
+        self.stats = Counter()
+
+        if readonly:
+            self._conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, timeout=60, check_same_thread=False)
+            self._total_bytes = 0
+            return
+
+        cache_dir = os.path.dirname(path)
+        if cache_dir and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses(last_access)")
+        self._conn.commit()
+        self._total_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def make_key(model, messages, temperature, tools=None, sample=None):
+        """
+        计算缓存键; sample 用于区分相同输入的多次采样(如多轮投票的第几轮)
+        """
+        payload = json.dumps({
+            "model": model,
+            "messages": messages,
+            "temperature": temperature,
+            "tools": tools,
+            "sample": sample,
+        }, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _record(self, **counts):
+        # 作用域统计可能被同一个app的多个线程共享, 一起加锁
+        scope_stats = _scope_stats.get()
+        with self._lock:
+            self.stats.update(counts)
+            if scope_stats is not None:
+                scope_stats.update(counts)
+
+    def get(self, key):
+        """
+        命中时返回 ChatCompletion 对象, 否则返回 None
+        """
+        try:
+            with self._lock:
+                row = self._conn.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+                if row and not self.readonly:
+                    self._conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+                    self._conn.commit()
+        except sqlite3.Error:
+            self._record(errors=1, misses=1)
+            return None
+        if row is None:
+            self._record(misses=1)
+            return None
+        self._record(hits=1, bytes_read=len(row[0]))
+        return ChatCompletion.model_validate_json(row[0])
+
+    def put(self, key, completion):
+        if self.readonly:
+            return
+        value = completion.model_dump_json().encode("utf-8")
+        with self._lock:
+            total_bytes = self._total_bytes
+            try:
+                old = self._conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO responses (key, value, size, last_access) VALUES (?, ?, ?, ?)",
+                    (key, value, len(value), time.time()),
+                )
+                self._total_bytes += len(value) - (old[0] if old else 0)
+                evictions = self._evict()
+                self._conn.commit()
+            except sqlite3.Error:
+                # 写入失败时回滚, 缓存保持原样
+                self._total_bytes = total_bytes
+                try:
+                    self._conn.rollback()
+                except sqlite3.Error:
+                    pass
+                failed = True
+            else:
+                failed = False
+        if failed:
+            self._record(errors=1)
+            return
+        self._record(writes=1, bytes_written=len(value), evictions=evictions)
+
+    def _evict(self):
+        # 淘汰最久未访问的记录, 直到总大小降到 max_bytes 的 90% 以下
+        if self._total_bytes <= self.max_bytes:
+            return 0
+        target = self.max_bytes * 0.9
+        evictions = 0
+        while self._total_bytes > target:
+            rows = self._conn.execute("SELECT key, size FROM responses ORDER BY last_access LIMIT 256").fetchall()
+            if not rows:
+                break
+            # 只删除计入了大小的记录, 避免多删以及 _total_bytes 与实际大小不一致
+            evicted = []
+            for key, size in rows:
+                evicted.append((key,))
+                self._total_bytes -= size
+                if self._total_bytes <= target:
+                    break
+            self._conn.executemany("DELETE FROM responses WHERE key = ?", evicted)
+            evictions += len(evicted)
+        return evictions
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+@contextmanager
+def cache_stats_scope():
+    """
+    统计作用域内的缓存命中情况, 在同一线程或由其创建的 asyncio 任务中生效
+    """
+    stats = Counter()
+    token = _scope_stats.set(stats)
+    try:
+        yield stats
+    finally:
+        _scope_stats.reset(token)
+
+
+def record_cache_stats(stage, stats_root):
+    """
+    装饰 func(app_name, dataset), 把该app的缓存统计写入 firmproj_stats.json 的 {stage}_stats
+    外层有 record_app_stats 时随该app的其他统计一起写入
+    支持同步函数和 async 函数
+    """
+    def save(stats, app_name, dataset):
+        # 在 record_app_stats 作用域内时交给该app的累加器统一写入
+        app_stats = current_app_stats()
+        if stats and app_stats is not None:
+            app_stats.set_stats(stage, stats)
+            return
+        stats_path = os.path.join(stats_root, dataset, app_name, "firmproj_stats.json")
+        if stats and os.path.exists(os.path.dirname(stats_path)):
+            save_llm_stats(stats_path, stage, dict(stats))
+
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(app_name, dataset, *args, **kwargs):
+                with cache_stats_scope() as stats:
+                    result = await func(app_name, dataset, *args, **kwargs)
+                save(stats, app_name, dataset)
+                return result
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(app_name, dataset, *args, **kwargs):
+            with cache_stats_scope() as stats:
+                result = func(app_name, dataset, *args, **kwargs)
+            save(stats, app_name, dataset)
+            return result
+        return wrapper
+    return decorator
+
+
+def add_cache_args(parser, default_path):
+    parser.add_argument("--cache-path", default=default_path, help="LLM response cache (sqlite)")
+    parser.add_argument("--cache-max-mb", type=int, default=4096, help="LLM response cache size limit in MB")
+    parser.add_argument("--cache-readonly", action="store_true", help="only read from the cache, never write")
+    parser.add_argument("--no-cache", action="store_true", help="disable the LLM response cache")
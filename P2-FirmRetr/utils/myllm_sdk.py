@@ -1,6 +1,11 @@
 import time
+import random
+import asyncio
+import threading
+import weakref
 from json import JSONDecodeError
-from openai import OpenAI
+import httpx
+from openai import OpenAI, AsyncOpenAI, DefaultHttpxClient, DefaultAsyncHttpxClient
 from openai import (
     AuthenticationError,
     APITimeoutError,
@@ -11,11 +16,82 @@ from openai import (
 )
 from utils.get_api_key import get_api_key
 from utils.get_base_url import get_base_url
+from utils.llm_cache import ResponseCache
+from utils.rate_limiter import AdaptiveRateLimiter, estimate_tokens
 
 vonder = 'deepseek'
-API_KEY = get_api_key(vonder)
-BASE_URL = get_base_url(vonder)
-client = OpenAI(api_key=API_KEY, base_url=BASE_URL,)
+
+# 连接池配置, 所有线程、所有阶段共用同一个 client 及其连接池
+HTTP_MAX_CONNECTIONS = 64
+HTTP_MAX_KEEPALIVE_CONNECTIONS = 32
+HTTP_KEEPALIVE_EXPIRY = 120
+HTTP_CONNECT_TIMEOUT = 10
+
+# 按 vonder 注册的 client, 第一次使用时创建
+_clients = {}
+_clients_lock = threading.Lock()
+_client_stats = {}
+
+def _new_client(vendor):
+    # 只在创建 client 时读取一次 .env
+    http_client = DefaultHttpxClient(
+        limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS,
+                            max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY),
+        timeout=httpx.Timeout(360, connect=HTTP_CONNECT_TIMEOUT),
+    )
+    # 关闭 SDK 自带的重试, 由 call_with_retry 统一重试, 429 才能被限速器感知
+    return OpenAI(api_key=get_api_key(vendor), base_url=get_base_url(vendor), http_client=http_client, max_retries=0)
+
+def get_client(vendor=vonder) -> OpenAI:
+    """
+    获取 vendor 对应的共享 client (线程安全, 懒加载)
+    """
+    client = _clients.get(vendor)
+    if client is not None:
+        with _clients_lock:
+            _client_stats[vendor]["hits"] += 1
+        return client
+
+    with _clients_lock:
+        client = _clients.get(vendor)
+        if client is None:
+            client = _clients[vendor] = _new_client(vendor)
+            _client_stats[vendor] = {"hits": 0, "misses": 1}
+        else:
+            _client_stats[vendor]["hits"] += 1
+    return client
+
+def get_client_pool_stats() -> dict:
+    """
+    返回各个 vendor 的 client 复用情况及连接池中的连接数, 用于监控
+    """
+    stats = {}
+    with _clients_lock:
+        for vendor, client in _clients.items():
+            hits = _client_stats[vendor]["hits"]
+            misses = _client_stats[vendor]["misses"]
+            vendor_stats = {
+                "hits": hits,
+                "misses": misses,
+                "hit_rate": hits / (hits + misses),
+            }
+            # httpx 没有公开连接池信息, 从底层 httpcore 连接池中读取
+            try:
+                connections = client._client._transport._pool.connections
+                vendor_stats["connections"] = len(connections)
+                vendor_stats["idle_connections"] = sum(1 for connection in connections if connection.is_idle())
+            except AttributeError:
+                pass
+            stats[vendor] = vendor_stats
+    return stats
+
+def close_clients():
+    # 关闭所有 client 的连接池
+    with _clients_lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
 
 # 模型重定向
 def model_redirect(model):
@@ -42,7 +118,7 @@ def one_chat(message, model="deepseek-v3", temperature=0.5, timeout=300, max_tok
     
     if functions:
         # 如果使用了函数调用, 则传入对应参数
-        completion = client.chat.completions.create(
+        completion = get_client().chat.completions.create(
                     model=model,
                     messages=message,
                     timeout=timeout,
@@ -61,7 +137,7 @@ def one_chat(message, model="deepseek-v3", temperature=0.5, timeout=300, max_tok
     
     else:
         # 正常传参
-        completion = client.chat.completions.create(
+        completion = get_client().chat.completions.create(
                     model=model,
                     messages=message,
                     timeout=timeout,
@@ -90,7 +166,7 @@ def one_completion(message, model="deepseek-v3", temperature=0.5, timeout=300, m
 
     if functions:
         # 如果使用了函数调用, 则传入对应参数
-        completion = client.chat.completions.create(
+        completion = get_client().chat.completions.create(
                     model=model,
                     messages=message,
                     timeout=timeout,
@@ -101,7 +177,7 @@ def one_completion(message, model="deepseek-v3", temperature=0.5, timeout=300, m
                 )
     else:
         # 正常传参
-        completion = client.chat.completions.create(
+        completion = get_client().chat.completions.create(
                     model=model,
                     messages=message,
                     timeout=timeout,
@@ -110,210 +186,381 @@ def one_completion(message, model="deepseek-v3", temperature=0.5, timeout=300, m
                 ) 
     return completion
 
-def create_chat_completion(messages,model="deepseek-v3",temperature=0.5,timeout=360,max_tokens=8192,tools=None,tool_choice='auto'):
+# 重试配置
+MAX_RETRY = 4
+BASE_DELAY = 1 # 基础等待时间
+
+def get_error_info(e, timeout):
     """
-    带异常处理的API调用函数, 有自动重试机制
-    返回结果(success, result)
-    - success=True 时 result 为 completion 对象
-    - success=False 时 result 为错误字典
+    将 API 调用抛出的异常转换为错误字典, retryable 表示是否可以重试
+    """
+    if isinstance(e, AuthenticationError):
+        return {
+            # "error_code": "AUTHENTICATION_ERROR",
+            "error_code": e,
+            "message": "API 认证失败，请检查 API KEY 和权限",
+            "retryable": False
+        }
+    elif isinstance(e, BadRequestError):
+        return {
+            # "error_code": "BadRequestError",
+            "error_code": e,
+            "message": f"无效请求参数: {str(e)} or 检查网络问题",
+            "retryable": False
+        }
+    elif isinstance(e, APITimeoutError):
+        return {
+            # "error_code": "TIMEOUT",
+            "error_code": e,
+            "message": f"请求超时({timeout}s)",
+            "retryable": True
+        }
+    elif isinstance(e, RateLimitError):
+        return {
+            # "error_code": "RATE_LIMIT",
+            "error_code": e,
+            "message": "请求频率过高，触发速率限制",
+            "retryable": True
+        }
+    elif isinstance(e, APIConnectionError):
+        return {
+            # "error_code": "API_CONNECTION_ERROR",
+            "error_code": e,
+            "message": "API连接错误",
+            "retryable": True
+        }
+    elif isinstance(e, APIError):
+        return {
+            # "error_code": "API_ERROR",
+            "error_code": e,
+            "message": "API服务暂时不可用",
+            "retryable": True
+        }
+    elif isinstance(e, JSONDecodeError):
+        return {
+            # "error_code": "JSON_DECODE_ERROR",
+            "error_code": e,
+            "message": "deepseek API JSON解析错误",
+            "retryable": True
+        }
+    else:
+        return {
+            # "error_code": "UNKNOWN_ERROR",
+            "error_code": e,
+            "message": f"未知错误: {str(e)}",
+            "retryable": False
+        }
+
+def get_retry_delay(retry_count):
+    # 指数退避 + 随机抖动
+    return BASE_DELAY * (2 ** retry_count) + random.uniform(0, BASE_DELAY)
+
+# 所有线程、所有事件循环共享的限速器, 由 setup_rate_limiter 按命令行参数重新配置
+rate_limiter = AdaptiveRateLimiter()
+
+def setup_rate_limiter(args):
+    """
+    根据命令行参数(utils.rate_limiter.add_rate_limit_args 以及 --concurrency)配置限速器
     """
+    global rate_limiter
+    rate_limiter = AdaptiveRateLimiter(rpm=args.rpm, tpm=args.tpm, max_concurrency=args.concurrency,
+                                       latency_target=args.latency_target)
+    return rate_limiter
+
+def rate_limiter_stats() -> dict:
+    return rate_limiter.snapshot()
 
-    max_retry = 4
+def get_error_delay(error_info, retry_count):
+    # 429 的等待由限速器统一处理(Retry-After 期间暂停所有请求), 其余错误指数退避
+    if isinstance(error_info.get("error_code"), RateLimitError):
+        return 0
+    return get_retry_delay(retry_count)
+
+def check_chat_completion(completion):
+    # 普通对话: 输出被截断时不可重试
+    if completion.choices[0].finish_reason == "length":
+        error_info = {
+            "error_code": "MAX_OUTPUT_LENGTH",
+            "message": "达到模型输出最大长度",
+            "retryable": False
+        }
+        return (False, error_info)
+    else:
+        return (True, completion)
+
+def check_tool_completion(completion):
+    # 函数调用: 没有生成函数调用时重试
+    if completion.choices[0].message.tool_calls:
+        return (True, completion)
+    else:
+        error_info = {
+            "error_code": "未生成函数调用",
+            "message": "LLM返回的函数调用为空, 请检查LLM的配置是否正确",
+            "retryable": True
+        }
+        return (False, error_info)
+
+def call_with_retry(create, check, timeout, tokens=0):
+    """
+    调用 create() 并用 check 检查结果, 可重试的错误按指数退避重试
+    每次请求前从限速器获取额度, tokens 为预估的 token 数
+    返回结果(success, result)
+    """
     retry_count = 0
-    base_delay = 1 # 基础等待时间
 
-    while retry_count < max_retry:
+    while retry_count < MAX_RETRY:
+        ticket = rate_limiter.acquire(tokens)
+        completion, error = None, None
         try:
-            completion = client.chat.completions.create(
-                model=model,
-                messages=messages,
-                temperature=temperature,
-                max_tokens=max_tokens,
-                timeout=timeout,
-                # response_format={
-                #     'type': 'json_object'
-                # }
-                # tools=tools,
-                # tool_choice=tool_choice,   
-            )
-
-            if completion.choices[0].finish_reason == "length":
-                error_info = {
-                    "error_code": "MAX_OUTPUT_LENGTH",
-                    "message": "达到模型输出最大长度",
-                    "retryable": False
-                }
-                return (False, error_info)
-            else:
-                return (True, completion)
-        
-        except AuthenticationError as e:
-            error_info = {
-                # "error_code": "AUTHENTICATION_ERROR",
-                "error_code": e,
-                "message": "API 认证失败，请检查 API KEY 和权限",
-                "retryable": False
-            }
-            return (False, error_info)
-        except BadRequestError as e:
-            error_info = {
-                # "error_code": "BadRequestError",
-                "error_code": e,
-                "message": f"无效请求参数: {str(e)} or 检查网络问题",
-                "retryable": False
-            }
-            return (False, error_info)
-        except APITimeoutError as e:
-            error_info = {
-                # "error_code": "TIMEOUT",
-                "error_code": e,
-                "message": f"请求超时({timeout}s)",
-                "retryable": True
-            }
-        except RateLimitError as e:
-            error_info = {
-                # "error_code": "RATE_LIMIT",
-                "error_code": e,
-                "message": "请求频率过高，触发速率限制",
-                "retryable": True
-            }
-        except APIConnectionError as e:
-            error_info = {
-                # "error_code": "API_CONNECTION_ERROR",
-                "error_code": e,
-                "message": "API连接错误",
-                "retryable": True
-            }
-        except APIError as e:
-            error_info = {
-                # "error_code": "API_ERROR",
-                "error_code": e,
-                "message": "API服务暂时不可用",
-                "retryable": True
-            } 
-        except JSONDecodeError as e:
-            error_info = {
-                # "error_code": "JSON_DECODE_ERROR",
-                "error_code": e,
-                "message": "deepseek API JSON解析错误",
-                "retryable": True
-            }
+            completion = create()
         except Exception as e:
-            error_info = {
-                # "error_code": "UNKNOWN_ERROR",
-                "error_code": e,
-                "message": f"未知错误: {str(e)}",
-                "retryable": False
-            }
-            return (False, error_info)
+            error = e
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            # 取消或 KeyboardInterrupt 时同样归还并发额度
+            rate_limiter.release(ticket, completion=completion, error=error)
+        if error is not None:
+            error_info = get_error_info(error, timeout)
+        else:
+            success, result = check(completion)
+            if success:
+                return (True, result)
+            error_info = result
+
         # 处理可重试的错误
         if error_info.get("retryable", False):
-            if retry_count < max_retry:
-                # 指数退避 + 随机抖动
-                delay = base_delay * (2 ** retry_count) + 0.1 * retry_count
-                time.sleep(delay)
-                retry_count += 1
-                continue
+            time.sleep(get_error_delay(error_info, retry_count))
+            retry_count += 1
+            continue
 
         break  # 不可重试错误或达到最大重试次数
     
     return (False, error_info)
 
+# 持久化响应缓存, 默认关闭, 由 enable_response_cache 开启
+response_cache = None
+
+def enable_response_cache(path, max_bytes=4 * 1024 ** 3, readonly=False):
+    """
+    开启 LLM 响应缓存, 相同 (model, messages, temperature, tools) 的请求直接返回缓存结果, 不再访问网络
+    """
+    global response_cache
+    response_cache = ResponseCache(path, max_bytes=max_bytes, readonly=readonly)
+    return response_cache
+
+def setup_response_cache(args):
+    # 根据命令行参数(utils.llm_cache.add_cache_args)开启缓存
+    if args.no_cache or not args.cache_path:
+        return None
+    return enable_response_cache(args.cache_path, args.cache_max_mb * 1024 * 1024, args.cache_readonly)
+
+def response_cache_stats() -> dict:
+    # 全局的缓存命中/未命中/字节数统计
+    if response_cache is None:
+        return {}
+    return dict(response_cache.stats)
+
+def get_cache_key(model, messages, temperature, tools=None, cache_sample=None):
+    if response_cache is None:
+        return None
+    return response_cache.make_key(model, messages, temperature, tools=tools, sample=cache_sample)
+
+def get_cached_completion(cache_key):
+    if cache_key is None:
+        return None
+    return response_cache.get(cache_key)
+
+def put_cached_completion(cache_key, success, result):
+    # 只缓存成功的结果
+    if cache_key is not None and success:
+        response_cache.put(cache_key, result)
+
+async def aget_cached_completion(cache_key):
+    # SQLite 读写可能等待其他进程的写锁, 放到线程中执行, 不阻塞事件循环
+    if cache_key is None:
+        return None
+    return await asyncio.to_thread(response_cache.get, cache_key)
+
+async def aput_cached_completion(cache_key, success, result):
+    if cache_key is not None and success:
+        await asyncio.to_thread(response_cache.put, cache_key, result)
+
+def create_chat_completion(messages,model="deepseek-v3",temperature=0.5,timeout=360,max_tokens=8192,tools=None,tool_choice='auto',cache_sample=None):
+    """
+    带异常处理的API调用函数, 有自动重试机制
+    返回结果(success, result)
+    - success=True 时 result 为 completion 对象
+    - success=False 时 result 为错误字典
+    cache_sample: 同一输入需要多次采样时(如多轮投票)用于区分缓存
+    """
+    cache_key = get_cache_key(model, messages, temperature, cache_sample=cache_sample)
+    cached = get_cached_completion(cache_key)
+    if cached is not None:
+        return (True, cached)
+
+    def create():
+        return get_client().chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            timeout=timeout,
+            # response_format={
+            #     'type': 'json_object'
+            # }
+            # tools=tools,
+            # tool_choice=tool_choice,   
+        )
+
+    success, result = call_with_retry(create, check_chat_completion, timeout, estimate_tokens(messages, max_tokens))
+    put_cached_completion(cache_key, success, result)
+    return (success, result)
+
 def dp_official_create_chat_completion(messages,model="deepseek-v3",temperature=0.5,timeout=360,max_tokens=8192,tools=None,tool_choice='auto'):
-    vonder = 'deepseek'
-    API_KEY = get_api_key(vonder)
-    BASE_URL = get_base_url(vonder)
-    local_client = OpenAI(api_key=API_KEY, base_url=BASE_URL,)
-    max_retry = 4
+    cache_key = get_cache_key(model, messages, temperature, tools=tools)
+    cached = get_cached_completion(cache_key)
+    if cached is not None:
+        return (True, cached)
+
+    # 函数调用只使用 deepseek 官方接口
+    local_client = get_client('deepseek')
+
+    def create():
+        return local_client.chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            timeout=timeout,
+            tools=tools,
+            tool_choice=tool_choice,   
+        )
+
+    success, result = call_with_retry(create, check_tool_completion, timeout, estimate_tokens(messages, max_tokens))
+    put_cached_completion(cache_key, success, result)
+    return (success, result)
+
+# ---------------- asyncio 版本 ----------------
+# AsyncOpenAI client 与事件循环绑定, 按事件循环分别保存; 并发上限由 rate_limiter 统一控制
+ASYNC_MAX_CONCURRENCY = 100
+_async_clients = weakref.WeakKeyDictionary()
+
+def set_async_concurrency(limit):
+    """
+    设置 AsyncOpenAI 连接池的大小(不小于同时进行的 LLM 请求数), 需要在事件循环开始发请求之前调用
+    """
+    global ASYNC_MAX_CONCURRENCY
+    ASYNC_MAX_CONCURRENCY = limit
+
+def get_async_client(vendor=vonder) -> AsyncOpenAI:
+    """
+    获取当前事件循环中 vendor 对应的共享 AsyncOpenAI client
+    """
+    loop = asyncio.get_running_loop()
+    clients = _async_clients.setdefault(loop, {})
+    client = clients.get(vendor)
+    if client is None:
+        http_client = DefaultAsyncHttpxClient(
+            limits=httpx.Limits(max_connections=max(HTTP_MAX_CONNECTIONS, ASYNC_MAX_CONCURRENCY),
+                                max_keepalive_connections=max(HTTP_MAX_KEEPALIVE_CONNECTIONS, ASYNC_MAX_CONCURRENCY),
+                                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY),
+            timeout=httpx.Timeout(360, connect=HTTP_CONNECT_TIMEOUT),
+        )
+        client = clients[vendor] = AsyncOpenAI(api_key=get_api_key(vendor), base_url=get_base_url(vendor),
+                                               http_client=http_client, max_retries=0)
+    return client
+
+async def aclose_clients():
+    # 关闭当前事件循环中的所有 AsyncOpenAI client
+    loop = asyncio.get_running_loop()
+    for client in _async_clients.pop(loop, {}).values():
+        await client.close()
+
+async def acall_with_retry(create, check, timeout, tokens=0):
+    """
+    call_with_retry 的异步版本, create 返回协程; 只有请求本身占用限速器的并发额度, 退避等待不占用
+    """
     retry_count = 0
-    base_delay = 1 # 基础等待时间
 
-    while retry_count < max_retry:
+    while retry_count < MAX_RETRY:
+        ticket = await rate_limiter.aacquire(tokens)
+        completion, error = None, None
         try:
-            completion = local_client.chat.completions.create(
-                model=model,
-                messages=messages,
-                temperature=temperature,
-                max_tokens=max_tokens,
-                timeout=timeout,
-                tools=tools,
-                tool_choice=tool_choice,   
-            )
-            # 如果生成了函数调用
-            if completion.choices[0].message.tool_calls:
-                return (True, completion)
-            else:
-                error_info = {
-                    "error_code": "未生成函数调用",
-                    "message": "LLM返回的函数调用为空, 请检查LLM的配置是否正确",
-                    "retryable": True
-                }
-        
-        except AuthenticationError as e:
-            error_info = {
-                # "error_code": "AUTHENTICATION_ERROR",
-                "error_code": e,
-                "message": "API 认证失败，请检查 API KEY 和权限",
-                "retryable": False
-            }
-            return (False, error_info)
-        except BadRequestError as e:
-            error_info = {
-                # "error_code": "BadRequestError",
-                "error_code": e,
-                "message": f"无效请求参数: {str(e)} or 检查网络问题",
-                "retryable": False
-            }
-            return (False, error_info)
-        except APITimeoutError as e:
-            error_info = {
-                # "error_code": "TIMEOUT",
-                "error_code": e,
-                "message": f"请求超时({timeout}s)",
-                "retryable": True
-            }
-        except RateLimitError as e:
-            error_info = {
-                # "error_code": "RATE_LIMIT",
-                "error_code": e,
-                "message": "请求频率过高，触发速率限制",
-                "retryable": True
-            }
-        except APIConnectionError as e:
-            error_info = {
-                # "error_code": "API_CONNECTION_ERROR",
-                "error_code": e,
-                "message": "API连接错误",
-                "retryable": True
-            }
-        except APIError as e:
-            error_info = {
-                # "error_code": "API_ERROR",
-                "error_code": e,
-                "message": "API服务暂时不可用",
-                "retryable": True
-            } 
+            completion = await create()
         except Exception as e:
-            error_info = {
-                # "error_code": "UNKNOWN_ERROR",
-                "error_code": e,
-                "message": f"未知错误: {str(e)}",
-                "retryable": False
-            }
-            return (False, error_info)
+            error = e
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            # 取消或 KeyboardInterrupt 时同样归还并发额度
+            rate_limiter.release(ticket, completion=completion, error=error)
+        if error is not None:
+            error_info = get_error_info(error, timeout)
+        else:
+            success, result = check(completion)
+            if success:
+                return (True, result)
+            error_info = result
+
         # 处理可重试的错误
         if error_info.get("retryable", False):
-            if retry_count < max_retry:
-                # 指数退避 + 随机抖动
-                delay = base_delay * (2 ** retry_count) + 0.1 * retry_count
-                time.sleep(delay)
-                retry_count += 1
-                continue
+            await asyncio.sleep(get_error_delay(error_info, retry_count))
+            retry_count += 1
+            continue
 
         break  # 不可重试错误或达到最大重试次数
-    
+
     return (False, error_info)
 
+async def acreate_chat_completion(messages,model="deepseek-v3",temperature=0.5,timeout=360,max_tokens=8192,tools=None,tool_choice='auto',cache_sample=None):
+    """
+    create_chat_completion 的异步版本, 返回结果(success, result)
+    """
+    cache_key = get_cache_key(model, messages, temperature, cache_sample=cache_sample)
+    cached = await aget_cached_completion(cache_key)
+    if cached is not None:
+        return (True, cached)
+
+    def create():
+        return get_async_client().chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            timeout=timeout,
+        )
+
+    success, result = await acall_with_retry(create, check_chat_completion, timeout, estimate_tokens(messages, max_tokens))
+    await aput_cached_completion(cache_key, success, result)
+    return (success, result)
+
+async def adp_official_create_chat_completion(messages,model="deepseek-v3",temperature=0.5,timeout=360,max_tokens=8192,tools=None,tool_choice='auto'):
+    """
+    dp_official_create_chat_completion 的异步版本, 返回结果(success, result)
+    """
+    cache_key = get_cache_key(model, messages, temperature, tools=tools)
+    cached = await aget_cached_completion(cache_key)
+    if cached is not None:
+        return (True, cached)
+
+    def create():
+        return get_async_client('deepseek').chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            timeout=timeout,
+            tools=tools,
+            tool_choice=tool_choice,
+        )
+
+    success, result = await acall_with_retry(create, check_tool_completion, timeout, estimate_tokens(messages, max_tokens))
+    await aput_cached_completion(cache_key, success, result)
+    return (success, result)
+
 def get_prompt_content(file_path):
     # 从文件中读取prompt
     with open(file_path, 'r', encoding='utf-8') as f:
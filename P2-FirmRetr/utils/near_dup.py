@@ -0,0 +1,233 @@
+import os
+import re
+import json
+import sqlite3
+import struct
+import hashlib
+import argparse
+import threading
+from collections import Counter
+from utils.request_dedup import canonicalize, dedup_fingerprint
+
+# MinHash 使用的梅森素数及签名长度, 分为 NUM_BANDS 个 band 做 LSH
+_PRIME = (1 << 61) - 1
+NUM_PERM = 64
+NUM_BANDS = 16
+
+# phase2 把 dynamic/null 字段视为缺失值, 这些标记与具体的值分开, 保留为独立的 token
+_dynamic = re.compile(r"<dynamic[^>]*>")
+_null = re.compile(r"(?<![\w<])null(?![\w>])")
+_placeholder = re.compile(r"\$?\{[a-z_][\w.-]*\}|%[sd](?![0-9a-f])")
+MISSING_MARKERS = ("<dynamic>", "<null>", "<placeholder>")
+# 只替换具体的主机名(域名或IP), 占位符形式的主机保持原样
+_url_host = re.compile(r"(?<=://)[a-z0-9-]+(?:\.[a-z0-9-]+)+(?![\w.<{$-])")
+_digits = re.compile(r"\d+")
+_hex = re.compile(r"\b[0-9a-f]{8,}\b")
+_token = re.compile(r"[a-z_]+|<[a-z]+>|[^\sa-z_]")
+
+
+def normalize_value(value):
+    """
+    请求值的归一化形式: 小写, dynamic/null/占位符替换为 <dynamic>/<null>/<placeholder>,
+    具体的主机名替换为 <host>, 长十六进制串替换为 <hex>, 数字替换为 <num>
+    只在具体的主机名、版本号上不同的请求值因此得到相同或相近的 token 序列, 缺失值与具体值不会混同
+    """
+    text = canonicalize(value).lower()
+    text = _dynamic.sub("<dynamic>", text)
+    text = _null.sub("<null>", text)
+    text = _placeholder.sub("<placeholder>", text)
+    text = _url_host.sub("<host>", text)
+    text = _hex.sub("<hex>", text)
+    return _digits.sub("<num>", text)
+
+
+def has_missing_fields(value):
+    # 请求值中是否有 dynamic/null/占位符字段, 只在相同的情况下复用标签
+    text = normalize_value(value)
+    return any(marker in text for marker in MISSING_MARKERS)
+
+
+def shingles(value, size=3):
+    # 归一化后按 token 切分, 取连续 size 个 token 作为 shingle
+    tokens = _token.findall(normalize_value(value))
+    if len(tokens) <= size:
+        return {" ".join(tokens)}
+    return {" ".join(tokens[index:index + size]) for index in range(len(tokens) - size + 1)}
+
+
+def _permutations(num_perm):
+    # 固定种子生成的 (a, b), 不同进程、不同运行的签名可以直接比较
+    perms = []
+    for index in range(num_perm):
+        digest = hashlib.blake2b(f"minhash-{index}".encode("utf-8"), digest_size=16).digest()
+        a, b = struct.unpack("<QQ", digest)
+        perms.append((a % (_PRIME - 1) + 1, b % _PRIME))
+    return perms
+
+
+_PERMS = _permutations(NUM_PERM)
+
+
+def minhash(value):
+    hashes = [struct.unpack("<Q", hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest())[0]
+              for shingle in shingles(value)]
+    return [min((a * h + b) % _PRIME for h in hashes) for a, b in _PERMS]
+
+
+def estimate_similarity(signature, other):
+    # 两个签名相同位置相等的比例, 即 Jaccard 相似度的估计
+    return sum(1 for x, y in zip(signature, other) if x == y) / len(signature)
+
+
+class NearDupIndex:
+    """
+    请求值的 MinHash/LSH 近似重复索引, 以请求值指纹为键保存 phase2 的投票结果 (SQLite, 跨运行增量构建)
+    lookup 在候选中选相似度最高、且达到 similarity 阈值的代表请求; 代表请求投票的一致性低于 min_confidence 时不复用
+    代表请求与当前请求是否含有缺失值(has_missing_fields)必须相同, 两者在 phase2 中属于不同的类别
+    """
+
+    def __init__(self, path, similarity=0.8, min_confidence=0.8, audit_rate=0.0):
+        self.path = path
+        self.similarity = similarity
+        self.min_confidence = min_confidence
+        self.audit_rate = audit_rate
+        self.rows_per_band = NUM_PERM // NUM_BANDS
+        self.stats = Counter()
+        self._lock = threading.Lock()
+        self._signatures = {}
+        self._results = {}
+        self._buckets = [{} for _ in range(NUM_BANDS)]
+        index_dir = os.path.dirname(path)
+        if index_dir and not os.path.exists(index_dir):
+            os.makedirs(index_dir, exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS signatures ("
+            "fingerprint TEXT PRIMARY KEY, signature TEXT NOT NULL, result TEXT NOT NULL)"
+        )
+        self._conn.commit()
+        for fingerprint, signature, result in self._conn.execute("SELECT fingerprint, signature, result FROM signatures"):
+            self._insert(fingerprint, json.loads(signature), json.loads(result))
+
+    def _bands(self, signature):
+        rows = self.rows_per_band
+        return [tuple(signature[band * rows:(band + 1) * rows]) for band in range(NUM_BANDS)]
+
+    def _insert(self, fingerprint, signature, result):
+        self._signatures[fingerprint] = signature
+        self._results[fingerprint] = result
+        for buckets, band in zip(self._buckets, self._bands(signature)):
+            buckets.setdefault(band, set()).add(fingerprint)
+
+    def lookup(self, value):
+        """
+        返回 (代表请求的投票结果, 相似度), 没有可复用的近似重复时返回 (None, 相似度)
+        """
+        signature = minhash(value)
+        missing = has_missing_fields(value)
+        best, best_similarity = None, 0.0
+        with self._lock:
+            self.stats["lookups"] += 1
+            candidates = set()
+            for buckets, band in zip(self._buckets, self._bands(signature)):
+                candidates.update(buckets.get(band, ()))
+            for fingerprint in candidates:
+                # 之前版本的索引没有记录 missing, 不复用
+                if self._results[fingerprint].get("missing") is not missing:
+                    continue
+                similarity = estimate_similarity(signature, self._signatures[fingerprint])
+                if similarity > best_similarity:
+                    best, best_similarity = fingerprint, similarity
+            if best is None or best_similarity < self.similarity:
+                return None, best_similarity
+            result = self._results[best]
+            if result.get("consistency_core", 0) < self.min_confidence:
+                self.stats["low_confidence"] += 1
+                return None, best_similarity
+            self.stats["hits"] += 1
+        return result, best_similarity
+
+    def add(self, value, result):
+        # 投票完成的请求加入索引, 作为后续近似重复请求的代表
+        fingerprint = dedup_fingerprint(value)
+        signature = minhash(value)
+        stored = {"most_common_label": result["most_common_label"],
+                  "consistency_core": result["consistency_core"],
+                  "prediction_entry": result["prediction_entry"],
+                  "counter": dict(result["counter"]),
+                  "missing": has_missing_fields(value)}
+        with self._lock:
+            if fingerprint in self._signatures:
+                return
+            self._insert(fingerprint, signature, stored)
+            self._conn.execute("INSERT OR REPLACE INTO signatures (fingerprint, signature, result) VALUES (?, ?, ?)",
+                               (fingerprint, json.dumps(signature), json.dumps(stored, ensure_ascii=False, default=str)))
+            self._conn.commit()
+            self.stats["indexed"] += 1
+
+    def should_audit(self, value):
+        # 按指纹确定是否抽检, 同一个请求值在不同运行中的抽检结果相同
+        if self.audit_rate <= 0:
+            return False
+        return int(dedup_fingerprint(value)[:8], 16) / 0xFFFFFFFF < self.audit_rate
+
+    def record_audit(self, reused_label, voted_label):
+        with self._lock:
+            self.stats["audited"] += 1
+            self.stats["audit_agree" if reused_label == voted_label else "audit_disagree"] += 1
+
+    def summary(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["size"] = len(self._signatures)
+        audited = stats.get("audited", 0)
+        if audited:
+            stats["audit_agreement"] = round(stats.get("audit_agree", 0) / audited, 4)
+        return stats
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+near_dup_index = None
+
+
+def setup_near_dup(args):
+    # 根据命令行参数(add_near_dup_args)开启近似重复复用
+    global near_dup_index
+    if args.near_dup and args.near_dup_path:
+        near_dup_index = NearDupIndex(args.near_dup_path, args.near_dup_similarity,
+                                      args.near_dup_confidence, args.near_dup_audit_rate)
+    return near_dup_index
+
+
+def near_dup_stats() -> dict:
+    if near_dup_index is None:
+        return {}
+    return near_dup_index.summary()
+
+
+def add_near_dup_args(parser, default_path):
+    parser.add_argument("--near-dup", action="store_true",
+                        help="reuse the phase2 label of a near-duplicate request (MinHash/LSH over normalized values)")
+    parser.add_argument("--near-dup-path", default=default_path, help="near-duplicate index (sqlite)")
+    parser.add_argument("--near-dup-similarity", type=float, default=0.8,
+                        help="min estimated Jaccard similarity to the representative request")
+    parser.add_argument("--near-dup-confidence", type=float, default=0.8,
+                        help="min voting consistency of the representative request")
+    parser.add_argument("--near-dup-audit-rate", type=float, default=0.0,
+                        help="fraction of near-duplicate hits still voted to check label agreement")
+
+
+if __name__ == "__main__":
+    # 查看两个请求值的归一化形式和相似度: python3 -m utils.near_dup '<value1>' '<value2>'
+    parser = argparse.ArgumentParser(description="show normalized forms and MinHash similarity of two request values")
+    parser.add_argument("values", nargs=2)
+    args = parser.parse_args()
+
+    for value in args.values:
+        print(normalize_value(value), "(missing fields)" if has_missing_fields(value) else "")
+    print(f"similarity: {estimate_similarity(minhash(args.values[0]), minhash(args.values[1])):.2f}")
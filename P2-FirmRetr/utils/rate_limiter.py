@@ -0,0 +1,264 @@
+import time
+import json
+import random
+import asyncio
+import threading
+from email.utils import parsedate_to_datetime
+from collections import Counter
+
+# 令牌桶允许的突发量: 桶容量等于 BURST_SECONDS 秒内的配额
+BURST_SECONDS = 10
+# AIMD: 两次乘性减小之间至少间隔 DECREASE_COOLDOWN 秒, 避免一次 429 风暴把并发降到底
+DECREASE_COOLDOWN = 5
+DECREASE_FACTOR = 0.5
+# 没有设置 latency_target 时, 延迟超过 EWMA 基线的 LATENCY_FACTOR 倍视为拥塞
+LATENCY_FACTOR = 3
+LATENCY_WARMUP = 20
+# 429 没有 Retry-After 时的等待时间, 连续 429 时指数增长
+RATE_LIMIT_BASE_DELAY = 1
+RATE_LIMIT_MAX_DELAY = 60
+
+
+class TokenBucket:
+    """
+    预约式令牌桶: reserve 立即扣除额度并返回需要等待的秒数, 额度可以透支
+    rate_per_minute <= 0 表示不限制
+    """
+
+    def __init__(self, rate_per_minute):
+        self.rate = rate_per_minute / 60
+        self.capacity = max(1, self.rate * BURST_SECONDS)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount, now):
+        if self.rate <= 0:
+            return 0
+        self._refill(now)
+        self.level -= amount
+        return -self.level / self.rate if self.level < 0 else 0
+
+    def adjust(self, amount, now):
+        # 实际用量与预估不同时补扣或退还
+        if self.rate <= 0:
+            return
+        self._refill(now)
+        self.level = min(self.capacity, self.level - amount)
+
+
+def estimate_tokens(messages, max_tokens=0):
+    """
+    粗略估计一次请求的 token 数(约 3 个字符一个 token), 请求完成后用实际 usage 校正
+    """
+    return len(json.dumps(messages, ensure_ascii=False)) // 3 + min(max_tokens or 0, 1024)
+
+
+def get_retry_after(e):
+    """
+    从 429 响应中读取 Retry-After (秒数或 HTTP 日期), 没有时返回 None
+    """
+    response = getattr(e, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    if headers.get("retry-after-ms"):
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class AdaptiveRateLimiter:
+    """
+    所有线程/协程共享的 LLM 请求限速器
+    - 每分钟请求数 (RPM) 和每分钟 token 数 (TPM) 两个令牌桶
+    - 并发上限按 AIMD 调整: 请求正常时加性增大, 出现 429 或延迟过高时乘性减小
+    - 收到 429 时按 Retry-After (没有则指数退避) 暂停所有新请求
+    同步调用使用 acquire/release, asyncio 中使用 aacquire/release
+    """
+
+    def __init__(self, rpm=0, tpm=0, max_concurrency=64, min_concurrency=1, latency_target=None):
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._async_waiters = []
+        self._requests = TokenBucket(rpm)
+        self._tokens = TokenBucket(tpm)
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min(min_concurrency, max_concurrency)
+        self.concurrency = float(max_concurrency)
+        self.latency_target = latency_target
+        self._latency_ewma = None
+        self._latency_samples = 0
+        self._in_flight = 0
+        self._blocked_until = 0
+        self._last_decrease = 0
+        self._consecutive_rate_limits = 0
+        self.stats = Counter()
+
+    def _try_take_slot(self):
+        if self._in_flight < max(self.min_concurrency, int(self.concurrency)):
+            self._in_flight += 1
+            return True
+        return False
+
+    def _wake(self):
+        # 唤醒等待空闲并发的线程和协程, 醒来后重新检查
+        free = max(self.min_concurrency, int(self.concurrency)) - self._in_flight
+        if free <= 0:
+            return
+        self._cond.notify(free)
+        while free > 0 and self._async_waiters:
+            loop, future = self._async_waiters.pop(0)
+            if future.done():
+                continue
+            loop.call_soon_threadsafe(_set_waiter_result, future)
+            free -= 1
+
+    def _reserve(self, tokens):
+        # 扣除 RPM/TPM 额度, 返回需要等待的秒数
+        now = time.monotonic()
+        wait = max(self._requests.reserve(1, now), self._tokens.reserve(tokens, now), self._blocked_until - now)
+        self.stats["requests"] += 1
+        if wait > 0:
+            self.stats["throttled"] += 1
+            self.stats["throttle_wait_seconds"] += wait
+        return wait
+
+    def acquire(self, tokens=0):
+        """
+        阻塞直到可以发出请求, 返回传给 release 的凭据
+        """
+        with self._cond:
+            while not self._try_take_slot():
+                self._cond.wait()
+            wait = self._reserve(tokens)
+        if wait > 0:
+            try:
+                time.sleep(wait)
+            except BaseException as e:
+                # 等待额度时被中断, 归还已经占用的并发额度
+                self.release((time.monotonic(), tokens), error=e)
+                raise
+        return (time.monotonic(), tokens)
+
+    async def aacquire(self, tokens=0):
+        # acquire 的异步版本
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._lock:
+                if self._try_take_slot():
+                    wait = self._reserve(tokens)
+                    break
+                future = loop.create_future()
+                waiter = (loop, future)
+                self._async_waiters.append(waiter)
+            try:
+                await future
+            except asyncio.CancelledError:
+                with self._lock:
+                    if waiter in self._async_waiters:
+                        self._async_waiters.remove(waiter)
+                    else:
+                        # 已经被唤醒, 把这次唤醒交给下一个等待者
+                        self._wake()
+                raise
+        if wait > 0:
+            try:
+                await asyncio.sleep(wait)
+            except BaseException as e:
+                self.release((time.monotonic(), tokens), error=e)
+                raise
+        return (time.monotonic(), tokens)
+
+    def release(self, ticket, completion=None, error=None):
+        """
+        请求结束后调用: 校正 token 用量, 根据结果和延迟调整并发上限
+        """
+        start, reserved_tokens = ticket
+        now = time.monotonic()
+        latency = now - start
+        with self._lock:
+            self._in_flight -= 1
+            usage = getattr(completion, "usage", None)
+            if usage is not None:
+                self._tokens.adjust(usage.total_tokens - reserved_tokens, now)
+
+            if error is not None and getattr(error, "status_code", None) == 429:
+                self._on_rate_limited(error, now)
+            elif error is None:
+                self._consecutive_rate_limits = 0
+                if self._is_congested(latency):
+                    self._decrease(now, "latency_decreases")
+                else:
+                    self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+                self._update_latency(latency)
+            self._wake()
+
+    def _on_rate_limited(self, error, now):
+        self.stats["rate_limited"] += 1
+        retry_after = get_retry_after(error)
+        if retry_after is not None:
+            self.stats["retry_after"] += 1
+        else:
+            retry_after = min(RATE_LIMIT_MAX_DELAY, RATE_LIMIT_BASE_DELAY * 2 ** self._consecutive_rate_limits)
+            retry_after += random.uniform(0, RATE_LIMIT_BASE_DELAY)
+        self._consecutive_rate_limits += 1
+        self._blocked_until = max(self._blocked_until, now + retry_after)
+        self._decrease(now, "rate_limit_decreases")
+
+    def _decrease(self, now, reason):
+        if now - self._last_decrease < DECREASE_COOLDOWN:
+            return
+        self._last_decrease = now
+        self.concurrency = max(self.min_concurrency, self.concurrency * DECREASE_FACTOR)
+        self.stats[reason] += 1
+
+    def _is_congested(self, latency):
+        if self.latency_target:
+            return latency > self.latency_target
+        if self._latency_samples < LATENCY_WARMUP:
+            return False
+        return latency > self._latency_ewma * LATENCY_FACTOR
+
+    def _update_latency(self, latency):
+        self._latency_samples += 1
+        if self._latency_ewma is None:
+            self._latency_ewma = latency
+        else:
+            self._latency_ewma = 0.9 * self._latency_ewma + 0.1 * latency
+
+    def snapshot(self) -> dict:
+        # 统计信息及当前并发上限, 用于日志
+        with self._lock:
+            stats = dict(self.stats)
+            stats["throttle_wait_seconds"] = round(stats.get("throttle_wait_seconds", 0), 3)
+            stats["concurrency"] = round(self.concurrency, 2)
+            stats["in_flight"] = self._in_flight
+            return stats
+
+
+def _set_waiter_result(future):
+    if not future.done():
+        future.set_result(None)
+
+
+def add_rate_limit_args(parser, rpm, tpm):
+    parser.add_argument("--rpm", type=int, default=rpm, help="max LLM requests per minute, 0 = unlimited")
+    parser.add_argument("--tpm", type=int, default=tpm, help="max LLM tokens per minute, 0 = unlimited")
+    parser.add_argument("--latency-target", type=float, default=None,
+                        help="LLM latency (s) above which concurrency is reduced, default: 3x observed average")
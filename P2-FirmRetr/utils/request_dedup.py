@@ -0,0 +1,255 @@
+import os
+import re
+import json
+import asyncio
+import sqlite3
+import hashlib
+import argparse
+import threading
+from collections import Counter
+from concurrent.futures import Future
+
+_whitespace = re.compile(r"\s+")
+
+
+def canonicalize(value):
+    """
+    请求值的规范形式: json对象按键排序, 字符串(或字符串形式的json)去掉多余的空白
+    同一个 SDK 在不同app中生成的请求构造因此得到相同的指纹
+    """
+    if isinstance(value, str):
+        text = value.strip()
+        if text[:1] in ("{", "["):
+            try:
+                return json.dumps(json.loads(text), ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+            except json.JSONDecodeError:
+                pass
+        return _whitespace.sub(" ", text)
+    return json.dumps(value, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+
+
+def dedup_fingerprint(value):
+    return hashlib.sha256(canonicalize(value).encode("utf-8")).hexdigest()
+
+
+class DedupStore:
+    """
+    全数据集共享的请求去重表, 以 (阶段, 请求值指纹) 为键保存LLM阶段的结果 (SQLite, 跨运行复用)
+    同一进程内, 同一个请求值同时只由一个app(owner)送入LLM, 其他app等待其结果后直接复用
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self.stats = Counter()
+        self._seen = {}
+        store_dir = os.path.dirname(path)
+        if store_dir and not os.path.exists(store_dir):
+            os.makedirs(store_dir, exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "stage TEXT NOT NULL, fingerprint TEXT NOT NULL, value TEXT NOT NULL, "
+            "PRIMARY KEY (stage, fingerprint))"
+        )
+        self._conn.commit()
+
+    def claim(self, stage, fingerprints):
+        """
+        返回 (已有结果 {指纹: 结果}, 由调用方负责处理的指纹, 正在由其他app处理的 {指纹: Future})
+        调用方处理完后必须对每个负责的指纹调用 publish 或 release
+        """
+        found, owned, waiting = {}, {}, {}
+        with self._lock:
+            seen = self._seen.setdefault(stage, set())
+            for fingerprint in fingerprints:
+                self.stats[f"{stage}_items"] += 1
+                if fingerprint not in seen:
+                    seen.add(fingerprint)
+                    self.stats[f"{stage}_unique"] += 1
+                if fingerprint in found or fingerprint in waiting or fingerprint in owned:
+                    self.stats[f"{stage}_shared"] += 1
+                    continue
+                row = self._conn.execute("SELECT value FROM results WHERE stage = ? AND fingerprint = ?",
+                                         (stage, fingerprint)).fetchone()
+                if row is not None:
+                    found[fingerprint] = json.loads(row[0])
+                    self.stats[f"{stage}_shared"] += 1
+                    continue
+                future = self._inflight.get((stage, fingerprint))
+                if future is not None:
+                    waiting[fingerprint] = future
+                    self.stats[f"{stage}_shared"] += 1
+                    continue
+                self._inflight[(stage, fingerprint)] = Future()
+                owned[fingerprint] = True
+        return found, list(owned), waiting
+
+    def publish(self, stage, fingerprint, value):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO results (stage, fingerprint, value) VALUES (?, ?, ?)",
+                               (stage, fingerprint, json.dumps(value, ensure_ascii=False, default=str)))
+            self._conn.commit()
+            future = self._inflight.pop((stage, fingerprint), None)
+        if future is not None:
+            future.set_result(value)
+
+    def release(self, stage, fingerprint):
+        # owner 处理失败, 等待的app得到 None, 改为自己处理
+        with self._lock:
+            future = self._inflight.pop((stage, fingerprint), None)
+        if future is not None:
+            future.set_result(None)
+
+    def summary(self):
+        """
+        各阶段的去重情况: 条目数、不同请求值的数量、复用结果的条目数和去重率
+        """
+        with self._lock:
+            stats = dict(self.stats)
+        summary = {}
+        for stage in sorted({key.rsplit("_", 1)[0] for key in stats}):
+            items = stats.get(f"{stage}_items", 0)
+            unique = stats.get(f"{stage}_unique", 0)
+            summary[stage] = {
+                "items": items,
+                "unique": unique,
+                "shared": stats.get(f"{stage}_shared", 0),
+                "dedup_ratio": round(1 - unique / items, 4) if items else 0,
+            }
+        return summary
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class DedupClaim:
+    """
+    一个app的一批 {key: 请求值} 在去重表中的申领结果
+    - shared: 可以直接复用的 {key: 结果}
+    - owned_items: 需要本app送入LLM的 {key: 请求值}, 同一个请求值只保留一个key
+    处理完 owned_items 后调用 publish, 再调用 wait / await_wait 取得其他app的结果
+    """
+
+    def __init__(self, store, stage, items: dict):
+        self.store = store
+        self.stage = stage
+        self.items = items
+        self.key_fps = {key: dedup_fingerprint(value) for key, value in items.items()}
+        found, owned, waiting = store.claim(stage, self.key_fps.values())
+        self._owned = set(owned)
+        self._published = set()
+        self.shared = {key: found[fingerprint] for key, fingerprint in self.key_fps.items() if fingerprint in found}
+        self.owned_items = {}
+        owner_fps = set()
+        for key, fingerprint in self.key_fps.items():
+            if fingerprint in self._owned and fingerprint not in owner_fps:
+                owner_fps.add(fingerprint)
+                self.owned_items[key] = items[key]
+        self._waiting = {key: waiting[fingerprint] for key, fingerprint in self.key_fps.items() if fingerprint in waiting}
+
+    def publish(self, results: dict):
+        """
+        results 为 owned_items 的 {key: 结果}; 有结果的请求值写入去重表, 没有结果的释放给等待的app
+        同一个app内重复的请求值同样得到该结果
+        """
+        by_fp = {self.key_fps[key]: result for key, result in results.items()
+                 if key in self.owned_items and result is not None}
+        for fingerprint in self._owned - self._published:
+            if fingerprint in by_fp:
+                self.store.publish(self.stage, fingerprint, by_fp[fingerprint])
+            else:
+                self.store.release(self.stage, fingerprint)
+            self._published.add(fingerprint)
+        for key, fingerprint in self.key_fps.items():
+            if fingerprint in by_fp and key not in self.owned_items:
+                self.shared[key] = by_fp[fingerprint]
+
+    def release(self):
+        # 出错时释放尚未发布的请求值, 避免其他app一直等待
+        self.publish({})
+
+    def _collect(self, key, result):
+        if result is None:
+            return {key: self.items[key]}
+        self.shared[key] = result
+        return {}
+
+    def wait(self):
+        """
+        等待其他app正在处理的请求值, 返回对方处理失败、需要本app自己处理的 {key: 请求值}
+        """
+        retry = {}
+        for key, future in self._waiting.items():
+            retry.update(self._collect(key, future.result()))
+        return retry
+
+    async def await_wait(self):
+        # wait 的异步版本
+        retry = {}
+        for key, future in self._waiting.items():
+            retry.update(self._collect(key, await asyncio.wrap_future(future)))
+        return retry
+
+
+dedup_store = None
+
+
+def setup_dedup_store(args):
+    # 根据命令行参数(add_dedup_args)开启跨app去重
+    global dedup_store
+    if args.dedup and args.dedup_path:
+        dedup_store = DedupStore(args.dedup_path)
+    return dedup_store
+
+
+def dedup_stats() -> dict:
+    if dedup_store is None:
+        return {}
+    return dedup_store.summary()
+
+
+def add_dedup_args(parser, default_path):
+    parser.add_argument("--dedup", action="store_true",
+                        help="run the LLM stages once per unique request value across all apps and share the results")
+    parser.add_argument("--dedup-path", default=default_path, help="cross-app dedup store (sqlite)")
+
+
+def scan_dataset(root, dataset, subdir="llm_preprocess"):
+    """
+    统计数据集中所有app的 {subdir} 输出里请求值的重复情况, 返回 (条目数, 不同请求值数, 重复最多的指纹)
+    """
+    counter = Counter()
+    dataset_path = os.path.join(root, dataset)
+    for app_name in os.listdir(dataset_path):
+        app_path = os.path.join(dataset_path, app_name, subdir)
+        if not os.path.isdir(app_path):
+            continue
+        for file in os.listdir(app_path):
+            if not file.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(app_path, file), 'r', encoding='utf-8') as f:
+                    content = json.load(f)
+            except (OSError, json.JSONDecodeError):
+                continue
+            counter.update(dedup_fingerprint(value) for value in content.values())
+    return sum(counter.values()), len(counter), counter.most_common(10)
+
+
+if __name__ == "__main__":
+    # 数据集级别的重复情况: python3 -m utils.request_dedup --dataset IoT-VER
+    from config import result_root_path, process_dataset
+    parser = argparse.ArgumentParser(description="report cross-app duplicate request values of a dataset")
+    parser.add_argument("--dataset", default=process_dataset)
+    parser.add_argument("--subdir", default="llm_preprocess", help="per-app output directory to scan")
+    args = parser.parse_args()
+
+    items, unique, most_common = scan_dataset(result_root_path, args.dataset, args.subdir)
+    print(f"items: {items}, unique: {unique}, dedup ratio: {1 - unique / items if items else 0:.2%}")
+    for fingerprint, count in most_common:
+        print(f"{fingerprint[:16]} x{count}")
@@ -0,0 +1,228 @@
+import re
+import json
+import argparse
+import threading
+from collections import Counter
+from utils.link_extractor import parse_body, split_response
+
+# 字段名包含这些词时保留其值, 与 extract_download_link_prompt.txt 中的字段提示一致
+_link_key = re.compile(r"url|link|download|path|file|firmware|href|src", re.IGNORECASE)
+# 与链接同一层时保留的上下文字段
+_context_key = re.compile(r"version|ver|name|model|md5|sha|size|hash|crc", re.IGNORECASE)
+# URL 或带扩展名的文件名形状的字符串
+_link_value = re.compile(r"https?://|/|\.[a-z][a-z0-9]{1,7}\b", re.IGNORECASE)
+_url_or_file = re.compile(r"https?://[^\s'\"<>]+|[\w.@%+/-]+\.[a-z][a-z0-9]{1,7}\b", re.IGNORECASE)
+_base64 = re.compile(r"^[A-Za-z0-9+/=_-]{256,}$")
+_html_drop = re.compile(r"<(script|style)\b.*?</\1>", re.IGNORECASE | re.DOTALL)
+_html_tag = re.compile(r"<[^>]+>")
+_whitespace = re.compile(r"\s+")
+
+# 结构骨架的限制: 深度、每个对象保留的字段数、每个列表保留的元素数
+SKELETON_DEPTH = 3
+SKELETON_KEYS = 12
+LIST_ITEMS = 20
+MAX_STRING = 300
+TEXT_HEAD = 500
+TRUNCATED = " ...[truncated]"
+# 原始响应只用于统计, 不调用 tokenizer, 按字符数估计 token 数(与 rate_limiter.estimate_tokens 相同)
+RAW_CHARS_PER_TOKEN = 3
+
+
+def _placeholder(value):
+    # 被丢弃的字段在骨架中只保留类型
+    if isinstance(value, str):
+        if _base64.match(value):
+            return f"<base64 {len(value)} chars>"
+        return f"<str {len(value)}>"
+    if isinstance(value, dict):
+        return f"<object {len(value)} keys>"
+    if isinstance(value, list):
+        return f"<list {len(value)} items>"
+    return value if isinstance(value, (int, float, bool)) or value is None else f"<{type(value).__name__}>"
+
+
+def _short(value):
+    if len(value) <= MAX_STRING or value.startswith(("http://", "https://")):
+        return value
+    return value[:MAX_STRING] + TRUNCATED
+
+
+def compact_json(node, depth=0, key=""):
+    """
+    只保留带链接的字段和 URL / 文件名形状的字符串, 其余字段在 SKELETON_DEPTH 层以内保留类型占位
+    与链接同一层的版本号、校验值等短字段一并保留, 便于LLM判断
+    返回 (压缩后的值, 是否包含链接相关的内容)
+    """
+    if isinstance(node, dict):
+        children = {name: compact_json(value, depth + 1, str(name)) for name, value in node.items()}
+        relevant = any(child_relevant for _, child_relevant in children.values())
+        kept, skeleton = {}, 0
+        for name, (compacted, child_relevant) in children.items():
+            value = node[name]
+            if child_relevant:
+                kept[name] = compacted
+            elif relevant and _context_key.search(str(name)) and isinstance(value, (str, int, float)) \
+                    and len(str(value)) <= MAX_STRING:
+                kept[name] = value
+            elif depth < SKELETON_DEPTH and skeleton < SKELETON_KEYS:
+                kept[name] = compacted if isinstance(value, (dict, list)) else _placeholder(value)
+                skeleton += 1
+        return kept, relevant
+    if isinstance(node, list):
+        kept, relevant_items, dropped = [], 0, 0
+        for value in node:
+            compacted, relevant = compact_json(value, depth + 1, key)
+            if relevant and relevant_items < LIST_ITEMS:
+                kept.append(compacted)
+                relevant_items += 1
+            elif not kept and depth < SKELETON_DEPTH:
+                # 没有链接的列表只保留第一个元素作为结构示例
+                kept.append(compacted if isinstance(value, (dict, list)) else _placeholder(value))
+            else:
+                dropped += 1
+        if dropped:
+            kept.append(f"<{dropped} more items>")
+        return kept, relevant_items > 0
+    if isinstance(node, str):
+        if _base64.match(node):
+            return _placeholder(node), False
+        if _link_value.search(node) or (_link_key.search(key) and len(node) <= MAX_STRING):
+            return _short(node), True
+        return _placeholder(node), False
+    return node, False
+
+
+def compact_xml(root):
+    # xml 转换为 "路径[@属性]: 值" 的行, 只保留链接相关的值, 其余元素只保留一次路径作为骨架
+    lines, seen = [], set()
+    stack = [(root, root.tag)]
+    while stack:
+        element, path = stack.pop()
+        kept = [f"{path}@{name}: {_short(value)}" for name, value in element.attrib.items()
+                if _link_value.search(value) or _link_key.search(name) or _context_key.search(name)]
+        text = (element.text or "").strip()
+        if text and (_link_value.search(text) or _link_key.search(element.tag)):
+            kept.append(f"{path}: {_short(text)}")
+        if kept:
+            lines.extend(kept)
+        elif path not in seen and len(seen) < SKELETON_KEYS * SKELETON_DEPTH:
+            lines.append(path)
+        seen.add(path)
+        stack.extend(reversed([(child, f"{path}/{child.tag}") for child in element]))
+    return "\n".join(dict.fromkeys(lines))
+
+
+def compact_text(text):
+    # html / 纯文本: 去掉脚本和标签, 保留开头一段(错误信息)和其中所有的 URL / 文件名
+    text = _whitespace.sub(" ", _html_tag.sub(" ", _html_drop.sub(" ", text))).strip()
+    if len(text) <= TEXT_HEAD:
+        return text
+    links = list(dict.fromkeys(match for match in _url_or_file.findall(text[TEXT_HEAD:])))
+    return text[:TEXT_HEAD] + TRUNCATED + ("\nlinks: " + " ".join(links) if links else "")
+
+
+def compact_body(content):
+    kind, body = parse_body(content)
+    if kind == "json":
+        return json.dumps(compact_json(body)[0], ensure_ascii=False)
+    if kind == "xml":
+        return compact_xml(body)
+    return compact_text(body)
+
+
+def compact_response(res):
+    """
+    function call 的单个响应压缩为送入LLM的文本, 状态码和错误信息原样保留
+    """
+    status_code, content = split_response(res)
+    if isinstance(res, dict) and "content" in res:
+        head = {name: value for name, value in res.items() if name != "content"}
+        body = compact_body(res["content"]) if content is not None else compact_text(str(res["content"]))
+        return json.dumps(head, ensure_ascii=False, default=str) + "\ncontent: " + body
+    return compact_body(content)
+
+
+def fit_token_budget(text, budget, count_tokens):
+    """
+    超过 budget 时按比例截断并重新计数, 返回 (文本, token数, 是否截断)
+    """
+    tokens = count_tokens(text)
+    truncated = False
+    while tokens > budget and text:
+        truncated = True
+        keep = max(0, int(len(text) * budget / tokens * 0.9) - len(TRUNCATED))
+        text = text[:keep] + TRUNCATED if keep else ""
+        tokens = count_tokens(text)
+    return text, tokens, truncated
+
+
+class ResponseCompactor:
+    """
+    startDownload 送入LLM的响应压缩, 统计压缩前(按字符数估计)后的 token 数和截断次数
+    budget 为 0 时不压缩, 与原来一样使用 str(res)
+    """
+
+    def __init__(self, budget=4000):
+        self.budget = budget
+        self.stats = Counter()
+        self._lock = threading.Lock()
+
+    def compact(self, res, count_tokens_batch):
+        """
+        返回 (文本, {"raw_tokens", "compact_tokens", "truncated"}), raw_tokens 为估计值
+        原始响应可能有几 MB, 只对压缩后的文本调用 tokenizer, 避免长时间占用全局的 tokenizer 锁
+        """
+        raw = str(res)
+        if self.budget <= 0:
+            return raw, None
+        compacted = compact_response(res)
+        raw_tokens = len(raw) // RAW_CHARS_PER_TOKEN
+        compact_tokens = count_tokens_batch([compacted])[0]
+        truncated = False
+        if compact_tokens > self.budget:
+            compacted, compact_tokens, truncated = fit_token_budget(
+                compacted, self.budget, lambda text: count_tokens_batch([text])[0])
+        with self._lock:
+            self.stats["responses"] += 1
+            self.stats["raw_tokens"] += raw_tokens
+            self.stats["compact_tokens"] += compact_tokens
+            self.stats["truncated"] += int(truncated)
+        return compacted, {"raw_tokens": raw_tokens, "compact_tokens": compact_tokens, "truncated": truncated}
+
+    def summary(self):
+        with self._lock:
+            stats = dict(self.stats)
+        if stats.get("raw_tokens"):
+            stats["compaction_ratio"] = round(stats["compact_tokens"] / stats["raw_tokens"], 4)
+        return stats
+
+
+response_compactor = ResponseCompactor()
+
+
+def setup_response_compactor(args):
+    # 根据命令行参数(add_compactor_args)设置响应的 token 上限
+    response_compactor.budget = args.response_token_budget
+    return response_compactor
+
+
+def response_compactor_stats() -> dict:
+    return response_compactor.summary()
+
+
+def add_compactor_args(parser):
+    parser.add_argument("--response-token-budget", type=int, default=response_compactor.budget,
+                        help="max tokens of one compacted http response sent to the LLM, 0 = send the raw response")
+
+
+if __name__ == "__main__":
+    # 查看一个响应压缩后的内容: python3 -m utils.response_compactor response.json
+    parser = argparse.ArgumentParser(description="show the compacted form of an http response body")
+    parser.add_argument("path", help="file with the response body")
+    args = parser.parse_args()
+
+    with open(args.path, "r", encoding="utf-8", errors="replace") as file:
+        content = file.read()
+    compacted = compact_body(content)
+    print(compacted)
+    print(f"chars: {len(content)} -> {len(compacted)}")
@@ -0,0 +1,255 @@
+import os
+import json
+import time
+import sqlite3
+import asyncio
+import hashlib
+import threading
+import functools
+import contextvars
+
+# 当前 (app, 阶段) 的断点记录, 线程(work_queue 会复制上下文)和asyncio任务各自继承调用方的作用域
+_current_checkpoint = contextvars.ContextVar("run_manifest_checkpoint", default=None)
+
+# app 级别记录使用的 item
+APP_ITEM = ""
+
+
+def fingerprint_value(value):
+    # 单个条目(字符串或json对象)的指纹
+    payload = value if isinstance(value, str) else json.dumps(value, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def fingerprint_files(paths):
+    # 一组输入文件(文件名+内容)的指纹, 文件顺序无关
+    digest = hashlib.sha256()
+    for path in sorted(paths):
+        digest.update(os.path.basename(path).encode("utf-8") + b"\0")
+        with open(path, "rb") as file:
+            for chunk in iter(lambda: file.read(1 << 20), b""):
+                digest.update(chunk)
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class RunManifest:
+    """
+    基于 SQLite 的运行清单, 记录每个 app x 阶段 x 条目的状态 (done / failed / partial) 和输入指纹
+    item 为空字符串表示整个app; 条目完成时可以附带结果(json), 断点续跑时直接复用
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+        manifest_dir = os.path.dirname(path)
+        if manifest_dir and not os.path.exists(manifest_dir):
+            os.makedirs(manifest_dir, exist_ok=True)
+
+    def _connect(self):
+        # 连接不能跨 fork 使用, 子进程重新连接
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS manifest ("
+                "dataset TEXT NOT NULL, app TEXT NOT NULL, stage TEXT NOT NULL, item TEXT NOT NULL, "
+                "status TEXT NOT NULL, fingerprint TEXT, result TEXT, updated REAL NOT NULL, "
+                "PRIMARY KEY (dataset, app, stage, item))"
+            )
+            self._conn.commit()
+            self._pid = os.getpid()
+        return self._conn
+
+    def items(self, dataset, app, stage):
+        """
+        返回 {item: (status, fingerprint, result)}
+        """
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT item, status, fingerprint, result FROM manifest WHERE dataset = ? AND app = ? AND stage = ?",
+                (dataset, app, stage)).fetchall()
+        return {item: (status, fingerprint, json.loads(result) if result else None)
+                for item, status, fingerprint, result in rows}
+
+    def mark(self, dataset, app, stage, item, status, fingerprint=None, result=None):
+        value = json.dumps(result, ensure_ascii=False, default=str) if result is not None else None
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO manifest (dataset, app, stage, item, status, fingerprint, result, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (dataset, app, stage, item, status, fingerprint, value, time.time()))
+            conn.commit()
+
+    def summary(self, dataset=None):
+        # 各阶段app级别的状态计数: {stage: {status: count}}
+        query = "SELECT stage, status, COUNT(*) FROM manifest WHERE item = ?"
+        params = [APP_ITEM]
+        if dataset is not None:
+            query += " AND dataset = ?"
+            params.append(dataset)
+        with self._lock:
+            rows = self._connect().execute(query + " GROUP BY stage, status", params).fetchall()
+        summary = {}
+        for stage, status, count in rows:
+            summary.setdefault(stage, {})[status] = count
+        return summary
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None and self._pid == os.getpid():
+                self._conn.close()
+            self._conn = None
+
+
+class StageCheckpoint:
+    """
+    一个app在一个阶段内的断点记录
+    resume=True 时, 指纹相同且已完成的条目通过 completed_item 返回保存的结果, 失败或指纹变化的条目重新处理
+    """
+
+    def __init__(self, manifest, dataset, app, stage, resume):
+        self.manifest = manifest
+        self.dataset = dataset
+        self.app = app
+        self.stage = stage
+        self._lock = threading.Lock()
+        self._items = manifest.items(dataset, app, stage) if resume else {}
+        self.resumed = 0
+        self.failed = 0
+
+    def completed_item(self, item, fingerprint):
+        # 返回已完成条目保存的结果(没有结果时为 True), 否则返回 None
+        with self._lock:
+            record = self._items.get(item)
+            if record is None or record[0] != "done" or record[1] != fingerprint:
+                return None
+            self.resumed += 1
+        return record[2] if record[2] is not None else True
+
+    def item_done(self, item):
+        with self._lock:
+            record = self._items.get(item)
+        return record is not None and record[0] == "done"
+
+    def mark_item(self, item, fingerprint, result=None, status="done"):
+        self.manifest.mark(self.dataset, self.app, self.stage, item, status, fingerprint, result)
+        with self._lock:
+            self._items[item] = (status, fingerprint, result)
+            if status == "failed":
+                self.failed += 1
+
+
+class _NullCheckpoint:
+    # 没有开启运行清单时使用, 所有条目都需要处理
+    resumed = 0
+    failed = 0
+
+    def completed_item(self, item, fingerprint):
+        return None
+
+    def item_done(self, item):
+        return False
+
+    def mark_item(self, item, fingerprint, result=None, status="done"):
+        pass
+
+
+_null_checkpoint = _NullCheckpoint()
+
+
+def current_checkpoint():
+    # 当前作用域的断点记录, 没有开启运行清单时返回一个空实现
+    return _current_checkpoint.get() or _null_checkpoint
+
+
+run_manifest = None
+resume = False
+
+
+def setup_run_manifest(args):
+    # 根据命令行参数(add_manifest_args)开启运行清单
+    global run_manifest, resume
+    if args.no_manifest or not args.manifest_path:
+        return None
+    run_manifest = RunManifest(args.manifest_path)
+    resume = args.resume
+    return run_manifest
+
+
+def add_manifest_args(parser, default_path):
+    parser.add_argument("--manifest-path", default=default_path, help="run manifest (sqlite) of per-app, per-stage status")
+    parser.add_argument("--no-manifest", action="store_true", help="do not record the run manifest")
+    parser.add_argument("--resume", action="store_true",
+                        help="skip apps and items completed in the manifest with the same input, retry failed ones")
+
+
+def checkpoint_stage(stage, list_inputs):
+    """
+    装饰 func(app_name, dataset), 在运行清单中记录该app在 stage 阶段的状态
+    list_inputs(app_name, dataset) 返回该阶段的输入文件, 其指纹不变且上次已完成时, resume 模式下直接跳过
+    函数内部通过 current_checkpoint() 按条目记录; 有条目失败时app记为 partial, 续跑时只重试未完成的条目
+    支持同步函数和 async 函数, 需要放在 record_app_stats 外层, 跳过的app不会覆盖原来的统计
+    """
+    def start(app_name, dataset):
+        try:
+            fingerprint = fingerprint_files(list_inputs(app_name, dataset))
+        except OSError:
+            fingerprint = None
+        checkpoint = StageCheckpoint(run_manifest, dataset, app_name, stage, resume)
+        if fingerprint is not None and checkpoint.completed_item(APP_ITEM, fingerprint):
+            return checkpoint, fingerprint, True
+        return checkpoint, fingerprint, False
+
+    def finish(checkpoint, fingerprint, error=None):
+        if error is not None:
+            status = "failed"
+        else:
+            status = "partial" if checkpoint.failed else "done"
+        checkpoint.mark_item(APP_ITEM, fingerprint, {"resumed_items": checkpoint.resumed,
+                                                     "failed_items": checkpoint.failed}, status=status)
+
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(app_name, dataset, *args, **kwargs):
+                if run_manifest is None:
+                    return await func(app_name, dataset, *args, **kwargs)
+                checkpoint, fingerprint, skip = start(app_name, dataset)
+                if skip:
+                    return f"Skipped {app_name} (resume)"
+                token = _current_checkpoint.set(checkpoint)
+                try:
+                    result = await func(app_name, dataset, *args, **kwargs)
+                except Exception as e:
+                    finish(checkpoint, fingerprint, e)
+                    raise
+                finally:
+                    _current_checkpoint.reset(token)
+                finish(checkpoint, fingerprint)
+                return result
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(app_name, dataset, *args, **kwargs):
+            if run_manifest is None:
+                return func(app_name, dataset, *args, **kwargs)
+            checkpoint, fingerprint, skip = start(app_name, dataset)
+            if skip:
+                return f"Skipped {app_name} (resume)"
+            token = _current_checkpoint.set(checkpoint)
+            try:
+                result = func(app_name, dataset, *args, **kwargs)
+            except Exception as e:
+                finish(checkpoint, fingerprint, e)
+                raise
+            finally:
+                _current_checkpoint.reset(token)
+            finish(checkpoint, fingerprint)
+            return result
+        return wrapper
+    return decorator
@@ -0,0 +1,205 @@
+import re
+import os
+import ast
+import json
+import math
+import argparse
+from collections import Counter
+import numpy as np
+
+
+def vote_entropy(counter):
+    total_votes = sum(counter.values())
+    probabilities = np.array([count / total_votes for count in counter.values()])
+    return -np.sum(probabilities * np.log(probabilities))
+
+
+class ConsistencyEntropyPolicy:
+    """
+    原有的终止规则: 至少 initial_rounds 票后, 一致性 >= consistency_threshold 且熵 <= entropy_threshold 时终止
+    """
+    name = "consistency"
+
+    def __init__(self, initial_rounds=5, consistency_threshold=0.8, entropy_threshold=0.5):
+        self.min_rounds = initial_rounds
+        self.consistency_threshold = consistency_threshold
+        self.entropy_threshold = entropy_threshold
+
+    def should_stop(self, predictions):
+        counter = Counter(predictions)
+        consistency_score = counter.most_common(1)[0][1] / len(predictions)
+        return consistency_score >= self.consistency_threshold and vote_entropy(counter) <= self.entropy_threshold
+
+
+class DirichletPolicy:
+    """
+    贝叶斯终止规则: 各标签的概率服从 Dirichlet(alpha + 计票) 后验,
+    当前票数最多的标签确实是概率最大的标签的后验概率 >= threshold 时终止 (蒙特卡洛估计)
+    """
+    name = "dirichlet"
+
+    def __init__(self, num_labels=4, alpha=0.5, threshold=0.9, min_rounds=2, samples=4000):
+        self.num_labels = num_labels
+        self.alpha = alpha
+        self.threshold = threshold
+        self.min_rounds = min_rounds
+        self.samples = samples
+        self._cache = {}
+
+    def posterior(self, predictions):
+        counts = sorted(Counter(predictions).values(), reverse=True)
+        counts += [0] * max(0, self.num_labels - len(counts))
+        key = tuple(counts)
+        if key not in self._cache:
+            # 后验只与计票有关, 固定随机种子保证同样的计票得到同样的结果
+            rng = np.random.default_rng(list(key))
+            draws = rng.dirichlet(np.array(counts, dtype=float) + self.alpha, self.samples)
+            self._cache[key] = float((draws.argmax(axis=1) == 0).mean())
+        return self._cache[key]
+
+    def should_stop(self, predictions):
+        return self.posterior(predictions) >= self.threshold
+
+
+class SPRTPolicy:
+    """
+    序贯概率比检验 (SPRT) 终止规则
+    H1: 每一票以概率 p1 投给当前领先的标签; H0: 随机投票, 概率为 1/num_labels
+    对数似然比超过 log((1 - beta) / alpha) 时接受 H1 并终止, 默认参数下 3 票一致即可终止
+    """
+    name = "sprt"
+
+    def __init__(self, num_labels=4, p1=0.9, alpha=0.05, beta=0.1, min_rounds=2):
+        p0 = 1 / num_labels
+        self.agree_llr = math.log(p1 / p0)
+        self.disagree_llr = math.log((1 - p1) / (1 - p0))
+        self.upper_bound = math.log((1 - beta) / alpha)
+        self.min_rounds = min_rounds
+
+    def llr(self, predictions):
+        agree = Counter(predictions).most_common(1)[0][1]
+        return agree * self.agree_llr + (len(predictions) - agree) * self.disagree_llr
+
+    def should_stop(self, predictions):
+        return self.llr(predictions) >= self.upper_bound
+
+
+STOPPING_POLICIES = {
+    "consistency": ConsistencyEntropyPolicy,
+    "dirichlet": DirichletPolicy,
+    "sprt": SPRTPolicy,
+}
+
+
+def get_stopping_policy(name, **kwargs):
+    """
+    按名称创建终止规则, kwargs 传给对应的构造函数
+    """
+    if name not in STOPPING_POLICIES:
+        raise ValueError(f"unknown stopping policy: {name}, choices: {list(STOPPING_POLICIES)}")
+    return STOPPING_POLICIES[name](**kwargs)
+
+
+# ---------------- 离线模拟: 用 phase2 日志中记录的投票序列回放 ----------------
+VOTE_SEQUENCE_PATTERN = re.compile(r"\[INFO\]: vote sequence: (\{.*\})\s*$")
+PREDICTIONS_PATTERN = re.compile(r"^\{(.+?)\} \[INFO\]: predictions: (\[.*\])\s*$")
+USED_TOKEN_PATTERN = re.compile(r"^\{(.+?)\} \[INFO\]: used token: (\d+)")
+
+
+def load_vote_sequences(log_paths):
+    """
+    从 phase2 日志中读取每个条目的完整投票序列, 返回 [{"votes": [...], "tokens": [...]}]
+    优先使用 "vote sequence:" 记录; 旧日志没有该记录时, 按线程拼接逐票打印的 predictions
+    (异步模式下同一线程的条目会交错, 只能依赖 "vote sequence:" 记录)
+    """
+    sequences = []
+    for log_path in log_paths:
+        with open(log_path, 'r', encoding='utf-8', errors='replace') as f:
+            lines = f.readlines()
+
+        if any(VOTE_SEQUENCE_PATTERN.search(line) for line in lines):
+            for line in lines:
+                match = VOTE_SEQUENCE_PATTERN.search(line)
+                if match:
+                    sequences.append(json.loads(match.group(1)))
+            continue
+
+        current = {}
+        for line in lines:
+            match = PREDICTIONS_PATTERN.match(line)
+            if match:
+                thread, votes = match.group(1), ast.literal_eval(match.group(2))
+                previous = current.get(thread)
+                if previous and len(votes) <= len(previous["votes"]):
+                    sequences.append(previous)
+                    previous = None
+                current[thread] = {"votes": votes, "tokens": previous["tokens"] if previous else []}
+                continue
+            match = USED_TOKEN_PATTERN.match(line)
+            if match and match.group(1) in current:
+                current[match.group(1)]["tokens"].append(int(match.group(2)))
+        sequences.extend(current.values())
+    return sequences
+
+
+def replay(votes, policy, max_rounds=10):
+    """
+    按 policy 回放一条投票序列, 返回 (使用的票数, 标签, 是否用完了记录的投票仍未终止)
+    """
+    for rounds in range(policy.min_rounds, min(len(votes), max_rounds) + 1):
+        if policy.should_stop(votes[:rounds]):
+            return rounds, Counter(votes[:rounds]).most_common(1)[0][0], False
+    exhausted = len(votes) < max_rounds
+    return len(votes), Counter(votes).most_common(1)[0][0], exhausted
+
+
+def simulate(sequences, policies, max_rounds=10):
+    """
+    对比各个终止规则: 票数、token 消耗, 以及与日志中实际结果(完整序列的多数标签)的一致率
+    """
+    report = {}
+    baseline_votes = sum(len(sequence["votes"]) for sequence in sequences)
+    baseline_tokens = sum(sum(sequence["tokens"]) for sequence in sequences)
+    for policy in policies:
+        votes_used, tokens_used, agree, exhausted = 0, 0, 0, 0
+        for sequence in sequences:
+            votes = sequence["votes"]
+            rounds, label, ran_out = replay(votes, policy, max_rounds)
+            votes_used += rounds
+            # 旧日志中缺少的 token 记录按该序列的平均值估计
+            tokens = sequence["tokens"]
+            average = sum(tokens) / len(tokens) if tokens else 0
+            tokens_used += sum(tokens[:rounds]) + average * max(0, rounds - len(tokens))
+            agree += label == Counter(votes).most_common(1)[0][0]
+            exhausted += ran_out
+        report[policy.name] = {
+            "items": len(sequences),
+            "votes": votes_used,
+            "avg_votes": round(votes_used / len(sequences), 3) if sequences else 0,
+            "tokens": int(tokens_used),
+            "token_saving": round(1 - tokens_used / baseline_tokens, 4) if baseline_tokens else 0,
+            "vote_saving": round(1 - votes_used / baseline_votes, 4) if baseline_votes else 0,
+            "label_agreement": round(agree / len(sequences), 4) if sequences else 0,
+            "exhausted": exhausted,
+        }
+    return report
+
+
+if __name__ == "__main__":
+    # 离线模拟: python3 -m utils.stopping_policy --logs logs/llm_phase2
+    parser = argparse.ArgumentParser(description="replay logged phase2 votes under different stopping policies")
+    parser.add_argument("--logs", nargs="+", default=["logs/llm_phase2"], help="phase2 log files or directories")
+    parser.add_argument("--max-rounds", type=int, default=10)
+    args = parser.parse_args()
+
+    log_paths = []
+    for path in args.logs:
+        if os.path.isdir(path):
+            log_paths.extend(os.path.join(path, file) for file in sorted(os.listdir(path)) if file.endswith(".log"))
+        else:
+            log_paths.append(path)
+
+    sequences = [sequence for sequence in load_vote_sequences(log_paths) if sequence["votes"]]
+    policies = [get_stopping_policy(name) for name in STOPPING_POLICIES]
+    for name, result in simulate(sequences, policies, args.max_rounds).items():
+        print(f"{name:12s} {result}")
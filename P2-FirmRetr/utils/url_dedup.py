@@ -0,0 +1,191 @@
+import os
+import time
+import sqlite3
+import hashlib
+import argparse
+import threading
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+# 不影响下载内容的跟踪参数, 规范化时去掉
+TRACKING_PARAMS = {"fbclid", "gclid", "dclid", "msclkid", "yclid", "igshid", "spm", "mc_cid", "mc_eid", "_hsenc", "_hsmkt"}
+TRACKING_PREFIXES = ("utm_",)
+
+DEFAULT_PORTS = {"http": 80, "https": 443, "ftp": 21}
+
+
+def canonicalize_url(url):
+    """
+    URL 的规范形式: scheme/主机名小写, 去掉默认端口、片段和跟踪参数, 查询参数按键排序
+    无法解析的字符串原样返回(去掉首尾空白)
+    """
+    url = url.strip()
+    try:
+        parts = urlsplit(url)
+        port = parts.port
+    except ValueError:
+        return url
+    if not parts.scheme or not parts.netloc:
+        return url
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    if parts.username or parts.password:
+        host = parts.netloc.rsplit("@", 1)[0] + "@" + host
+    if port is not None and port != DEFAULT_PORTS.get(scheme):
+        host = f"{host}:{port}"
+    query = [(name, value) for name, value in parse_qsl(parts.query, keep_blank_values=True)
+             if name.lower() not in TRACKING_PARAMS and not name.lower().startswith(TRACKING_PREFIXES)]
+    return urlunsplit((scheme, host, parts.path or "/", urlencode(sorted(query)), ""))
+
+
+class UrlDedup:
+    """
+    下载链接去重: 进程内按规范化URL分片加锁的集合, 判断和加入为 O(1), 多个app的线程共用
+    指定 path 时, 已经下载过的URL保存在 SQLite 中, 之后的运行和其他app不再重复下载
+    每个链接带一个 Event, 得到链接的调用方下载完成(record_downloaded)后置位, 其他app可以 wait 后复用下载结果
+    """
+
+    def __init__(self, path=None, shards=16):
+        self.path = path
+        self._shards = [(threading.Lock(), {}) for _ in range(shards)]
+        self._lock = threading.Lock()
+        self._conn = None
+        self.stats = {"claimed": 0, "duplicate": 0, "downloaded_before": 0}
+        if path:
+            store_dir = os.path.dirname(path)
+            if store_dir and not os.path.exists(store_dir):
+                os.makedirs(store_dir, exist_ok=True)
+            self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS downloads ("
+                "url TEXT PRIMARY KEY, app TEXT, dataset TEXT, updated REAL NOT NULL)"
+            )
+            self._conn.commit()
+
+    def _shard(self, url):
+        digest = hashlib.blake2b(url.encode("utf-8"), digest_size=4).digest()
+        return self._shards[int.from_bytes(digest, "little") % len(self._shards)]
+
+    def _downloaded_before(self, url):
+        if self._conn is None:
+            return False
+        with self._lock:
+            row = self._conn.execute("SELECT 1 FROM downloads WHERE url = ?", (url,)).fetchone()
+        return row is not None
+
+    def claim(self, urls, seen=None):
+        """
+        返回 urls 中第一次出现、且之前没有下载过的链接(保持原顺序), 同时标记为已访问
+        同一个链接并发 claim 时只有一个调用方得到它; 传入 seen 列表时, 被去掉的链接加入其中
+        """
+        claimed = []
+        for url in urls:
+            if not isinstance(url, str) or not url.strip():
+                continue
+            canonical = canonicalize_url(url)
+            lock, visited = self._shard(canonical)
+            with lock:
+                if canonical in visited:
+                    self._count("duplicate")
+                    if seen is not None:
+                        seen.append(url)
+                    continue
+                visited[canonical] = threading.Event()
+            if self._downloaded_before(canonical):
+                self._count("downloaded_before")
+                visited[canonical].set()
+                if seen is not None:
+                    seen.append(url)
+                continue
+            self._count("claimed")
+            claimed.append(url)
+        return claimed
+
+    def record_downloaded(self, urls, app_name=None, dataset=None):
+        # 下载请求完成后调用, 持久化之后不会再下载这些链接
+        if self._conn is not None and urls:
+            now = time.time()
+            with self._lock:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO downloads (url, app, dataset, updated) VALUES (?, ?, ?, ?)",
+                    [(canonicalize_url(url), app_name, dataset, now) for url in urls])
+                self._conn.commit()
+        for url in urls:
+            self._finish(canonicalize_url(url))
+
+    def release(self, urls):
+        # 没有下载成功的链接: 从已访问集合中移除, 其他app之后可以重新下载, 并唤醒等待其结果的调用方
+        for url in urls:
+            canonical = canonicalize_url(url)
+            lock, visited = self._shard(canonical)
+            with lock:
+                event = visited.pop(canonical, None)
+            if event is not None:
+                event.set()
+
+    def _finish(self, canonical):
+        lock, visited = self._shard(canonical)
+        with lock:
+            event = visited.get(canonical)
+        if event is not None:
+            event.set()
+
+    def wait(self, url, timeout=None):
+        """
+        等待其他调用方对该链接的下载结束, 之前运行下载过或没有被 claim 的链接立即返回
+        返回 False 表示超时
+        """
+        canonical = canonicalize_url(url)
+        lock, visited = self._shard(canonical)
+        with lock:
+            event = visited.get(canonical)
+        return event is None or event.wait(timeout)
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def summary(self):
+        with self._lock:
+            stats = dict(self.stats)
+        stats["visited"] = sum(len(visited) for _, visited in self._shards)
+        return stats
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+            self._conn = None
+
+
+# 默认只在进程内去重, setup_url_dedup 开启持久化
+url_dedup = UrlDedup()
+
+
+def setup_url_dedup(args):
+    # 根据命令行参数(add_url_dedup_args)选择是否持久化已下载的链接
+    global url_dedup
+    if not args.no_download_history and args.download_history_path:
+        url_dedup = UrlDedup(args.download_history_path)
+    return url_dedup
+
+
+def url_dedup_stats() -> dict:
+    return url_dedup.summary()
+
+
+def add_url_dedup_args(parser, default_path):
+    parser.add_argument("--download-history-path", default=default_path,
+                        help="urls downloaded by earlier runs or other apps (sqlite), never downloaded again")
+    parser.add_argument("--no-download-history", action="store_true",
+                        help="only dedup download links within this run")
+
+
+if __name__ == "__main__":
+    # 查看链接的规范形式: python3 -m utils.url_dedup 'http://A.com:80/x?b=1&utm_source=y&a=2'
+    parser = argparse.ArgumentParser(description="print the canonical form of urls")
+    parser.add_argument("urls", nargs="+")
+    args = parser.parse_args()
+    for url in args.urls:
+        print(canonicalize_url(url))
@@ -1,5 +1,8 @@
 import os
 import json
+import asyncio
+import tempfile
+import threading
 
 def get_json_content_from_file(json_path):
     # 从文件中读取json内容
@@ -7,38 +10,55 @@ def get_json_content_from_file(json_path):
         content = json.load(f)
     return content
 
-def save_llm_phase_time(save_path, stage, times):
-    # 记录每次llm调用的耗时
-    if not os.path.exists(save_path):
+# 进程的 umask 只能通过设置来读取, 在导入时(单线程)读取一次
+_umask = os.umask(0)
+os.umask(_umask)
+
+def save_json_atomic(content, json_path):
+    # 先写同目录下的临时文件再 rename, 并发写入或中途退出都不会留下损坏的文件
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{os.path.basename(json_path)}.", suffix=".tmp", dir=os.path.dirname(json_path) or ".")
+    try:
+        # mkstemp 创建的文件权限为 0600, 改为与 open() 新建文件相同的权限, 共享的结果目录其他用户仍可读
+        os.chmod(tmp_path, 0o666 & ~_umask)
+        with os.fdopen(fd, 'w', encoding='utf-8') as file:
+            json.dump(content, file, ensure_ascii=False, indent=4)
+        os.replace(tmp_path, json_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+_stats_file_locks = {}
+_stats_file_locks_lock = threading.Lock()
+
+def update_stats_file(save_path, updates: dict):
+    """
+    将 updates 合并进 save_path 处的统计json, 原子写入
+    """
+    with _stats_file_locks_lock:
+        lock = _stats_file_locks.setdefault(save_path, threading.Lock())
+    with lock:
         data = {}
-    else:
-        try:
-            with open(save_path, 'r', encoding='utf-8') as file:
-                data = json.load(file)
-        except json.JSONDecodeError:
-            # 文件存在但内容不是有效的 JSON，初始化为一个空字典
-            print(f"Error reading JSON from {save_path}. Initializing as an empty dictionary.")
-    
-    data[f'{stage}_times'] = times
+        if os.path.exists(save_path):
+            try:
+                with open(save_path, 'r', encoding='utf-8') as file:
+                    data = json.load(file)
+            except json.JSONDecodeError:
+                # 文件存在但内容不是有效的 JSON，初始化为一个空字典
+                print(f"Error reading JSON from {save_path}. Initializing as an empty dictionary.")
+        data.update(updates)
+        save_json_atomic(data, save_path)
+
+def save_llm_phase_time(save_path, stage, times):
+    # 记录每次llm调用的耗时; 各阶段内部使用 utils.app_stats 按app累加后一次写入
+    update_stats_file(save_path, {f'{stage}_times': times})
 
-    with open(save_path, 'w', encoding='utf-8') as file:
-        json.dump(data, file, ensure_ascii=False, indent=4)
 def save_llm_usage(save_path, stage, tokens):
     # 记录每次llm调用使用的token量
-    if not os.path.exists(save_path):
-        data = {}
-    else:
-        try:
-            with open(save_path, 'r', encoding='utf-8') as file:
-                data = json.load(file)
-        except json.JSONDecodeError:
-            # 文件存在但内容不是有效的 JSON，初始化为一个空字典
-            print(f"Error reading JSON from {save_path}. Initializing as an empty dictionary.")
-    
-    data[f'{stage}_tokens'] = tokens
+    update_stats_file(save_path, {f'{stage}_tokens': tokens})
 
-    with open(save_path, 'w', encoding='utf-8') as file:
-        json.dump(data, file, ensure_ascii=False, indent=4)
+def save_llm_stats(save_path, stage, stats: dict):
+    # 记录各阶段的统计信息(计数器等)
+    update_stats_file(save_path, {f'{stage}_stats': stats})
 
 def save2json(content, json_path):
     # 将内容保存为json文件
@@ -78,3 +98,31 @@ def save_errors(errors: list, file_path):
         file.write(f"Summary of Errors(total {len(errors)}):\n")
         file.write("\n".join(errors))
         file.write("\n")
+
+
+async def run_apps_async(task, applist, dataset, max_apps=50):
+    """
+    在一个事件循环中并发处理所有app, 同时处理的app数量不超过 max_apps
+    task 为 async def task(app_name, dataset), 返回所有错误信息
+    """
+    semaphore = asyncio.Semaphore(max_apps)
+    completed = 0
+    total = len(applist)
+    errors = []  # 用于记录所有错误信息
+
+    async def run(app):
+        nonlocal completed
+        async with semaphore:
+            try:
+                result = await task(app, dataset)
+            except Exception as e:
+                # 捕获异常并记录详细信息
+                error_message = f"Error processing {app}: {str(e)}"
+                errors.append(error_message)
+                print(error_message)
+                result = "error"
+        completed += 1
+        print(f"Progress: {completed}/{total} - {result}")
+
+    await asyncio.gather(*(run(app) for app in applist))
+    return errors
@@ -0,0 +1,53 @@
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+
+class LLMWorkQueue:
+    """
+    多个app共享的有界 LLM 任务队列 (线程模式)
+    - max_workers 个线程同时执行任务, 最多 max_pending 个任务(包括正在执行的)在队列中, 队列满时 submit 阻塞
+    - 任务在提交者的 contextvars 上下文中执行, 按app统计的缓存命中等信息不会丢失
+    任务内部不能再向同一个队列提交任务并等待结果, 否则可能死锁
+    """
+
+    def __init__(self, max_workers=16, max_pending=None, name="llm"):
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._slots = threading.BoundedSemaphore(max_pending or max_workers * 4)
+
+    def submit(self, fn, *args, **kwargs):
+        self._slots.acquire()
+        context = contextvars.copy_context()
+        try:
+            future = self._executor.submit(context.run, fn, *args, **kwargs)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def map(self, fn, iterable):
+        # 按顺序返回结果列表
+        futures = [self.submit(fn, item) for item in iterable]
+        return [future.result() for future in futures]
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+
+_queues = {}
+_queues_lock = threading.Lock()
+
+
+def get_work_queue(name, max_workers=16, max_pending=None) -> LLMWorkQueue:
+    """
+    获取进程内名为 name 的共享任务队列, 第一次调用时按参数创建
+    """
+    queue = _queues.get(name)
+    if queue is None:
+        with _queues_lock:
+            queue = _queues.get(name)
+            if queue is None:
+                queue = _queues[name] = LLMWorkQueue(max_workers, max_pending, name)
+    return queue